@@ -0,0 +1,86 @@
+"""Startup time, agreement and throughput of the NumPy engine vs Theano
+
+Usage: python -m benchmarks.engine [--model resnet] [--checkpoint ckpt.npz]
+
+Builds the model (with random weights unless a checkpoint is given), exports
+its predict function with and without plan optimization (batch norm folding,
+nonlinearity fusion, dropout removal) and scores the same inputs with all
+three. Outputs are compared against Theano's deterministic predictions.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+import theano
+import models
+from models.export import export
+from util.engine import Engine
+
+# ----------------------------------------------------------------------------
+
+def make_model(name):
+  if name == 'resnet':
+    return models.Resnet(n_dim=32, n_out=10, n_chan=3, n_superbatch=100)
+  elif name == 'cnn':
+    return models.CNN(n_dim=32, n_out=10, n_chan=3, model='cifar10', n_superbatch=100)
+  elif name == 'mlp':
+    return models.MLP(n_dim=28, n_out=10, n_chan=1, n_superbatch=100)
+  raise ValueError('Invalid model')
+
+def throughput(f, X, n_repeat):
+  f(X[:len(X) // 10]) # warm up
+  start_time = time.time()
+  for i in range(n_repeat):
+    f(X)
+  return n_repeat * len(X) / (time.time() - start_time)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='resnet', choices=['resnet', 'cnn', 'mlp'])
+  parser.add_argument('--checkpoint')
+  parser.add_argument('--n', type=int, default=1000)
+  parser.add_argument('--batchsize', type=int, default=100)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  np.random.seed(1234)
+  start_time = time.time()
+  model = make_model(args.model)
+  if args.checkpoint:
+    model.load(args.checkpoint)
+  model.compile_inference('predict')
+  theano_startup = time.time() - start_time
+
+  shape = (args.n, model.n_chan, model.n_dim, model.n_dim)
+  X = np.random.normal(size=shape).astype(theano.config.floatX)
+  P = model.predict(X, batchsize=args.batchsize)
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    print '{:<12}{:>8}{:>14}{:>14}{:>12}'.format(
+        'runtime', 'ops', 'startup (s)', 'max |diff|', 'rows/s')
+    print '{:<12}{:>8}{:>14.3f}{:>14}{:>12.1f}'.format(
+        'theano', '-', theano_startup, '-',
+        throughput(lambda X: model.predict(X, batchsize=args.batchsize), X, args.repeat))
+
+    for name, optimize in (('numpy', False), ('numpy-opt', True)):
+      fname = os.path.join(tmpdir, name + '.npz')
+      export(model, 'predict', fname, optimize=optimize)
+
+      start_time = time.time()
+      engine = Engine.load(fname)
+      P_engine = engine(X[:args.batchsize], batchsize=args.batchsize)
+      startup = time.time() - start_time
+
+      P_engine = engine(X, batchsize=args.batchsize)
+      print '{:<12}{:>8}{:>14.3f}{:>14.2e}{:>12.1f}'.format(
+          name, len(engine.plan['ops']), startup, np.abs(P_engine - P).max(),
+          throughput(lambda X: engine(X, batchsize=args.batchsize), X, args.repeat))
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,74 @@
+"""Step time of the REINFORCE models with float64 vs floatX centering signals
+
+Usage: python -m benchmarks.reinforce_dtype [--steps 200] [--n_batch 128]
+
+The 'float64' variant rebuilds the models with the centering variables c, v
+created as np.float64, which is how they were defined before; the 'floatX'
+variant is the current code.
+"""
+import time
+import argparse
+import numpy as np
+
+import theano
+import models
+
+# ----------------------------------------------------------------------------
+
+def _float64_centering():
+  c = theano.shared(np.zeros((1,1), dtype=np.float64), broadcastable=(True,True))
+  v = theano.shared(np.zeros((1,1), dtype=np.float64), broadcastable=(True,True))
+  return c, v
+
+class SBN64(models.SBN):
+  def create_model(self, X, Y, n_dim, n_out, n_chan=1):
+    network = models.SBN.create_model(self, X, Y, n_dim, n_out, n_chan)
+    return network[:-2] + _float64_centering()
+
+class DADGM64(models.DADGM):
+  def create_model(self, X, Y, n_dim, n_out, n_chan=1):
+    network = models.DADGM.create_model(self, X, Y, n_dim, n_out, n_chan)
+    return network[:-2] + _float64_centering()
+
+VARIANTS = [
+  ('sbn', 'float64', SBN64),
+  ('sbn', 'floatX', models.SBN),
+  ('dadgm', 'float64', DADGM64),
+  ('dadgm', 'floatX', models.DADGM),
+]
+
+# ----------------------------------------------------------------------------
+
+def time_steps(model, n_steps, n_batch):
+  n_superbatch = model.n_superbatch
+  X = np.random.binomial(1, 0.5, size=(n_superbatch, 1, 28, 28))
+  Y = np.zeros((n_superbatch,))
+  model.load_data(X.astype(theano.config.floatX), Y.astype(theano.config.floatX))
+
+  n_idx = n_superbatch // n_batch
+  model.train(0, n_batch, 1.0) # warm up
+
+  start_time = time.time()
+  for step in range(n_steps):
+    idx1 = (step % n_idx) * n_batch
+    model.train(idx1, idx1 + n_batch, 1.0)
+  return (time.time() - start_time) / n_steps
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--steps', type=int, default=200)
+  parser.add_argument('--n_batch', type=int, default=128)
+  parser.add_argument('--n_superbatch', type=int, default=1280)
+  args = parser.parse_args()
+
+  print 'floatX = {}'.format(theano.config.floatX)
+  print '{:<8}{:<10}{:>16}{:>14}'.format('model', 'centering', 'float64 nodes', 'ms/step')
+  for name, variant, cls in VARIANTS:
+    np.random.seed(1234)
+    model = cls(n_dim=28, n_out=10, n_superbatch=args.n_superbatch)
+    n_float64 = sum(len(nodes) for nodes in model.audit_dtypes().values())
+    step_time = time_steps(model, args.steps, args.n_batch)
+    print '{:<8}{:<10}{:>16}{:>14.3f}'.format(name, variant, n_float64, 1000 * step_time)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,64 @@
+"""Latency and throughput of a running inference server under concurrent load
+
+Usage: python run.py serve --model vae --checkpoint vae.ckpt.npz &
+       python -m benchmarks.serve_load --url http://127.0.0.1:8000/encode
+
+Each client thread sends requests back to back, so --clients is also the
+number of requests in flight; raise it to see how well they get coalesced.
+"""
+import time
+import argparse
+import threading
+import numpy as np
+
+from util.serve import post_array
+
+# ----------------------------------------------------------------------------
+
+def run_client(url, X, n_requests, latencies, errors):
+  for i in range(n_requests):
+    start_time = time.time()
+    try:
+      post_array(url, X)
+    except Exception:
+      errors.append(i)
+      continue
+    latencies.append(time.time() - start_time)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--url', default='http://127.0.0.1:8000/encode')
+  parser.add_argument('--clients', type=int, default=16)
+  parser.add_argument('--requests', type=int, default=200,
+                      help='Requests per client')
+  parser.add_argument('--rows', type=int, default=1,
+                      help='Rows per request')
+  parser.add_argument('--n_in', type=int, default=784,
+                      help='Width of each row (e.g. latent size for /decode)')
+  args = parser.parse_args()
+
+  X = np.random.binomial(1, 0.5, size=(args.rows, args.n_in)).astype(np.float32)
+  post_array(args.url, X) # warm up
+
+  latencies, errors = [], []
+  clients = [threading.Thread(target=run_client,
+                              args=(args.url, X, args.requests, latencies, errors))
+             for i in range(args.clients)]
+  start_time = time.time()
+  for client in clients: client.start()
+  for client in clients: client.join()
+  elapsed = time.time() - start_time
+
+  if not latencies:
+    print 'all {} requests failed'.format(len(errors))
+    return
+  latencies = 1000 * np.array(latencies)
+  print 'clients:     {}'.format(args.clients)
+  print 'requests:    {} ({} failed)'.format(len(latencies) + len(errors), len(errors))
+  print 'latency p50: {:.2f} ms'.format(np.percentile(latencies, 50))
+  print 'latency p99: {:.2f} ms'.format(np.percentile(latencies, 99))
+  print 'throughput:  {:.1f} req/s, {:.1f} rows/s'.format(
+      len(latencies) / elapsed, args.rows * len(latencies) / elapsed)
+
+if __name__ == '__main__':
+  main()
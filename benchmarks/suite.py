@@ -0,0 +1,213 @@
+"""Build/compile time, step throughput and peak memory of every model
+
+Usage: python run.py bench [--models vae sbn] [--out bench.json] [--baseline old.json]
+   or: python -m benchmarks.suite (same options)
+
+Each model is built with the same options as `run.py train` and fed
+synthetic data of its input shape, in a process of its own so that peak RSS
+is the model's alone. Build time is the construction time minus the time
+spent inside theano.function. Train and eval throughput are measured at
+each batch size after a few warm-up steps (the RBM's batch size is fixed
+when it is compiled, so it is measured at that size only).
+
+With --baseline, every metric that got worse by more than --tolerance
+(relative) is listed and the command exits with status 1.
+"""
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from util.memory import rss_mb
+
+MODELS = ['softmax', 'mlp', 'cnn', 'resnet', 'vae', 'vae_reinforce', 'sbn', 'sbn_gsm',
+          'adgm', 'dadgm', 'adgm_gsm', 'gsm', 'rbm']
+
+# ----------------------------------------------------------------------------
+# measurements
+
+class CompileTimer(object):
+  """Accumulates the time spent in theano.function while active"""
+  def __enter__(self):
+    import theano
+    self.seconds, self.n_functions = 0., 0
+    self._function = theano.function
+
+    def timed_function(*args, **kwargs):
+      start_time = time.time()
+      try:
+        return self._function(*args, **kwargs)
+      finally:
+        self.seconds += time.time() - start_time
+        self.n_functions += 1
+
+    theano.function = timed_function
+    return self
+
+  def __exit__(self, *exc_info):
+    import theano
+    theano.function = self._function
+
+def throughput(step, batchsize, n_steps, n_warmup=3):
+  """Examples per second of step(i), after n_warmup untimed calls"""
+  for i in range(n_warmup):
+    step(i)
+  start_time = time.time()
+  for i in range(n_steps):
+    step(i)
+  return n_steps * batchsize / (time.time() - start_time)
+
+def load_synthetic(model, n, n_out, seed=0):
+  """Load n binary examples shaped like the model's training buffers
+
+  Returns X and int32 labels Y, as model.loss takes them; the training
+  buffers get a copy of Y in their own (float) dtype.
+  """
+  import theano
+  rng = np.random.RandomState(seed)
+  shape = model.train_set_x.get_value(borrow=True).shape
+  X = rng.binomial(1, 0.5, size=(n,) + shape[1:]).astype(theano.config.floatX)
+  Y = rng.randint(n_out, size=n).astype('int32')
+  model.load_data(X, Y.astype(model.train_set_y.get_value(borrow=True).dtype), dest='train')
+  return X, Y
+
+def step_throughput(model, X, Y, batchsize, n_steps):
+  """((batchsize, train examples/s), (batchsize, eval examples/s)) on loaded data
+
+  The RBM's batch size is fixed at compile time and used instead.
+  """
+  if hasattr(model, 'k_steps'):
+    b = model.n_batch
+    n_batches = len(X) // b
+    train = throughput(lambda i: model.train(i % n_batches), b, n_steps)
+    evaluate = throughput(
+      lambda i: model.loss(X[(i % n_batches) * b:(i % n_batches + 1) * b]), b, n_steps)
+    return (b, train), (b, evaluate)
+
+  b = batchsize
+  n_batches = len(X) // b
+  def train_step(i):
+    idx1 = (i % n_batches) * b
+    model.train(idx1, idx1 + b, 1.0)
+  def eval_step(i):
+    idx1 = (i % n_batches) * b
+    model.loss(X[idx1:idx1 + b], Y[idx1:idx1 + b])
+  return (b, throughput(train_step, b, n_steps)), (b, throughput(eval_step, b, n_steps))
+
+def bench_model(name, dataset='mnist', batch_sizes=(32, 128, 512), n_steps=20):
+  """Timings of one model; call in a fresh process for a meaningful peak RSS"""
+  import run
+
+  n_superbatch = max(batch_sizes) * 4
+  args = run.make_parser().parse_args(
+    ['train', '--model', name, '--dataset', dataset, '--n_batch', str(max(batch_sizes)),
+     '--n_superbatch', str(n_superbatch)])
+
+  start_time = time.time()
+  with CompileTimer() as compile_timer:
+    model = run.make_model(args)
+  total = time.time() - start_time
+  result = dict(build_s=total - compile_timer.seconds, compile_s=compile_timer.seconds,
+                n_functions=compile_timer.n_functions, train={}, eval={})
+
+  X, Y = load_synthetic(model, n_superbatch, run.DATASET_DIMS[dataset][1])
+  for b in (batch_sizes[:1] if name == 'rbm' else batch_sizes):
+    (b, train), (_, evaluate) = step_throughput(model, X, Y, b, n_steps)
+    result['train'][str(b)], result['eval'][str(b)] = train, evaluate
+
+  result['peak_rss_mb'] = rss_mb()[1]
+  return result
+
+def _bench_in_child(queue, name, kwargs):
+  try:
+    queue.put(bench_model(name, **kwargs))
+  except Exception as e:
+    queue.put(dict(error='%s: %s' % (type(e).__name__, e)))
+
+def run_suite(names=MODELS, **kwargs):
+  results = {}
+  for name in names:
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_bench_in_child, args=(queue, name, kwargs))
+    process.start()
+    results[name] = queue.get()
+    process.join()
+    print_result(name, results[name])
+  return results
+
+def print_result(name, result):
+  if 'error' in result:
+    print '{:<14} failed: {}'.format(name, result['error'])
+    return
+  print '{:<14} build {:.2f}s  compile {:.2f}s ({} fns)  peak {:.0f}MB'.format(
+    name, result['build_s'], result['compile_s'], result['n_functions'], result['peak_rss_mb'])
+  for b in sorted(result['train'], key=int):
+    print '{:<14}   batch {:>4}: train {:>10.1f}/s  eval {:>10.1f}/s'.format(
+      '', b, result['train'][b], result['eval'][b])
+
+# ----------------------------------------------------------------------------
+# baselines
+
+def _flatten(results):
+  """(model, metric, batch) -> (value, lower_is_better)"""
+  flat = {}
+  for name, result in results.items():
+    if 'error' in result: continue
+    for metric in ['build_s', 'compile_s', 'peak_rss_mb']:
+      flat[(name, metric, None)] = (result[metric], True)
+    for metric in ['train', 'eval']:
+      for b, value in result[metric].items():
+        flat[(name, metric, b)] = (value, False)
+  return flat
+
+def compare(results, baseline, tolerance=0.1):
+  """Metrics that are more than tolerance worse than in the baseline"""
+  current, old = _flatten(results), _flatten(baseline)
+  regressions = []
+  for key in sorted(current):
+    if key not in old: continue
+    (value, lower_is_better), (old_value, _) = current[key], old[key]
+    change = (value - old_value) / old_value if old_value else 0.
+    if (change if lower_is_better else -change) > tolerance:
+      regressions.append((key, old_value, value, change))
+  return regressions
+
+# ----------------------------------------------------------------------------
+
+def add_bench_args(parser):
+  parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+  parser.add_argument('--dataset', default='mnist')
+  parser.add_argument('--batch-sizes', nargs='+', type=int, default=[32, 128, 512])
+  parser.add_argument('--steps', type=int, default=20,
+                      help='Timed steps per batch size')
+  parser.add_argument('--out', default='bench.json')
+  parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+  parser.add_argument('--tolerance', type=float, default=0.1)
+
+def bench(args):
+  results = run_suite(args.models, dataset=args.dataset,
+                      batch_sizes=tuple(args.batch_sizes), n_steps=args.steps)
+  with open(args.out, 'w') as f:
+    json.dump(results, f, indent=1, sort_keys=True)
+  print 'Wrote {}'.format(args.out)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for (name, metric, b), old_value, value, change in regressions:
+      print 'REGRESSION {} {}{}: {:.4g} -> {:.4g} ({:+.1f}%)'.format(
+        name, metric, ' @%s' % b if b else '', old_value, value, 100 * change)
+    if regressions:
+      sys.exit(1)
+    print 'No regressions against {}'.format(args.baseline)
+
+def main():
+  parser = argparse.ArgumentParser()
+  add_bench_args(parser)
+  bench(parser.parse_args())
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,14 @@
+import numpy as np
+
+from models.mlp import MLP
+from benchmarks.suite import load_synthetic, step_throughput
+
+# ----------------------------------------------------------------------------
+
+def test_step_throughput_supervised():
+  # the loss function takes int32 labels; float labels raise a TypeError
+  model = MLP(n_dim=28, n_out=10, n_superbatch=64, n_hidden=[32])
+  X, Y = load_synthetic(model, 64, 10)
+  assert Y.dtype == np.int32
+  (b, train), (_, evaluate) = step_throughput(model, X, Y, 16, n_steps=2)
+  assert b == 16 and train > 0 and evaluate > 0
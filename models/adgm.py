@@ -1,6 +1,7 @@
 import time
 import pickle
 import numpy as np
+from collections import OrderedDict
 
 import theano
 import theano.tensor as T
@@ -10,17 +11,23 @@ from model import Model
 
 from layers import GaussianSampleLayer
 
-from distributions import log_bernoulli, log_normal, log_normal2
+from distributions import log_bernoulli_logit, log_normal, log_normal2, log_mean_exp
 
 # ----------------------------------------------------------------------------
 
 class ADGM(Model):
   """Auxiliary Deep Generative Model (unsupervised version)"""
   def __init__(self, n_dim, n_out, n_chan=1, n_superbatch=12800, model='bernoulli',
-                opt_alg='adam', opt_params={'lr' : 1e-3, 'b1': 0.9, 'b2': 0.99}):
+                opt_alg='adam', opt_params={'lr' : 1e-3, 'b1': 0.9, 'b2': 0.99},
+                n_samples=1, iwae=False):
     # save model that wil be created
     self.model = model
 
+    # number of samples of z drawn per datapoint during training, and
+    # whether to combine them into an importance-weighted bound
+    self.n_samples = n_samples
+    self.iwae = iwae
+
     Model.__init__(self, n_dim, n_chan, n_out, n_superbatch, opt_alg, opt_params)
 
   def create_model(self, X, Y, n_dim, n_out, n_chan=1):
@@ -77,7 +84,9 @@ class ADGM(Model):
         W=lasagne.init.GlorotNormal(),
         b=lasagne.init.Normal(1e-3),
         nonlinearity=relu_shift)
-    l_qz = GaussianSampleLayer(l_qz_mu, l_qz_logsigma)
+    # q(a|x) and q(z|a,x) run once per datapoint; only z is drawn n_samples
+    # times, so the decoder and p(a|z) see (n_samples*batch) rows
+    l_qz = GaussianSampleLayer(l_qz_mu, l_qz_logsigma, n_samples=self.n_samples)
 
     # create the decoder network
 
@@ -90,8 +99,9 @@ class ADGM(Model):
     l_px_mu, l_px_logsigma = None, None
 
     if self.model == 'bernoulli':
+      # the decoder outputs logits; the likelihood is computed in logit space
       l_px_mu = lasagne.layers.DenseLayer(l_px_hid, num_units=n_out,
-          nonlinearity = lasagne.nonlinearities.sigmoid,
+          nonlinearity = None,
           W=lasagne.init.GlorotUniform(),
           b=lasagne.init.Normal(1e-3))
     elif self.model == 'gaussian':
@@ -152,6 +162,10 @@ class ADGM(Model):
     X = self.inputs[0]
     x = X.flatten(2)
 
+    # z (and everything downstream of it) has k samples per datapoint
+    k = 1 if deterministic else self.n_samples
+    tile = lambda v: T.tile(v, (k,) + (1,) * (v.ndim - 1)) if k > 1 else v
+
     # load network
     l_px_mu, l_px_logsigma, l_pa_mu, l_pa_logsigma, \
       l_qz_mu, l_qz_logsigma, l_qa_mu, l_qa_logsigma, \
@@ -171,20 +185,20 @@ class ADGM(Model):
                                                      deterministic=deterministic)
 
     # entropy term
-    log_qa_given_x  = log_normal2(a, qa_mu, qa_logsigma).sum(axis=1)
-    log_qz_given_ax = log_normal2(z, qz_mu, qz_logsigma).sum(axis=1)
+    log_qa_given_x  = tile(log_normal2(a, qa_mu, qa_logsigma).sum(axis=1))
+    log_qz_given_ax = log_normal2(z, tile(qz_mu), tile(qz_logsigma)).sum(axis=1)
     log_qza_given_x = log_qz_given_ax + log_qa_given_x
 
     # log-probability term
-    z_prior_sigma = T.cast(T.ones_like(qz_logsigma), dtype=theano.config.floatX)
-    z_prior_mu = T.cast(T.zeros_like(qz_mu), dtype=theano.config.floatX)
+    z_prior_sigma = T.cast(T.ones_like(z), dtype=theano.config.floatX)
+    z_prior_mu = T.cast(T.zeros_like(z), dtype=theano.config.floatX)
     log_pz = log_normal(z, z_prior_mu,  z_prior_sigma).sum(axis=1)
-    log_pa_given_z = log_normal2(a, pa_mu, pa_logsigma).sum(axis=1)
+    log_pa_given_z = log_normal2(tile(a), pa_mu, pa_logsigma).sum(axis=1)
 
     if self.model == 'bernoulli':
-      log_px_given_z = log_bernoulli(x, px_mu).sum(axis=1)
+      log_px_given_z = log_bernoulli_logit(tile(x), px_mu).sum(axis=1)
     elif self.model == 'gaussian':
-      log_px_given_z = log_normal2(x, px_mu, px_logsigma).sum(axis=1)
+      log_px_given_z = log_normal2(tile(x), px_mu, px_logsigma).sum(axis=1)
 
     log_paxz = log_pa_given_z + log_px_given_z + log_pz
 
@@ -195,7 +209,11 @@ class ADGM(Model):
     # log_paxz = log_pa + log_px_given_z + log_pz
 
     # compute the evidence lower bound
-    elbo = T.mean(log_paxz - log_qza_given_x)
+    if self.iwae and k > 1:
+      log_w = (log_paxz - log_qza_given_x).reshape((k, -1))
+      elbo = log_mean_exp(log_w, axis=0).mean()
+    else:
+      elbo = T.mean(log_paxz - log_qza_given_x)
 
     # we don't use a spearate accuracy metric right now
     return -elbo, T.mean(qz_logsigma)
@@ -220,3 +238,17 @@ class ADGM(Model):
       if param not in params: params.append(param)
 
     return params
+
+  def get_inference_layers(self):
+    l_px_mu, l_qz_mu, l_qz_logsigma = self.network[0], self.network[4], self.network[5]
+    l_qz = self.network[9]
+    post = 'sigmoid' if self.model == 'bernoulli' else None
+    return OrderedDict([
+      ('encode', dict(output=l_qz_mu)),
+      ('posterior', dict(output=[l_qz_mu, l_qz_logsigma], names=['q_mu', 'q_logsigma'])),
+      ('decode', dict(input=l_qz, output=l_px_mu, post=post)),
+    ])
+
+  def sample_prior(self, n, rng=np.random):
+    n_lat = self.network[4].output_shape[1]
+    return rng.normal(size=(n, n_lat)).astype(theano.config.floatX)
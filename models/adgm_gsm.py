@@ -1,18 +1,18 @@
 
 import numpy as np
+from collections import OrderedDict
 import theano.tensor as T
 from lasagne.layers import (
   InputLayer, DenseLayer, ElemwiseSumLayer, NonlinearityLayer,
-  reshape, flatten, get_all_params, get_output,
+  reshape, flatten, get_all_params, get_all_layers, get_output,
 )
 from lasagne.updates import total_norm_constraint
 from lasagne.init import GlorotNormal, Normal
 from layers import GumbelSoftmaxSampleLayer, GaussianSampleLayer
-from distributions import log_bernoulli, log_normal2
+from distributions import log_bernoulli, log_bernoulli_logit, log_normal2
 from gsm import GSM
 
 import theano, lasagne
-theano.config.optimizer = 'None'
 
 class ADGM_GSM(GSM):
   """ Auxiliary Deep Generative Model trained
@@ -20,6 +20,9 @@ class ADGM_GSM(GSM):
       https://arxiv.org/pdf/1602.05473v4.pdf
       https://arxiv.org/pdf/1611.01144v2.pdf
   """
+  # compiled without graph optimizations
+  mode = theano.Mode(optimizer=None)
+
   def create_model(self, x, y, n_dim, n_out, n_chan=1):
     n_class = 10  # number of classes
     n_cat = 20  # number of categorical distributions
@@ -77,7 +80,8 @@ class ADGM_GSM(GSM):
     # )
     # qz_net_sample = GaussianSampleLayer(qz_net_mu, qz_net_logsigma)
     qz_net_mu = reshape(qz_net_mu, (-1, n_class))
-    qz_net_sample = GumbelSoftmaxSampleLayer(qz_net_mu, tau)
+    qz_net_sample = GumbelSoftmaxSampleLayer(qz_net_mu, tau,
+                                             straight_through=self.straight_through)
     qz_net_sample = reshape(qz_net_sample, (-1, n_cat, n_class))
 
     # create the decoder network
@@ -88,7 +92,7 @@ class ADGM_GSM(GSM):
     )
     px_net_mu = DenseLayer(
       px_net, num_units=n_out,
-      nonlinearity=T.nnet.sigmoid,
+      nonlinearity=None,
     )
 
     # - create p(a|z)
@@ -133,10 +137,10 @@ class ADGM_GSM(GSM):
     )
 
     # calculate the likelihoods
-    qz_given_ax = T.nnet.softmax(qz_mu)  # (batch*n_cat, n_class)
-    _qz_given_ax = qz_given_ax.reshape((-1, n_cat*n_class))  # (batch, n_lat)
+    # log q(z|a,x) straight from the logits, without the log of a softmax
+    log_qz_given_ax = T.nnet.logsoftmax(qz_mu)  # (batch*n_cat, n_class)
+    log_qz_given_ax = log_qz_given_ax.reshape((-1, n_cat*n_class)).sum(axis=1)
     _qz_sample = qz_sample.reshape((-1, n_cat*n_class))
-    log_qz_given_ax = T.log(_qz_given_ax + 1e-20).sum(axis=1)
     log_qa_given_x = log_normal2(qa_sample, qa_mu, qa_logsigma).sum(axis=1)
     # log_qz_given_ax = log_normal2(qz_sample, qz_mu, qz_logsigma).sum(axis=1)
     log_qza_given_x = log_qz_given_ax + log_qa_given_x
@@ -146,7 +150,7 @@ class ADGM_GSM(GSM):
     # log_pz = log_normal2(_qz_sample, z_prior_mu,  z_prior_sigma).sum(axis=1)
     z_prior = T.ones_like(_qz_sample)*np.float32(0.5)
     log_pz = log_bernoulli(_qz_sample, z_prior).sum(axis=1)
-    log_px_given_z = log_bernoulli(x, px_mu).sum(axis=1)
+    log_px_given_z = log_bernoulli_logit(x, px_mu).sum(axis=1)
     log_pa_given_z = log_normal2(qa_sample, pa_mu, pa_logsigma).sum(axis=1)
     log_paxz = log_pa_given_z + log_px_given_z + log_pz
 
@@ -175,3 +179,13 @@ class ADGM_GSM(GSM):
         params.append(param)
 
     return params
+
+  def get_inference_layers(self):
+    px_net_mu, qz_net_mu = self.network[0], self.network[3]
+    qz_net_sample = [l for l in get_all_layers(px_net_mu)
+                     if isinstance(l, GumbelSoftmaxSampleLayer)][0]
+    return OrderedDict([
+      ('encode', dict(output=qz_net_mu, post='softmax')),
+      ('posterior', dict(output=[qz_net_mu], names=['q_y'], post='softmax')),
+      ('decode', dict(input=qz_net_sample, output=px_net_mu, post='sigmoid')),
+    ])
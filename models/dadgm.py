@@ -10,14 +10,15 @@ from theano.gradient import disconnected_grad as dg
 
 from model import Model
 from layers import GaussianSampleLayer, BernoulliSampleLayer
-from distributions import log_bernoulli, log_normal2
-
-theano.config.optimizer = 'None'
+from distributions import log_bernoulli, log_bernoulli_logit, log_normal2
 
 # ----------------------------------------------------------------------------
 
 class DADGM(Model):
   """Auxiliary Deep Generative Model (unsupervised version) with discrete z"""
+  # compiled without graph optimizations
+  mode = theano.Mode(optimizer=None)
+
   def __init__(self, n_dim, n_out, n_chan=1, n_superbatch=12800, model='bernoulli',
                 opt_alg='adam', opt_params={'lr' : 1e-3, 'b1': 0.9, 'b2': 0.99}):
     # save model that wil be created
@@ -83,8 +84,9 @@ class DADGM(Model):
     l_px_mu, l_px_logsigma = None, None
 
     if self.model == 'bernoulli':
+      # the decoder outputs logits; the likelihood is computed in logit space
       l_px_mu = lasagne.layers.DenseLayer(l_px_hid, num_units=n_out,
-          nonlinearity = lasagne.nonlinearities.sigmoid)
+          nonlinearity = None)
     elif self.model == 'gaussian':
       l_px_mu = lasagne.layers.DenseLayer(
           l_px_hid, num_units=n_out,
@@ -117,8 +119,8 @@ class DADGM(Model):
         nonlinearity=None)
 
     # create variables for centering signal
-    c = theano.shared(np.zeros((1,1), dtype=np.float64), broadcastable=(True,True))
-    v = theano.shared(np.zeros((1,1), dtype=np.float64), broadcastable=(True,True))
+    c = theano.shared(np.zeros((1,1), dtype=theano.config.floatX), broadcastable=(True,True))
+    v = theano.shared(np.zeros((1,1), dtype=theano.config.floatX), broadcastable=(True,True))
 
     # store certain input layers for downstream (quick hack)
     self.input_layers = (l_qa_in, l_qz_in, l_px_in)
@@ -168,7 +170,7 @@ class DADGM(Model):
     # z_prior_sigma = T.cast(T.ones_like(qz_logsigma), dtype=theano.config.floatX)
     # z_prior_mu = T.cast(T.zeros_like(qz_mu), dtype=theano.config.floatX)
     # log_pz = log_normal(z, z_prior_mu,  z_prior_sigma).sum(axis=1)
-    log_px_given_z = log_bernoulli(x, px_mu).sum(axis=1)
+    log_px_given_z = log_bernoulli_logit(x, px_mu).sum(axis=1)
     log_pa_given_z = log_normal2(a, pa_mu, pa_logsigma).sum(axis=1)
 
     log_pxz = log_pa_given_z + log_px_given_z + log_pz
@@ -273,6 +275,21 @@ class DADGM(Model):
     # return p_params + qa_params + qz_params + cv_params
     return p_params + qa_params +qz_params #+ cv_params
 
+  def get_inference_layers(self):
+    l_px_mu, l_qa_mu, l_qz_mu = self.network[0], self.network[4], self.network[6]
+    l_qa_in, l_qz_in, l_px_in = self.input_layers
+    post = 'sigmoid' if self.model == 'bernoulli' else None
+    return OrderedDict([
+      # feed q(z|a,x) with the mean of q(a|x)
+      ('encode', dict(output=l_qz_mu, links={l_qz_in : l_qa_mu})),
+      ('posterior', dict(output=[l_qz_mu], names=['q_mu'], links={l_qz_in : l_qa_mu})),
+      ('decode', dict(input=l_px_in, output=l_px_mu, post=post)),
+    ])
+
+  def sample_prior(self, n, rng=np.random):
+    n_lat = self.network[6].output_shape[1]
+    return rng.binomial(1, 0.5, size=(n, n_lat)).astype(theano.config.floatX)
+
   def create_updates(self, grads, params, alpha, opt_alg, opt_params):
     # call super-class to generate SGD/ADAM updates
     grad_updates = Model.create_updates(self, grads, params, alpha, opt_alg, opt_params)
@@ -1 +1,2 @@
-from distributions import *
\ No newline at end of file
+from distributions import *
+from operations import log_sum_exp, log_mean_exp
@@ -26,6 +26,45 @@ def log_bernoulli(x, p, eps=1e-6):
     p = T.clip(p, eps, 1.0 - eps)
     return -T.nnet.binary_crossentropy(p, x)
 
+def log_bernoulli_logit(x, logit):
+    """
+    Compute log pdf of a Bernoulli distribution parameterized by its logit, at values x.
+        .. math:: \log p(x; l) = x \log \sigma(l) + (1-x) \log (1-\sigma(l)) = x l - \log(1 + e^l)
+    Parameters
+    ----------
+    x : Theano tensor
+        Values at which to evaluate pdf.
+    logit : Theano tensor
+        Pre-sigmoid activation, i.e. :math:`\log p(x=1) - \log p(x=0)`.
+    Returns
+    -------
+    Theano tensor
+        Element-wise log probability, this has to be summed for multi-variate distributions.
+    See also
+    --------
+    log_bernoulli : using probability parameterization
+    """
+    return x * logit - T.nnet.softplus(logit)
+
+def log_categorical_logit(x, logit):
+    """
+    Compute log pdf of a categorical distribution parameterized by its logits, at values x.
+        .. math:: \log p(x; l) = \sum_k x_k (l_k - \log \sum_j e^{l_j})
+    Parameters
+    ----------
+    x : Theano tensor
+        One-hot values (or class probabilities) along the last axis.
+    logit : Theano tensor
+        Unnormalized log probabilities along the last axis.
+    Returns
+    -------
+    Theano tensor
+        Log probability of each categorical variable; the last axis is summed over.
+    """
+    logit_max = T.max(logit, axis=-1, keepdims=True)
+    log_z = T.log(T.sum(T.exp(logit - logit_max), axis=-1, keepdims=True)) + logit_max
+    return T.sum(x * (logit - log_z), axis=-1)
+
 def log_normal(x, mean, std, eps=1e-6):
     """
     Compute log pdf of a Gaussian distribution with diagonal covariance, at values x.
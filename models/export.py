@@ -0,0 +1,433 @@
+import os
+import json
+from collections import OrderedDict
+
+import numpy as np
+import theano
+import theano.tensor as T
+import lasagne
+from lasagne.layers import (
+  InputLayer, DenseLayer, Conv2DLayer, MaxPool2DLayer, BatchNormLayer,
+  ElemwiseSumLayer, NonlinearityLayer, GlobalPoolLayer, ReshapeLayer,
+  FlattenLayer, PadLayer, ExpressionLayer, DropoutLayer, get_all_layers,
+)
+
+from layers import (GaussianSampleLayer, BernoulliSampleLayer,
+                    GumbelSoftmaxSampleLayer)
+from util.checkpoint import save_npz
+from util.engine import optimize as optimize_plan
+from util.quantize import quantize, dequantize, fallbacks, OUTPUT_AXIS
+from helpers import evaluate, iterate_chunk_idx
+
+# ----------------------------------------------------------------------------
+# identifying nonlinearities
+
+# nonlinearities are recognized by evaluating them on a probe, so lambdas
+# such as the shifted relus in the models are handled as well
+_PROBE = np.linspace(-20, 20, 84).reshape(4, 21).astype(theano.config.floatX)
+
+_CANDIDATES = [
+  ('identity', lambda x: x),
+  ('relu', lambda x: np.maximum(x, 0)),
+  ('sigmoid', lambda x: 1. / (1. + np.exp(-x))),
+  ('tanh', np.tanh),
+  ('softplus', lambda x: np.logaddexp(0, x)),
+  ('softmax', lambda x: np.exp(x - x.max(1, keepdims=True))
+                        / np.exp(x - x.max(1, keepdims=True)).sum(1, keepdims=True)),
+]
+
+def identify_nonlinearity(f, _cache={}):
+  """Name (and parameters) of nonlinearity f, as a dict"""
+  if f is None:
+    return dict(name='identity')
+  if f not in _cache:
+    y = f(T.constant(_PROBE)).eval()
+    for name, g in _CANDIDATES:
+      if np.allclose(y, g(_PROBE.astype(np.float64)), atol=1e-5):
+        _cache[f] = dict(name=name)
+        break
+    else:
+      # relu(x + s) - s, used for numerically stable log-sigmas
+      floor = float(y.min())
+      if np.allclose(y, np.maximum(_PROBE, floor), atol=1e-5):
+        _cache[f] = dict(name='floor', value=floor)
+      else:
+        raise NotImplementedError('Unsupported nonlinearity %r' % f)
+  return _cache[f]
+
+def identify_slice(layer):
+  """Express an ExpressionLayer as basic slicing (e.g. X[:, :, ::2, ::2])"""
+  shape = [s or 2 for s in layer.input_shape]
+  x = np.arange(np.prod(shape), dtype=np.float64).reshape(shape)
+  try:
+    y = np.asarray(layer.function(x))
+  except Exception:
+    raise NotImplementedError('Unsupported ExpressionLayer %s' % layer.name)
+  if y.ndim == x.ndim and y.size:
+    start = np.unravel_index(int(y.flat[0]), shape)
+    step = []
+    for axis in range(y.ndim):
+      if y.shape[axis] == 1:
+        step.append(1)
+      else:
+        nxt = [0] * y.ndim
+        nxt[axis] = 1
+        step.append(int(y[tuple(nxt)] - y.flat[0]) // int(np.prod(shape[axis+1:])))
+    index = tuple(slice(int(a), None, s) for a, s in zip(start, step))
+    if all(s > 0 for s in step) and x[index].shape == y.shape \
+        and np.array_equal(x[index], y):
+      return [[int(a), s] for a, s in zip(start, step)]
+  raise NotImplementedError('ExpressionLayer %s is not a slice' % layer.name)
+
+# ----------------------------------------------------------------------------
+# export
+
+def _pair(v):
+  return list(v) if isinstance(v, (tuple, list)) else [v, v]
+
+def _conv_pad(layer):
+  filter_size = _pair(layer.filter_size)
+  if layer.pad == 'same':
+    return [s // 2 for s in filter_size]
+  elif layer.pad == 'valid':
+    return [0, 0]
+  elif layer.pad == 'full':
+    return [s - 1 for s in filter_size]
+  return _pair(layer.pad)
+
+def _value(param):
+  return np.asarray(param.get_value(), dtype=theano.config.floatX)
+
+def _store_weight(op, W, weights, key, precision):
+  """Add W to weights, quantized per output channel unless precision is float32"""
+  if precision in (None, 'float32'):
+    weights[key] = W
+  else:
+    weights[key], scale = quantize(W, precision, OUTPUT_AXIS[op['op']])
+    if scale is not None:
+      weights[key + '_scale'] = scale
+      op['W_scale'] = key + '_scale'
+  op['W'] = key
+
+def layer_op(layer, weights, prefix, precision=None):
+  """Plan entry (without inputs) for one layer; adds its arrays to weights"""
+  if isinstance(layer, DenseLayer):
+    assert getattr(layer, 'num_leading_axes', 1) == 1
+    op = dict(op='dense')
+    _store_weight(op, _value(layer.W), weights, prefix + '.W', precision)
+    if layer.b is not None:
+      weights[prefix + '.b'] = _value(layer.b)
+      op['b'] = prefix + '.b'
+    op['nonlinearity'] = identify_nonlinearity(layer.nonlinearity)
+
+  elif isinstance(layer, Conv2DLayer):
+    assert not layer.untie_biases and getattr(layer, 'num_groups', 1) == 1
+    assert tuple(_pair(getattr(layer, 'filter_dilation', 1))) == (1, 1)
+    W = _value(layer.W)
+    if layer.flip_filters:
+      W = W[:, :, ::-1, ::-1]
+    op = dict(op='conv', stride=_pair(layer.stride), pad=_conv_pad(layer))
+    _store_weight(op, np.ascontiguousarray(W), weights, prefix + '.W', precision)
+    if layer.b is not None:
+      weights[prefix + '.b'] = _value(layer.b)
+      op['b'] = prefix + '.b'
+    op['nonlinearity'] = identify_nonlinearity(layer.nonlinearity)
+
+  elif isinstance(layer, MaxPool2DLayer):
+    assert layer.ignore_border
+    op = dict(op='maxpool', pool_size=_pair(layer.pool_size),
+              stride=_pair(layer.stride), pad=_pair(layer.pad))
+
+  elif isinstance(layer, BatchNormLayer):
+    # deterministic batch norm is an affine map with fixed statistics
+    scale = _value(layer.inv_std)
+    if layer.gamma is not None:
+      scale = scale * _value(layer.gamma)
+    shift = -_value(layer.mean) * scale
+    if layer.beta is not None:
+      shift = shift + _value(layer.beta)
+    shape = [1 if axis in layer.axes else s
+             for axis, s in enumerate(layer.input_shape)]
+    weights[prefix + '.scale'] = scale.reshape(shape)
+    weights[prefix + '.shift'] = shift.reshape(shape)
+    op = dict(op='affine', scale=prefix + '.scale', shift=prefix + '.shift')
+
+  elif isinstance(layer, ElemwiseSumLayer):
+    op = dict(op='sum', coeffs=[float(c) for c in layer.coeffs])
+
+  elif isinstance(layer, NonlinearityLayer):
+    op = dict(op='nonlinearity',
+              nonlinearity=identify_nonlinearity(layer.nonlinearity))
+
+  elif isinstance(layer, GlobalPoolLayer):
+    name = getattr(layer.pool_function, '__name__', '')
+    if name not in ('mean', 'max', 'sum'):
+      raise NotImplementedError('Unsupported pool function %s' % name)
+    op = dict(op='globalpool', function=name)
+
+  elif isinstance(layer, ReshapeLayer):
+    op = dict(op='reshape', shape=list(layer.shape))
+
+  elif isinstance(layer, FlattenLayer):
+    op = dict(op='flatten', outdim=layer.outdim)
+
+  elif isinstance(layer, PadLayer):
+    width = layer.width
+    if not isinstance(width, (tuple, list)):
+      width = [width] * (len(layer.input_shape) - layer.batch_ndim)
+    op = dict(op='pad', width=[_pair(w) for w in width], val=float(layer.val),
+              batch_ndim=layer.batch_ndim)
+
+  elif isinstance(layer, ExpressionLayer):
+    op = dict(op='slice', index=identify_slice(layer))
+
+  elif isinstance(layer, (DropoutLayer, GaussianSampleLayer)):
+    # both pass their (first) input through at deterministic time
+    op = dict(op='identity')
+
+  elif isinstance(layer, BernoulliSampleLayer):
+    op = dict(op='bernoulli')
+
+  elif isinstance(layer, GumbelSoftmaxSampleLayer):
+    tau = layer.gumbel_softmax.temperature
+    if hasattr(tau, 'get_value'):
+      tau = tau.get_value()
+    op = dict(op='gumbel_softmax', tau=float(tau), eps=float(layer.gumbel_softmax.eps),
+              straight_through=bool(layer.straight_through))
+
+  else:
+    raise NotImplementedError('Cannot export %s' % type(layer).__name__)
+
+  return op
+
+def spec_layers(spec):
+  """Layers computed by an inference spec, in execution order
+
+  The walk stops at the spec's input layer, so for methods such as decode
+  the layers in front of it (the encoder) are left out.
+  """
+  outputs = spec['output'] if isinstance(spec['output'], list) else [spec['output']]
+  fed = spec.get('input')
+  # link sources go first, so they run before the layers they feed
+  return get_all_layers(list(spec.get('links', {}).values()) + outputs,
+                        treat_as_input=[fed] if fed is not None else None)
+
+def export_plan(model, name, precision=None):
+  """Layer plan and weights for the inference function name of model
+
+  The plan mirrors what compile_inference builds: a list of ops over
+  numbered buffers (0 is the input), in execution order. precision maps
+  dense/conv layers to 'int8', 'float16' or 'float32' (the default).
+  """
+  precision = precision or {}
+  spec = model.get_inference_layers()[name]
+  outputs = spec['output'] if isinstance(spec['output'], list) else [spec['output']]
+  links = spec.get('links', {})
+  fed = spec.get('input')
+  layers = spec_layers(spec)
+
+  weights = OrderedDict()
+  ops, ids = [], {}
+  input_shape = None
+  for layer in layers:
+    if layer is fed:
+      ids[layer] = 0
+      input_shape = [-1] + [s for s in layer.output_shape[1:]]
+      continue
+    if isinstance(layer, InputLayer):
+      if layer in links:
+        continue
+      if fed is not None or layer.input_var is not model.inputs[0]:
+        raise ValueError('Input layer %s is not fed by %s' % (layer.name, name))
+      ids[layer] = 0
+      input_shape = [-1] + [s for s in layer.shape[1:]]
+      continue
+
+    op = layer_op(layer, weights, 'op%03d' % len(ops), precision.get(layer))
+    incoming = getattr(layer, 'input_layers', None) or [layer.input_layer]
+    incoming = [links.get(l, l) for l in incoming]
+    op['inputs'] = [ids[l] for l in incoming]
+    op['id'] = len(ops) + 1
+    ids[layer] = op['id']
+    ops.append(op)
+
+  # identity ops only read their first input (e.g. the mean of a sample)
+  for op in ops:
+    if op['op'] == 'identity':
+      op['inputs'] = op['inputs'][:1]
+
+  # post-processing and flattening, as in compile_inference
+  out_ids = []
+  for layer in outputs:
+    out_id = ids[layer]
+    if spec.get('post'):
+      ops.append(dict(op='nonlinearity', nonlinearity=dict(name=spec['post']),
+                      inputs=[out_id], id=len(ops) + 1))
+      out_id = len(ops)
+    out_ids.append(out_id)
+
+  # drop ops whose results are never used
+  live = set(out_ids)
+  for op in reversed(ops):
+    if op['id'] in live:
+      live.update(op['inputs'])
+  ops = [op for op in ops if op['id'] in live]
+  used = set(v for op in ops for v in op.values() if isinstance(v, basestring))
+  weights = OrderedDict((key, value) for key, value in weights.items() if key in used)
+
+  plan = OrderedDict([
+    ('model', type(model).__name__),
+    ('method', name),
+    ('input_shape', input_shape),
+    ('outputs', out_ids),
+    ('single_output', not isinstance(spec['output'], list)),
+    ('dtype', theano.config.floatX),
+    ('ops', ops),
+  ])
+  return plan, weights
+
+def export(model, name, fname, optimize=True, precision=None):
+  """Write inference function name of model to an .npz file for util.engine
+
+  With optimize, batch norm is folded into the preceding convolutions,
+  nonlinearities are fused into the ops feeding them and pass-through ops
+  (dropout, ...) are removed. precision is as in export_plan.
+  """
+  plan, weights = export_plan(model, name, precision)
+  if optimize:
+    optimize_plan(plan, weights)
+  arrays = OrderedDict(weights)
+  arrays['plan'] = np.frombuffer(json.dumps(plan), dtype=np.uint8)
+  save_npz(fname, arrays)
+  return plan
+
+# ----------------------------------------------------------------------------
+# quantization
+
+def weight_layers(model, name):
+  """Dense and conv layers used by inference function name"""
+  layers = spec_layers(model.get_inference_layers()[name])
+  return [l for l in layers if isinstance(l, (DenseLayer, Conv2DLayer))]
+
+def fake_quantize(layer, mode):
+  """Round layer.W to precision mode in place; returns the original value"""
+  W = layer.W.get_value()
+  axis = OUTPUT_AXIS['dense' if isinstance(layer, DenseLayer) else 'conv']
+  q, scale = quantize(W, mode, axis)
+  layer.W.set_value(dequantize(q, scale, dtype=W.dtype))
+  return W
+
+class _FixedNoise(object):
+  """Resets the model's random streams before every loss evaluation, so
+  losses computed with different weights see the same noise"""
+  def __init__(self, model):
+    self.model = model
+    self.variables = [v for v in model._state_variables()
+                      if getattr(v, 'default_update', None) is not None]
+    self.values = [v.get_value() for v in self.variables]
+
+  def evaluate(self, X, Y, batchsize=1000):
+    for var, value in zip(self.variables, self.values):
+      var.set_value(value)
+    if self.model.inputs[0].ndim == 2:
+      X = X.reshape(len(X), -1)
+    return evaluate(self.model.loss, X, Y, batchsize=min(batchsize, len(X)))
+
+def calibrate(model, name, mode, X, Y, tol=0.01):
+  """Pick a precision for each dense/conv layer of inference function name
+
+  Layers are quantized one at a time, keeping earlier choices, to the most
+  compact precision that keeps the loss on (X, Y), a slice of training
+  data, within a relative tol of the float32 loss; layers that fail every
+  precision stay float32. The model's weights are left unchanged.
+  """
+  noise = _FixedNoise(model)
+  base_loss, _ = noise.evaluate(X, Y)
+
+  precision, originals = OrderedDict(), []
+  try:
+    for layer in weight_layers(model, name):
+      precision[layer] = 'float32'
+      for m in fallbacks(mode):
+        W = fake_quantize(layer, m)
+        loss, _ = noise.evaluate(X, Y)
+        if abs(loss - base_loss) <= tol * abs(base_loss):
+          precision[layer] = m
+          originals.append((layer, W))
+          break
+        layer.W.set_value(W)
+  finally:
+    for layer, W in originals:
+      layer.W.set_value(W)
+  return precision
+
+def quantization_report(model, precision, X, Y):
+  """Loss/accuracy on (X, Y) with float32 and with quantized weights"""
+  noise = _FixedNoise(model)
+  report = OrderedDict([('float32', noise.evaluate(X, Y))])
+
+  originals = []
+  try:
+    for layer, m in precision.items():
+      if m != 'float32':
+        originals.append((layer, fake_quantize(layer, m)))
+    report['quantized'] = noise.evaluate(X, Y)
+  finally:
+    for layer, W in originals:
+      layer.W.set_value(W)
+
+  counts = OrderedDict()
+  for m in precision.values():
+    counts[m] = counts.get(m, 0) + 1
+  report['layers'] = counts
+  return report
+
+# ----------------------------------------------------------------------------
+# latent export
+
+def export_latents(model, X, prefix, name='posterior', batchsize=1000,
+                   superbatch=12800):
+  """Stream X through inference function name into <prefix>.<output>.npy
+
+  Outputs are preallocated .npy memmaps that each superbatch is written
+  into directly, so memory use does not grow with len(X). The number of
+  rows done is recorded in <prefix>.progress after every superbatch, and
+  an interrupted export resumes from there.
+  """
+  spec = model.get_inference_layers()[name]
+  names = spec.get('names') or [name]
+  fnames = ['%s.%s.npy' % (prefix, output) for output in names]
+  progress = prefix + '.progress'
+
+  # resume if a previous export of the same data was interrupted
+  start, outs = 0, None
+  if os.path.exists(progress) and all(os.path.exists(f) for f in fnames):
+    with open(progress) as f:
+      state = json.load(f)
+    if state['n'] == len(X) and state['name'] == name:
+      start = state['rows']
+      outs = [np.load(f, mmap_mode='r+') for f in fnames]
+
+  if outs is None:
+    # output widths come from running the function on one example
+    Ys = model.apply_inference(name, X[:1])
+    Ys = Ys if isinstance(Ys, list) else [Ys]
+    outs = [np.lib.format.open_memmap(f, mode='w+', dtype=Y.dtype,
+                                      shape=(len(X),) + Y.shape[1:])
+            for f, Y in zip(fnames, Ys)]
+
+  for idx1, idx2 in iterate_chunk_idx(len(X), superbatch):
+    if idx2 <= start: continue
+    idx1 = max(idx1, start)
+    dest = [out[idx1:idx2] for out in outs]
+    model.apply_inference(name, X[idx1:idx2], batchsize,
+                          out=dest if isinstance(spec['output'], list) else dest[0])
+    for out in outs:
+      out.flush()
+
+    # record progress only once the rows are on disk
+    with open(progress + '.tmp', 'w') as f:
+      json.dump(dict(name=name, n=len(X), rows=idx2), f)
+    os.rename(progress + '.tmp', progress)
+
+  return fnames
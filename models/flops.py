@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+import numpy as np
+from lasagne.layers import (
+  InputLayer, DenseLayer, BatchNormLayer, ElemwiseSumLayer, GlobalPoolLayer,
+)
+from lasagne.layers.conv import BaseConvLayer
+from lasagne.layers.pool import Pool2DLayer
+
+from helpers import network_layers
+
+# a training step is a forward pass plus a backward pass that costs about
+# twice as much (gradients w.r.t. both the inputs and the weights)
+TRAIN_FACTOR = 3
+
+# ----------------------------------------------------------------------------
+# counting
+
+def _size(shape):
+  return int(np.prod(shape))
+
+def layer_cost(layer):
+  """(params, multiply-accumulates, activations) of a layer, per example
+
+  MACs count the dominant work of each layer type: the matrix products of
+  dense and convolutional layers, one comparison or add per window element
+  for pooling, one scale-and-shift per element for batch norm and one add
+  per input element for sums. Nonlinearities and other elementwise layers
+  count as free.
+  """
+  params = sum(p.get_value(borrow=True).size for p in layer.params)
+  out = _size(layer.output_shape[1:])
+
+  if isinstance(layer, DenseLayer):
+    macs = _size(layer.input_shape[1:]) * layer.num_units
+  elif isinstance(layer, BaseConvLayer):
+    n_in = layer.input_shape[1]
+    macs = out * n_in * _size(layer.filter_size)
+  elif isinstance(layer, Pool2DLayer):
+    macs = out * _size(layer.pool_size)
+  elif isinstance(layer, BatchNormLayer):
+    macs = out
+  elif isinstance(layer, ElemwiseSumLayer):
+    macs = out * (len(layer.input_shapes) - 1)
+  elif isinstance(layer, GlobalPoolLayer):
+    macs = _size(layer.input_shape[1:])
+  else:
+    macs = 0
+  return params, macs, out
+
+def count(model):
+  """Per-layer costs of a model's network as an OrderedDict name -> dict
+
+  Layers whose shape depends on the batch in more than the first dimension
+  are skipped. The RBM, which has no Lasagne network, gets a single entry
+  for one k-step contrastive divergence update.
+  """
+  costs = OrderedDict()
+  network = getattr(model, 'network', None)
+  if network is None:
+    if not hasattr(model, 'n_hidden'):
+      raise TypeError('Cannot count %s: it has no Lasagne network' % type(model).__name__)
+    # positive phase up, then k_steps of down-and-up Gibbs sampling
+    V, H = model.n_visible, model.n_hidden
+    costs['rbm'] = dict(type='RBM', shape=(V, H), params=V * H + V + H,
+                        macs=V * H * (1 + 2 * model.k_steps), activations=V + H)
+    return costs
+
+  for i, layer in enumerate(network_layers(network)):
+    if isinstance(layer, InputLayer): continue
+    if any(dim is None for dim in layer.output_shape[1:]): continue
+    params, macs, activations = layer_cost(layer)
+    name = layer.name or '%03d.%s' % (i, type(layer).__name__)
+    costs[name] = dict(type=type(layer).__name__, shape=layer.output_shape[1:],
+                       params=params, macs=macs, activations=activations)
+  return costs
+
+def totals(costs):
+  return dict((key, sum(c[key] for c in costs.values()))
+              for key in ('params', 'macs', 'activations'))
+
+def train_gflops(costs, examples_per_sec, train_factor=TRAIN_FACTOR):
+  """Achieved GFLOP/s of training at a measured throughput (1 MAC = 2 FLOPs)"""
+  return 2. * train_factor * totals(costs)['macs'] * examples_per_sec / 1e9
+
+def format_costs(costs):
+  lines = ['{:<32}{:>20}{:>12}{:>14}{:>12}'.format(
+    'layer', 'output', 'params', 'MACs', 'acts')]
+  for name, c in costs.items():
+    lines.append('{:<32}{:>20}{:>12,}{:>14,}{:>12,}'.format(
+      name[:32], str(tuple(c['shape'])), c['params'], c['macs'], c['activations']))
+  total = totals(costs)
+  lines.append('{:<32}{:>20}{:>12,}{:>14,}{:>12,}'.format(
+    'total (per example)', '', total['params'], total['macs'], total['activations']))
+  return lines
@@ -1,6 +1,7 @@
 import time
 import pickle
 import numpy as np
+from collections import OrderedDict
 
 import lasagne
 import theano
@@ -8,7 +9,7 @@ import theano.tensor as T
 
 from lasagne.layers import *
 from layers import GumbelSoftmaxSampleLayer
-from distributions import log_bernoulli
+from distributions import log_bernoulli_logit, log_categorical_logit
 from model import Model
 from helpers import *
 
@@ -23,7 +24,11 @@ class GSM(Model):
     validation loss/acc:	  98.537678	-19.804097
   """
   def __init__(self, n_dim, n_out, n_chan=1, n_superbatch=12800,
-              opt_alg='adam', opt_params={'lr': 1e-3, 'b1': 0.9, 'b2': 0.99}):
+              opt_alg='adam', opt_params={'lr': 1e-3, 'b1': 0.9, 'b2': 0.99},
+              straight_through=False):
+    # use hard samples with soft gradients (straight-through estimator)
+    self.straight_through = straight_through
+
     # invoke parent constructor
     # create shared data variables
     train_set_x = theano.shared(
@@ -32,9 +37,10 @@ class GSM(Model):
         dtype=theano.config.floatX
       ), borrow=False
     )
+    # validation buffers stay empty until load_data(dest='val') fills them
     val_set_x = theano.shared(
       np.empty(
-        (n_superbatch, n_chan*n_dim*n_dim),
+        (0, n_chan*n_dim*n_dim),
         dtype=theano.config.floatX
       ), borrow=False
     )
@@ -47,7 +53,7 @@ class GSM(Model):
     )
     val_set_y = theano.shared(
       np.empty(
-        (n_superbatch,),
+        (0,),
         dtype=theano.config.floatX
       ), borrow=False
     )
@@ -92,12 +98,15 @@ class GSM(Model):
         y : train_set_y_int[idx1:idx2]
       },
       on_unused_input='warn',
+      mode=self.mode,
     )
 
-    self.loss = theano.function([x, y], [loss, acc], on_unused_input='warn')
+    self.loss = theano.function([x, y], [loss, acc], on_unused_input='warn', mode=self.mode)
+    self.inference_fns = OrderedDict()
 
     # save config
     self.n_dim = n_dim
+    self.n_chan = n_chan
     self.n_out = n_out
     self.n_superbatch = n_superbatch
     self.alg = opt_alg
@@ -128,12 +137,12 @@ class GSM(Model):
     # sample from Gumble-Softmax posterior
     logits_y = DenseLayer(net, n_cat*n_class, nonlinearity=None)
     logits_y = reshape(logits_y, (-1, n_class))
-    y = GumbelSoftmaxSampleLayer(logits_y, tau)
+    y = GumbelSoftmaxSampleLayer(logits_y, tau, straight_through=self.straight_through)
     y = reshape(y, (-1, n_cat, n_class))
     # create the decoder network
     net = DenseLayer(flatten(y), 256, nonlinearity=T.nnet.relu)
     net = DenseLayer(net, 512, nonlinearity=T.nnet.relu)
-    logits_x = DenseLayer(net, n_out, nonlinearity=T.nnet.sigmoid)
+    logits_x = DenseLayer(net, n_out, nonlinearity=None)
 
     # save network params
     self.n_class = n_class
@@ -154,11 +163,11 @@ class GSM(Model):
 
     # define the loss
     q_y = T.nnet.softmax(_logits_y)
-    log_q_y = T.log(q_y + 1e-20)
-    log_p_x = log_bernoulli(x, _logits_x)
+    log_p_x = log_bernoulli_logit(x, _logits_x)
 
-    kl_tmp = T.reshape(q_y * (log_q_y - T.log(1.0 / n_class)), [-1 , n_cat, n_class])
-    KL = T.sum(kl_tmp, axis=[1, 2])
+    # KL(q(y|x) || uniform) = sum_y q(y|x) log q(y|x) + n_cat * log(n_class)
+    q_log_q = T.reshape(log_categorical_logit(q_y, _logits_y), [-1, n_cat])
+    KL = T.sum(q_log_q, axis=1) + np.float32(n_cat * np.log(n_class))
     elbo = T.sum(log_p_x, axis=1) - KL
     loss = T.mean(-elbo)
 
@@ -168,11 +177,40 @@ class GSM(Model):
     _, logits_x = self.network
     return get_all_params(logits_x)
 
+  def get_inference_layers(self):
+    logits_y, logits_x = self.network
+    l_sample = [l for l in get_all_layers(logits_x)
+                if isinstance(l, GumbelSoftmaxSampleLayer)][0]
+    return OrderedDict([
+      ('encode', dict(output=logits_y, post='softmax')),
+      ('posterior', dict(output=[logits_y], names=['q_y'], post='softmax')),
+      ('decode', dict(input=l_sample, output=logits_x, post='sigmoid')),
+    ])
+
+  def binarize_codes(self, codes):
+    # one-hot of the most likely class of each categorical variable
+    q_y = codes.reshape(len(codes), -1, self.n_class)
+    onehot = np.eye(self.n_class, dtype=bool)[q_y.argmax(axis=-1)]
+    return onehot.reshape(len(codes), -1)
+
+  def sample_prior(self, n, rng=np.random):
+    # uniform prior over each of the n_cat one-hot codes
+    idx = rng.randint(self.n_class, size=(n, self.n_cat))
+    Z = np.eye(self.n_class, dtype=theano.config.floatX)[idx]
+    return Z.reshape(n, -1)
+
+  def profile_steps(self, X_train, Y_train, X_val, Y_val, n_steps=100, n_batch=100):
+    n_flat_dim = np.prod(X_train.shape[1:])
+    Model.profile_steps(self, X_train.reshape(-1, n_flat_dim), Y_train,
+                        X_val.reshape(-1, n_flat_dim), Y_val, n_steps, n_batch)
+
   def fit(
     self, X_train, Y_train, X_val, Y_val,
     n_epoch=10, n_batch=100, logname='run',
+    checkpoint=None, checkpoint_every=0, log_format='tsv',
+    registry=None, config=None, timing=False, memory=False, resume=False,
   ):
-    """Train the model"""
+    """Train the model (see Model.fit for the options)"""
 
     alpha = 1.0  # learning rate, which can be adjusted later
     tau0 = 1.0  # initial temp
@@ -188,47 +226,59 @@ class GSM(Model):
     X_train = X_train.reshape(-1, n_flat_dim)
     X_val = X_val.reshape(-1, n_flat_dim)
 
-    for epoch in range(n_epoch):
-      # In each epoch, we do a full pass over the training data:
-      train_batches, train_err, train_acc = 0, 0, 0
-      start_time = time.time()
-
-      # iterate over superbatches to save time on GPU memory transfer
-      for X_sb, Y_sb in self.iterate_superbatches(
-        X_train, Y_train, n_superbatch,
-        datatype='train', shuffle=True,
-      ):
-        for idx1, idx2 in iterate_minibatch_idx(len(X_sb), n_batch):
-          err, acc = self.train(idx1, idx2, alpha)
-
-          # anneal temp and learning rate
-          if i % 1000 == 1:
-            alpha *= 0.9
-            np_temp = np.maximum(tau0*np.exp(-ANNEAL_RATE*i), MIN_TEMP)
-            self.tau.set_value(np_temp, borrow=False)
-
-          # collect metrics
-          i += 1
-          train_batches += 1
-          train_err += err
-          train_acc += acc
-          if train_batches % 100 == 0:
-            n_total = epoch * n_data + n_batch * train_batches
-            metrics = [n_total, train_err / train_batches, train_acc / train_batches]
-            log_metrics(logname, metrics)
-
-      print "Epoch {} of {} took {:.3f}s ({} minibatches)".format(
-        epoch + 1, n_epoch,
-        time.time() - start_time,
-        train_batches,
-      )
-
-      # make a full pass over the training data and record metrics:
-      train_err, train_acc = evaluate(self.loss, X_train, Y_train, batchsize=100)
-      val_err, val_acc = evaluate(self.loss, X_val, Y_val, batchsize=100)
-
-      print "  training loss/acc:\t\t{:.6f}\t{:.6f}".format(train_err, train_acc)
-      print "  validation loss/acc:\t\t{:.6f}\t{:.6f}".format(val_err, val_acc)
-
-      metrics = [ epoch, train_err, train_acc, val_err, val_acc ]
-      log_metrics(logname + '.val', metrics)
+    with self._fit_context(
+      logname, n_batch, checkpoint, checkpoint_every, log_format,
+      registry, config, timing, memory, resume,
+    ) as run:
+      alpha = float(run.cursor.get('alpha', alpha))
+      i = int(run.cursor.get('step', i))
+      timer = run.timer
+      for epoch in range(run.first_epoch, n_epoch):
+        # In each epoch, we do a full pass over the training data:
+        train_batches, train_err, train_acc = 0, 0, 0
+        run.start_epoch(epoch)
+
+        # iterate over superbatches to save time on GPU memory transfer
+        for X_sb, Y_sb in self.iterate_superbatches(
+          X_train, Y_train, n_superbatch,
+          datatype='train', shuffle=True, epoch=epoch,
+        ):
+          for idx1, idx2 in iterate_minibatch_idx(len(X_sb), n_batch):
+            with timer.phase('train'):
+              err, acc = self.train(idx1, idx2, alpha)
+
+            # anneal temp and learning rate
+            if i % 1000 == 1:
+              alpha *= 0.9
+              np_temp = np.maximum(tau0*np.exp(-ANNEAL_RATE*i), MIN_TEMP)
+              self.tau.set_value(np_temp, borrow=False)
+
+            # collect metrics
+            with timer.phase('metrics'):
+              i += 1
+              train_batches += 1
+              train_err += err
+              train_acc += acc
+            if train_batches % 100 == 0:
+              with timer.phase('log'):
+                n_total = epoch * n_data + n_batch * train_batches
+                run.log([n_total, train_err / train_batches, train_acc / train_batches])
+
+        print "Epoch {} of {} took {:.3f}s ({} minibatches)".format(
+          epoch + 1, n_epoch,
+          run.epoch_seconds(),
+          train_batches,
+        )
+
+        # make a full pass over the training data and record metrics:
+        with timer.phase('evaluate'):
+          train_err, train_acc = evaluate(self.loss, X_train, Y_train, batchsize=100,
+                                          prepare=self.eval_transform('train'))
+          val_err, val_acc = evaluate(self.loss, X_val, Y_val, batchsize=100,
+                                      prepare=self.eval_transform('val'))
+
+        print "  training loss/acc:\t\t{:.6f}\t{:.6f}".format(train_err, train_acc)
+        print "  validation loss/acc:\t\t{:.6f}\t{:.6f}".format(val_err, val_acc)
+
+        run.end_epoch(epoch, [epoch, train_err, train_acc, val_err, val_acc],
+                      n_batch * train_batches, alpha=alpha, step=i)
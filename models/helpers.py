@@ -1,4 +1,5 @@
 import numpy as np
+import lasagne
 
 # ----------------------------------------------------------------------------
 # iteration
@@ -7,6 +8,11 @@ def iterate_minibatch_idx(n_inputs, batchsize,):
   for start_idx in range(0, n_inputs - batchsize + 1, batchsize):
     yield start_idx, min(start_idx + batchsize, n_inputs)
 
+def iterate_chunk_idx(n_inputs, batchsize):
+  """Like iterate_minibatch_idx, but also yields the final partial chunk"""
+  for start_idx in range(0, n_inputs, batchsize):
+    yield start_idx, min(start_idx + batchsize, n_inputs)
+
 def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
   assert len(inputs) == len(targets)
   if shuffle:
@@ -29,16 +35,60 @@ def random_subbatch(inputs, targets, batchsize):
 # ----------------------------------------------------------------------------
 # eval
 
-def evaluate(eval_f, X, Y, batchsize=1000):
+def evaluate(eval_f, X, Y, batchsize=1000, prepare=None):
+  """Mean loss and accuracy over minibatches; prepare(inputs, i) transforms each"""
   tot_err, tot_acc, batches = 0, 0, 0
   for inputs, targets in iterate_minibatches(X, Y, batchsize, shuffle=False):
+    if prepare is not None:
+      inputs = prepare(inputs, batches)
     err, acc = eval_f(inputs, targets)
     tot_err += err
     tot_acc += acc
     batches += 1
   return tot_err / batches, tot_acc / batches
 
+def apply_in_batches(f, X, batchsize=1000, out=None):
+  """Apply f to X chunk by chunk, writing the results into one array
+
+  X can be anything that slices like an array (e.g. a np.memmap), so only a
+  chunk of inputs is in memory at a time; out is allocated on the first chunk
+  unless given (pass a np.memmap to bound the output memory as well). If f
+  returns a list of arrays, out is a list as well.
+  """
+  for idx1, idx2 in iterate_chunk_idx(len(X), batchsize):
+    Y = f(X[idx1:idx2])
+    Ys = Y if isinstance(Y, list) else [Y]
+    if out is None:
+      outs = [np.empty((len(X),) + y.shape[1:], dtype=y.dtype) for y in Ys]
+      out = outs if isinstance(Y, list) else outs[0]
+    for o, y in zip(out if isinstance(out, list) else [out], Ys):
+      o[idx1:idx2] = y
+  return out
+
 def log_metrics(logname, metrics):
   logfile = '%s.log' % logname
   with open(logfile, 'a') as f:
     f.write('\t'.join([str(m) for m in metrics]) + '\n')
+
+# ----------------------------------------------------------------------------
+# networks
+
+def network_layers(network):
+  """Lasagne layers behind a network (a layer or a tuple of them)
+
+  Some networks (SBN, DADGM) end with the shared variables of their
+  centering signals, which get_all_layers passes through; they are left out.
+  """
+  return [layer for layer in lasagne.layers.get_all_layers(network)
+          if isinstance(layer, lasagne.layers.Layer)]
+
+# ----------------------------------------------------------------------------
+# dtype audit
+
+def find_float64_nodes(f):
+  """Return the apply nodes of a compiled function that produce float64"""
+  nodes = []
+  for node in f.maker.fgraph.toposort():
+    if any(getattr(out, 'dtype', None) == 'float64' for out in node.outputs):
+      nodes.append(node)
+  return nodes
@@ -1,49 +1,109 @@
 import numpy as np
+import theano
+import theano.scalar as ts
 import theano.tensor as T
 import lasagne
+from theano.gradient import disconnected_grad as dg
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 # ----------------------------------------------------------------------------
 
+class GumbelPerturb(ts.ScalarOp):
+    """(logits + g) / tau for g = -log(-log(u + eps) + eps), Gumbel(0, 1) noise
+    from uniform u, as one scalar op with its own C code and gradient.
+
+    Wrapped in an Elemwise, this runs as a single loop without temporaries
+    whether or not the graph optimizer (and hence fusion) runs; DADGM and
+    ADGM_GSM compile without it.
+    """
+    nin = 3
+
+    def __init__(self, eps):
+        super(GumbelPerturb, self).__init__(output_types_preference=ts.upgrade_to_float)
+        self.eps = float(eps)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.eps == other.eps
+
+    def __hash__(self):
+        return hash((type(self), self.eps))
+
+    def impl(self, logits, u, tau):
+        return (logits - np.log(-np.log(u + self.eps) + self.eps)) / tau
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        logits, u, tau = inputs
+        z, = outputs
+        eps = repr(self.eps)
+        return '%(z)s = (%(logits)s - log(-log(%(u)s + %(eps)s) + %(eps)s)) / %(tau)s;' % locals()
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def grad(self, inputs, output_grads):
+        logits, u, tau = inputs
+        gz, = output_grads
+        eps = ts.constant(np.asarray(self.eps, dtype=u.dtype))
+        z = self(logits, u, tau)
+        # dz/du = 1 / (tau (u + eps) (eps - log(u + eps)))
+        g_u = gz / (tau * (u + eps) * (eps - ts.log(u + eps)))
+        return [gz / tau, g_u, -gz * z / tau]
+
+
 class GumbelSoftmax:
     def __init__(self, tau, eps=1e-20):
         assert tau != 0
         self.temperature=tau
         self.eps=eps
         self._srng = RandomStreams(lasagne.random.get_rng().randint(1, 2147462579))
+        self._perturb = T.Elemwise(GumbelPerturb(eps), name='gumbel_perturb')
 
     def __call__(self, logits):
-        #sample from Gumbel(0, 1)
-        uniform = self._srng.uniform(logits.shape,low=0,high=1)
-        gumbel = -T.log(-T.log(uniform + self.eps) + self.eps)
+        #sample from Gumbel(0, 1) and perturb the logits in one pass
+        uniform = self._srng.uniform(logits.shape,low=0,high=1,dtype=logits.dtype)
+        tau = T.cast(self.temperature, logits.dtype)
+        tau = T.shape_padleft(tau, logits.ndim - tau.ndim)
 
         #draw a sample from the Gumbel-Softmax distribution
-        return T.nnet.softmax((logits + gumbel) / self.temperature)
+        return T.nnet.softmax(self._perturb(logits, uniform, tau))
 
 
 def onehot_argmax(logits):
-    return T.extra_ops.to_one_hot(T.argmax(logits,-1),logits.shape[-1])
+    return T.extra_ops.to_one_hot(T.argmax(logits,-1),logits.shape[-1],
+                                  dtype=logits.dtype)
+
+
+def straight_through(y):
+    """One-hot of y in the forward pass, gradient of y in the backward pass"""
+    return dg(onehot_argmax(y) - y) + y
 
 
 class GumbelSoftmaxSampleLayer(lasagne.layers.Layer):
-    def __init__(self, incoming, tau, eps=1e-20, **kwargs):
+    def __init__(self, incoming, tau, eps=1e-20, straight_through=False, **kwargs):
         super(GumbelSoftmaxSampleLayer, self).__init__(incoming, **kwargs)
         self.gumbel_softmax = GumbelSoftmax(tau, eps=eps)
+        self.straight_through = straight_through
 
     def get_output_for(self, input, hard_max=False, **kwargs):
         if hard_max:
             return onehot_argmax(input)
+        elif self.straight_through:
+            return straight_through(self.gumbel_softmax(input))
         else:
             return self.gumbel_softmax(input)
 
 
 class GaussianSampleLayer(lasagne.layers.MergeLayer):
-    def __init__(self, mu, logsigma, rng=None, **kwargs):
+    def __init__(self, mu, logsigma, rng=None, n_samples=1, **kwargs):
         self.rng = rng if rng else RandomStreams(lasagne.random.get_rng().randint(1,2147462579))
+        self.n_samples = n_samples
         super(GaussianSampleLayer, self).__init__([mu, logsigma], **kwargs)
 
     def get_output_shape_for(self, input_shapes):
-        return input_shapes[0]
+        n_batch = input_shapes[0][0]
+        if n_batch is not None:
+            n_batch *= self.n_samples
+        return (n_batch,) + tuple(input_shapes[0][1:])
 
     def get_output_for(self, inputs, deterministic=False, **kwargs):
         mu, logsigma = inputs
@@ -51,7 +111,15 @@ class GaussianSampleLayer(lasagne.layers.MergeLayer):
                 self.input_shapes[0][1] or inputs[0].shape[1])
         if deterministic:
             return mu
-        return mu + T.exp(logsigma) * self.rng.normal(shape)
+        if self.n_samples == 1:
+            return mu + T.exp(logsigma) * self.rng.normal(shape)
+
+        # draw n_samples per datapoint; samples are stacked sample-major,
+        # i.e. the output is (n_samples*batch, n_lat) with row s*batch + i
+        # holding sample s of datapoint i
+        eps = self.rng.normal((self.n_samples,) + shape)
+        z = mu.dimshuffle('x', 0, 1) + T.exp(logsigma).dimshuffle('x', 0, 1) * eps
+        return z.reshape((-1, shape[1]))
 
 
 class BernoulliSampleLayer(lasagne.layers.Layer):
@@ -0,0 +1,73 @@
+import numpy as np
+import theano
+import theano.tensor as T
+import lasagne
+
+from models.layers.sampling import GumbelSoftmaxSampleLayer, GumbelSoftmax, GumbelPerturb
+
+floatX = theano.config.floatX
+
+# ----------------------------------------------------------------------------
+
+def sample_and_grad(straight_through, mode=None):
+    """A sample of the layer and the gradient of a linear loss w.r.t. the logits"""
+    logits = T.matrix('logits')
+    l_in = lasagne.layers.InputLayer((None, 5), input_var=logits)
+    l_sample = GumbelSoftmaxSampleLayer(l_in, tau=0.5, straight_through=straight_through)
+    sample = lasagne.layers.get_output(l_sample)
+    loss = T.sum(sample * np.arange(5, dtype=floatX))
+    f = theano.function([logits], [sample, T.grad(loss, logits)], mode=mode)
+    return f(np.random.RandomState(0).randn(4, 5).astype(floatX))
+
+def check_grad(grad):
+    assert np.all(np.isfinite(grad))
+    assert np.any(grad != 0)
+    # softmax outputs are invariant to shifting a row of logits
+    assert np.allclose(grad.sum(axis=1), 0, atol=1e-4)
+
+def test_grad_soft_sample():
+    sample, grad = sample_and_grad(straight_through=False)
+    assert np.allclose(sample.sum(axis=1), 1, atol=1e-5)
+    check_grad(grad)
+
+def test_grad_straight_through_sample():
+    sample, grad = sample_and_grad(straight_through=True)
+    assert set(np.unique(sample)) <= set([0, 1])
+    assert np.all(sample.sum(axis=1) == 1)
+    check_grad(grad)
+
+# ----------------------------------------------------------------------------
+# the fused perturbation op
+
+def perturb_nodes(f):
+    """Elemwise nodes of compiled f, as (fused GumbelPerturb nodes, other log nodes)"""
+    nodes = [n for n in f.maker.fgraph.toposort() if isinstance(n.op, T.Elemwise)]
+    fused = [n for n in nodes if isinstance(n.op.scalar_op, GumbelPerturb)]
+    logs = [n for n in nodes if isinstance(n.op.scalar_op, theano.scalar.Log)]
+    return fused, logs
+
+def test_perturbation_is_one_op():
+    logits = T.matrix('logits')
+    sample = GumbelSoftmax(tau=0.5)(logits)
+    # as ADGM_GSM compiles it: without the graph optimizer, which could fuse ops
+    f = theano.function([logits], sample, mode=theano.Mode(optimizer=None))
+    fused, logs = perturb_nodes(f)
+    assert len(fused) == 1 and not logs
+
+def test_perturbation_values():
+    rng = np.random.RandomState(0)
+    x, u = rng.randn(4, 5), rng.uniform(size=(4, 5))
+    tau, eps = 0.5, 1e-20
+    expected = (x - np.log(-np.log(u + eps) + eps)) / tau
+
+    xs, us, taus = T.dmatrix(), T.dmatrix(), T.dscalar()
+    z = T.Elemwise(GumbelPerturb(eps))(xs, us, T.shape_padleft(taus, 2))
+    for linker in ('py', 'c'):
+        f = theano.function([xs, us, taus], z, mode=theano.Mode(linker=linker, optimizer=None))
+        assert np.allclose(f(x, u, tau), expected)
+
+def test_perturbation_grad():
+    rng = np.random.RandomState(0)
+    op = T.Elemwise(GumbelPerturb(1e-20))
+    points = [rng.randn(3, 4), rng.uniform(0.1, 0.9, size=(3, 4)), np.asarray([[0.7]])]
+    theano.gradient.verify_grad(op, points, rng=rng, mode=theano.Mode(optimizer=None))
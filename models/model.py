@@ -1,27 +1,48 @@
+import os
 import pdb
 import time
 import pickle
+import itertools
 from collections import OrderedDict
 
 import numpy as np
 import theano
 import theano.tensor as T
 import lasagne
+from theano.compile import SharedVariable
 
 from helpers import *
+from util.metrics import MetricsLogger
+from util.timing import PhaseTimer, NULL_TIMER
+from util.memory import RSSSampler, report as memory_report
+from util.checkpoint import (save_npz, load_npz, pack_rng, unpack_rng,
+                             CheckpointWriter)
 
 # ----------------------------------------------------------------------------
 
+# nonlinearities applied to the outputs of inference functions
+POSTPROCESS = {
+  None: lambda v: v,
+  'sigmoid': T.nnet.sigmoid,
+  'softmax': T.nnet.softmax,
+}
+
 class Model(object):
   """Model superclass that includes training code"""
+  timer = NULL_TIMER # replaced by a PhaseTimer while fit(timing=True) runs
+  augmenter = None # a util.augment.Augmenter of the training set, if any
+  binarizer = None # a util.data.DynamicBinarizer, if the data is binarized on the fly
+  mode = None # Theano mode the model's functions are compiled with (None: the default)
+
   def __init__(self, n_dim, n_chan, n_out, n_superbatch, opt_alg, opt_params):
     # create shared data variables
     train_set_x = theano.shared(np.empty((n_superbatch, n_chan, n_dim, n_dim), dtype=theano.config.floatX), borrow=False)
-    val_set_x = theano.shared(np.empty((n_superbatch, n_chan, n_dim, n_dim), dtype=theano.config.floatX), borrow=False)
+    # validation buffers stay empty until load_data(dest='val') fills them
+    val_set_x = theano.shared(np.empty((0, n_chan, n_dim, n_dim), dtype=theano.config.floatX), borrow=False)
 
     # create y-variables
     train_set_y = theano.shared(np.empty((n_superbatch,), dtype=theano.config.floatX), borrow=False)
-    val_set_y = theano.shared(np.empty((n_superbatch,), dtype=theano.config.floatX), borrow=False)
+    val_set_y = theano.shared(np.empty((0,), dtype=theano.config.floatX), borrow=False)
     train_set_y_int, val_set_y_int = T.cast(train_set_y, 'int32'), T.cast(val_set_y, 'int32')
 
     # create input vars
@@ -53,14 +74,15 @@ class Model(object):
     # create methods for training / prediction
     self.train = theano.function([idx1, idx2, alpha], [loss, acc], updates=updates,
                                  givens={X : train_set_x[idx1:idx2], Y : train_set_y_int[idx1:idx2]},
-                                 on_unused_input='warn')
-    self.loss = theano.function([X, Y], [loss, acc], on_unused_input='warn')
+                                 on_unused_input='warn', mode=self.mode)
+    self.loss = theano.function([X, Y], [loss, acc], on_unused_input='warn', mode=self.mode)
 
-    # # TODO: implement a create_predictions method
-    # self.predict = theano.function([X], P)
+    # inference functions are compiled on first use (see compile_inference)
+    self.inference_fns = OrderedDict()
 
     # save config
     self.n_dim = n_dim
+    self.n_chan = n_chan
     self.n_out = n_out
     self.n_superbatch = n_superbatch
     self.alg = opt_alg
@@ -123,56 +145,278 @@ class Model(object):
     l_out = self.network
     return lasagne.layers.get_all_params(l_out, trainable=True)
 
-  def fit(self, X_train, Y_train, X_val, Y_val, n_epoch=10, n_batch=100, logname='run'):
-    """Train the model"""
+  def get_inference_layers(self):
+    """Layers behind each inference function, as a dict name -> spec
+
+    A spec is a dict with an 'output' layer (or list of layers) and optional
+    keys: 'input', a layer fed with the function's argument instead of the
+    data; 'links', a dict mapping input layers to the layers feeding them;
+    and 'post', a nonlinearity from POSTPROCESS applied to the outputs.
+    """
+    return OrderedDict([('predict', dict(output=self.network))])
+
+  def compile_inference(self, name):
+    """Compile (once) the deterministic forward pass for inference function name"""
+    if name in self.inference_fns:
+      return self.inference_fns[name]
+
+    specs = self.get_inference_layers()
+    if name not in specs:
+      raise NotImplementedError('%s does not support %s' % (type(self).__name__, name))
+    spec = specs[name]
+
+    if 'input' in spec:
+      x = T.matrix(dtype=theano.config.floatX)
+      inputs = {spec['input'] : x}
+    else:
+      x = self.inputs[0]
+      inputs = {}
+    for dst, src in spec.get('links', {}).items():
+      inputs[dst] = lasagne.layers.get_output(src, inputs, deterministic=True)
+
+    post = POSTPROCESS[spec.get('post')]
+    outputs = lasagne.layers.get_output(spec['output'], inputs, deterministic=True)
+    if isinstance(outputs, list):
+      outputs = [post(o).reshape((x.shape[0], -1)) for o in outputs]
+    else:
+      outputs = post(outputs).reshape((x.shape[0], -1))
+
+    self.inference_fns[name] = theano.function([x], outputs, on_unused_input='warn',
+                                               mode=self.mode)
+    return self.inference_fns[name]
+
+  def predict(self, X, batchsize=1000, out=None):
+    """Class probabilities for X"""
+    return self.apply_inference('predict', X, batchsize, out)
+
+  def encode(self, X, batchsize=1000, out=None):
+    """Posterior means (or probabilities) of the latent variables for X"""
+    return self.apply_inference('encode', X, batchsize, out)
+
+  def decode(self, Z, batchsize=1000, out=None):
+    """Means of p(x|z) for latent codes Z, flattened to one row per code"""
+    return self.apply_inference('decode', Z, batchsize, out)
+
+  def sample(self, n, chunk=1000, out=None, seed=0):
+    """Draw n samples from the model into out (e.g. a np.memmap)"""
+    for idx1, idx2, X in self.iterate_samples(n, chunk, seed):
+      if out is None:
+        out = np.empty((n,) + X.shape[1:], dtype=X.dtype)
+      out[idx1:idx2] = X
+    return out
+
+  def iterate_samples(self, n, chunk=1000, seed=0, start=0, stop=None):
+    """Yield (idx1, idx2, X) for rows [start, stop) of a stream of n samples
+
+    Chunk c of the stream is drawn with RandomState([seed, c]), so a slice
+    comes out the same no matter which process draws it; start must fall
+    on a chunk boundary.
+    """
+    assert start % chunk == 0, 'start must be a multiple of chunk'
+    stop = n if stop is None else min(stop, n)
+    for idx1 in range(start, stop, chunk):
+      idx2 = min(idx1 + chunk, stop)
+      rng = np.random.RandomState([seed, idx1 // chunk])
+      yield idx1, idx2, self.sample_chunk(idx2 - idx1, rng)
+
+  def sample_chunk(self, n, rng):
+    """Means of p(x|z) for n draws of z from the prior"""
+    return self.compile_inference('decode')(self.sample_prior(n, rng))
+
+  def binarize_codes(self, codes):
+    """Binary latent codes from encode() outputs (Bernoulli means)"""
+    return codes > 0.5
+
+  def sample_prior(self, n, rng=np.random):
+    """Draw n latent codes from the prior p(z)"""
+    raise NotImplementedError('%s has no prior to sample from' % type(self).__name__)
+
+  def apply_inference(self, name, X, batchsize=1000, out=None):
+    """Run inference function name over X in chunks of batchsize"""
+    f = self.compile_inference(name)
+
+    # accept both flat and image-shaped inputs
+    ndim = f.maker.inputs[0].variable.ndim
+    if X.ndim != ndim:
+      if ndim == 2:
+        X = X.reshape(len(X), -1)
+      else:
+        X = X.reshape(len(X), self.n_chan, self.n_dim, self.n_dim)
+
+    floatX = theano.config.floatX
+    return apply_in_batches(lambda x: f(np.asarray(x, dtype=floatX)), X, batchsize, out)
+
+  def fit(self, X_train, Y_train, X_val, Y_val, n_epoch=10, n_batch=100, logname='run',
+          checkpoint=None, checkpoint_every=0, log_format='tsv', registry=None, config=None,
+          timing=False, memory=False, resume=False):
+    """Train the model
+
+    With checkpoint_every > 0, a checkpoint is written to checkpoint every
+    that many epochs; with resume, training continues from that file.
+    Metrics go to <logname>.log and <logname>.val.log, or to .bin files in
+    the binary format of util/metrics.py if log_format is 'binary'. Given a
+    util.registry.Registry, the run's config and per-epoch metrics are
+    recorded there too. With timing, each epoch prints a breakdown of where
+    the time went and logs it to <logname>.timing.log (see util/timing.py).
+    With memory, the model's memory footprint is printed at the start and
+    the process RSS after every epoch, logged to <logname>.memory.log.
+    Both logs go to .bin files instead with the binary log_format.
+    """
 
     alpha = 1.0 # learning rate, which can be adjusted later
     n_data = len(X_train)
     n_superbatch = self.n_superbatch
 
-    for epoch in range(n_epoch):
-      # In each epoch, we do a full pass over the training data:
-      train_batches, train_err, train_acc = 0, 0, 0
-      start_time = time.time()
-
-      # iterate over superbatches to save time on GPU memory transfer
-      for X_sb, Y_sb in self.iterate_superbatches(X_train, Y_train, n_superbatch, datatype='train', shuffle=True):
-        for idx1, idx2 in iterate_minibatch_idx(len(X_sb), n_batch):
-          err, acc = self.train(idx1, idx2, alpha)
-
-          # collect metrics
-          train_batches += 1
-          train_err += err
-          train_acc += acc
-          if train_batches % 100 == 0:
-            n_total = epoch * n_data + n_batch * train_batches
-            metrics = [n_total, train_err / train_batches, train_acc / train_batches]
-            log_metrics(logname, metrics)
-
-      print "Epoch {} of {} took {:.3f}s ({} minibatches)".format(
-          epoch + 1, n_epoch, time.time() - start_time, train_batches)
-
-      # make a full pass over the training data and record metrics:
-      train_err, train_acc = evaluate(self.loss, X_train, Y_train, batchsize=1000)
-      val_err, val_acc = evaluate(self.loss, X_val, Y_val, batchsize=1000)
-
-      print "  training loss/acc:\t\t{:.6f}\t{:.6f}".format(train_err, train_acc)
-      print "  validation loss/acc:\t\t{:.6f}\t{:.6f}".format(val_err, val_acc)
-
-      metrics = [ epoch, train_err, train_acc, val_err, val_acc ]
-      log_metrics(logname + '.val', metrics)
-
-  def dump(self, fname):
-    """Pickle weights to a file"""
-    params = lasagne.layers.get_all_param_values(self.network)
-    with open(fname, 'w') as f:
-      pickle.dump(params, f)
-
-  def load(self, params):
-    """Load pickled network"""
-    with open(fname) as f:
-      params = pickle.load(f)
-    self.load_params(params)
+    with self._fit_context(logname, n_batch, checkpoint, checkpoint_every, log_format,
+                           registry, config, timing, memory, resume) as run:
+      alpha = float(run.cursor.get('alpha', alpha))
+      timer = run.timer
+      for epoch in range(run.first_epoch, n_epoch):
+        # In each epoch, we do a full pass over the training data:
+        train_batches, train_err, train_acc = 0, 0, 0
+        run.start_epoch(epoch)
+
+        # iterate over superbatches to save time on GPU memory transfer
+        for X_sb, Y_sb in self.iterate_superbatches(X_train, Y_train, n_superbatch, datatype='train', shuffle=True, epoch=epoch):
+          for idx1, idx2 in iterate_minibatch_idx(len(X_sb), n_batch):
+            with timer.phase('train'):
+              err, acc = self.train(idx1, idx2, alpha)
+
+            # collect metrics
+            with timer.phase('metrics'):
+              train_batches += 1
+              train_err += err
+              train_acc += acc
+            if train_batches % 100 == 0:
+              with timer.phase('log'):
+                n_total = epoch * n_data + n_batch * train_batches
+                run.log([n_total, train_err / train_batches, train_acc / train_batches])
+
+        print "Epoch {} of {} took {:.3f}s ({} minibatches)".format(
+            epoch + 1, n_epoch, run.epoch_seconds(), train_batches)
+
+        # make a full pass over the training data and record metrics:
+        with timer.phase('evaluate'):
+          train_err, train_acc = evaluate(self.loss, X_train, Y_train, batchsize=1000,
+                                          prepare=self.eval_transform('train'))
+          val_err, val_acc = evaluate(self.loss, X_val, Y_val, batchsize=1000,
+                                      prepare=self.eval_transform('val'))
+
+        print "  training loss/acc:\t\t{:.6f}\t{:.6f}".format(train_err, train_acc)
+        print "  validation loss/acc:\t\t{:.6f}\t{:.6f}".format(val_err, val_acc)
+
+        run.end_epoch(epoch, [epoch, train_err, train_acc, val_err, val_acc],
+                      n_batch * train_batches, alpha=alpha)
+
+  def _fit_context(self, logname, n_batch, checkpoint=None, checkpoint_every=0,
+                   log_format='tsv', registry=None, config=None, timing=False,
+                   memory=False, resume=False):
+    """What every fit sets up around its epochs, as a _FitRun for a with block
+
+    The arguments are those of fit; subclasses with their own training loop
+    call this too, so the logs, checkpoints and reports stay the same.
+    """
+    return _FitRun(self, logname, n_batch, checkpoint, checkpoint_every, log_format,
+                   registry, config, timing, memory, resume)
+
+  def profile_steps(self, X_train, Y_train, X_val, Y_val, n_steps=100, n_batch=100):
+    """Run n_steps training minibatches and as many validation minibatches
+
+    Used to time the compiled functions when they were built with
+    theano.config.profile on; parameters are updated as in training.
+    """
+    steps = 0
+    for X_sb, Y_sb in self.iterate_superbatches(X_train, Y_train, self.n_superbatch,
+                                                datatype='train', shuffle=True):
+      for idx1, idx2 in iterate_minibatch_idx(len(X_sb), n_batch):
+        if steps == n_steps: break
+        self.train(idx1, idx2, 1.0)
+        steps += 1
+      if steps == n_steps: break
+
+    n_val = min(len(X_val), n_steps * n_batch)
+    evaluate(self.loss, X_val[:n_val], Y_val[:n_val], batchsize=n_batch,
+             prepare=self.eval_transform('val'))
+
+  def dump(self, fname, **cursor):
+    """Save params, optimizer and RNG state to an .npz checkpoint"""
+    save_npz(fname, self.get_state(**cursor))
+
+  def load(self, fname):
+    """Restore a checkpoint written by dump; returns its data cursor"""
+    state = load_npz(fname)
+    self.set_state(state)
+    return dict((name[len('cursor.'):], state[name].item())
+                for name in state if name.startswith('cursor.'))
+
+  def resume(self, checkpoint):
+    """Restore the checkpoint that fit(resume=True) continues from"""
+    if not checkpoint or not os.path.exists(checkpoint):
+      raise ValueError('No checkpoint to resume from: %s' % checkpoint)
+    cursor = self.load(checkpoint)
+    print 'Resuming from {} at epoch {}'.format(checkpoint, int(cursor['epoch']) + 1)
+    return cursor
+
+  def get_state(self, **cursor):
+    """Copy of all training state as a flat dict of numpy arrays
+
+    This covers every shared variable read or updated by the compiled
+    functions except the data buffers (parameters, optimizer moments,
+    centering signals, RNG streams, ...), the numpy global RNG, and any
+    cursor values passed as keyword arguments (e.g. epoch).
+    """
+    state = OrderedDict()
+    for key, var in self._state_keys():
+      value = var.get_value(borrow=False)
+      if isinstance(value, np.random.RandomState):
+        state.update(pack_rng(value.get_state(), key))
+      else:
+        state[key] = value
+    state.update(pack_rng(np.random.get_state(), 'np_random'))
+    for name, value in cursor.items():
+      state['cursor.' + name] = np.asarray(value)
+    return state
+
+  def set_state(self, state):
+    """Restore state produced by get_state"""
+    for key, var in self._state_keys():
+      value = var.get_value(borrow=True)
+      if isinstance(value, np.random.RandomState):
+        if key + '.pos' not in state:
+          raise ValueError('Checkpoint does not match the model at %s' % key)
+        value.set_state(unpack_rng(state, key))
+        var.set_value(value, borrow=True)
+      elif key not in state or state[key].shape != value.shape:
+        raise ValueError('Checkpoint does not match the model at %s' % key)
+      else:
+        var.set_value(np.array(state[key], dtype=value.dtype), borrow=True)
+    np.random.set_state(unpack_rng(state, 'np_random'))
+
+  def _state_variables(self):
+    """Shared variables used by the compiled functions, minus data buffers"""
+    data = [getattr(self, name, None) for name in
+            ('train_set_x', 'train_set_y', 'val_set_x', 'val_set_y')]
+    variables = []
+    for f in (self.train, self.loss):
+      for inp in f.maker.inputs:
+        var = inp.variable
+        if not isinstance(var, SharedVariable): continue
+        if any(var is v for v in data + variables): continue
+        variables.append(var)
+    return variables
+
+  def _state_keys(self):
+    """(checkpoint key, variable) for every state variable
+
+    A key is the variable's name plus its index among the variables of the
+    same name, so state is not matched up by position in the whole graph.
+    """
+    counts, keys = {}, []
+    for var in self._state_variables():
+      name = var.name or 'unnamed'
+      keys.append(('var.%s.%d' % (name, counts.get(name, 0)), var))
+      counts[name] = counts.get(name, 0) + 1
+    return keys
 
   def load_params(self, params):
     """Load a given set of parameters"""
@@ -182,6 +426,37 @@ class Model(object):
     """Dump a given set of parameters"""
     return lasagne.layers.get_all_param_values(self.network)
 
+  def compiled_functions(self):
+    """Return the compiled Theano functions owned by the model"""
+    fns = OrderedDict()
+    for name in sorted(vars(self)):
+      value = getattr(self, name)
+      if isinstance(value, theano.compile.function_module.Function):
+        fns[name] = value
+    fns.update(getattr(self, 'inference_fns', {}))
+    return fns
+
+  def audit_dtypes(self, strict=False):
+    """Report float64 nodes in compiled functions when floatX is float32"""
+    report = OrderedDict()
+    if theano.config.floatX != 'float32':
+      return report
+
+    for name, f in self.compiled_functions().items():
+      nodes = find_float64_nodes(f)
+      if nodes:
+        report[name] = nodes
+
+    for name, nodes in report.items():
+      print 'WARNING: {} float64 node(s) in {}:'.format(len(nodes), name)
+      for node in nodes[:10]:
+        print '  ', node
+
+    if strict and report:
+      raise TypeError('float64 nodes found in: %s' % ', '.join(report.keys()))
+
+    return report
+
   def load_data(self, X, Y, dest='train'):
     assert dest in ('train', 'val')
     if dest == 'train':
@@ -193,20 +468,128 @@ class Model(object):
         if Y is not None:
           self.val_set_y.set_value(Y, borrow=False)
 
-  def iterate_superbatches(self, X, Y, batchsize, datatype='train', shuffle=False):
+  def eval_transform(self, datatype):
+    """What evaluate should apply to minibatches of a dataset, if anything
+
+    Evaluation uses the same binarization every epoch, so that the metrics
+    of different epochs are comparable.
+    """
+    if self.binarizer is None:
+      return None
+    return self.binarizer.stream('eval-' + datatype, 0)
+
+  def iterate_superbatches(self, X, Y, batchsize, datatype='train', shuffle=False, epoch=0):
     assert datatype in ('train', 'val')
     assert len(X) == len(Y)
     assert batchsize <= len(X)
 
+    # augmented and binarized data change every epoch, so they are always reloaded
+    augment = datatype == 'train' and self.augmenter is not None and self.augmenter.X is X
+
     # if we are loading entire dataset, only load it once
-    if batchsize == len(X):
+    if batchsize == len(X) and not augment and self.binarizer is None:
       if not self.data_loaded:
-        self.load_data(X, Y, dest=datatype)
+        with self.timer.phase('load_data'):
+          self.load_data(X, Y, dest=datatype)
         self.data_loaded = True
       yield X, Y
     else:
       # otherwise iterate over superbatches
-      for superbatch in iterate_minibatches(X, Y, batchsize, shuffle=shuffle):
+      if augment:
+        assert self.augmenter.batchsize == batchsize
+        superbatches = self.augmenter.epoch(shuffle=shuffle)
+      else:
+        superbatches = iterate_minibatches(X, Y, batchsize, shuffle=shuffle)
+      for index in itertools.count():
+        with self.timer.phase('shuffle'):
+          superbatch = next(superbatches, None)
+        if superbatch is None:
+          return
         inputs, targets = superbatch
-        self.load_data(inputs, targets, dest=datatype)
+        with self.timer.phase('load_data'):
+          if self.binarizer is not None:
+            inputs = self.binarizer(inputs, datatype, epoch, index)
+          self.load_data(inputs, targets, dest=datatype)
         yield inputs, targets
+
+# ----------------------------------------------------------------------------
+# the bookkeeping around fit
+
+class _FitRun(object):
+  """Checkpoints, metrics logs, registry run, timer and RSS sampler of a fit
+
+  Leaving the with block closes them all and marks the registry run done,
+  or failed if the block raised. cursor holds the values restored with
+  resume (empty otherwise) and first_epoch the epoch to continue from.
+  """
+  def __init__(self, model, logname, n_batch, checkpoint, checkpoint_every, log_format,
+               registry, config, timing, memory, resume):
+    self.model = model
+    self.logname = logname
+    self.checkpoint, self.checkpoint_every = checkpoint, checkpoint_every
+    self.registry = registry
+
+    # resume from a previous checkpoint
+    self.cursor = model.resume(checkpoint) if resume else {}
+    self.first_epoch = int(self.cursor.get('epoch', 0))
+
+    self.writer = CheckpointWriter() if checkpoint and checkpoint_every else None
+    self.logger = MetricsLogger(log_format)
+    self.run_id = registry.start_run(logname, config or {}) if registry else None
+    self.timer = model.timer = PhaseTimer() if timing else NULL_TIMER
+    self.sampler = RSSSampler() if memory else None
+    if memory:
+      for line in memory_report(model, n_batch): print line
+    self.epoch_start = time.time()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if self.writer: self.writer.close()
+    if self.sampler: self.sampler.close()
+    self.logger.close()
+    if self.registry:
+      self.registry.finish_run(self.run_id, 'failed' if exc_type else 'done')
+    self.model.timer = NULL_TIMER
+
+  def start_epoch(self, epoch):
+    # the first epoch also times what ran before it (e.g. loading the data)
+    if self.timer is not NULL_TIMER and epoch > self.first_epoch:
+      self.timer.reset()
+    self.epoch_start = time.time()
+
+  def epoch_seconds(self):
+    return time.time() - self.epoch_start
+
+  def log(self, metrics):
+    """Log [examples seen, training loss, training accuracy] during an epoch"""
+    self.logger.log(self.logname, metrics)
+
+  def end_epoch(self, epoch, metrics, n_examples, log_val=True, **cursor):
+    """Record an epoch's [epoch, train loss, train acc, val loss, val acc]
+
+    The metrics go to <logname>.val (unless log_val is false) and to the
+    registry. A checkpoint is written when one is due, with the keyword
+    arguments as its cursor, and timing and memory are reported.
+    """
+    if log_val:
+      self.logger.log(self.logname + '.val', metrics)
+    if self.registry:
+      self.registry.log_epoch(self.run_id, epoch, metrics, self.epoch_seconds())
+
+    # snapshot the state now; the write happens in the background
+    if self.writer and (epoch + 1) % self.checkpoint_every == 0:
+      with self.timer.phase('checkpoint'):
+        self.writer.save(self.checkpoint, self.model.get_state(epoch=epoch + 1, **cursor))
+
+    if self.timer is not NULL_TIMER:
+      for line in self.timer.report(n_examples):
+        print line
+      self.logger.log(self.logname + '.timing', self.timer.row(epoch, n_examples))
+
+    if self.sampler:
+      sampler = self.sampler
+      print '  RSS {:.1f}MB (peak this epoch {:.1f}MB)'.format(sampler.current, sampler.peak)
+      self.logger.log(self.logname + '.memory', [epoch, sampler.current, sampler.peak])
+      sampler.reset_peak()
@@ -68,6 +68,8 @@ class RBM(Model):
 
     self.n_batch = n_batch
     self.loss = theano.function([x], cost,  on_unused_input='warn')
+    self.inference_fns = OrderedDict()
+    self.gibbs_chain = None
     self.train_set_x = train_set_x
     self.train_set_y = train_set_y
 
@@ -148,8 +150,12 @@ class RBM(Model):
     pre_sigmoid_activation = T.dot(vis, self.W) + self.hbias
     return [pre_sigmoid_activation, T.nnet.sigmoid(pre_sigmoid_activation)]
 
-  def sample_h_given_v(self, v0_sample):
-    ''' This function infers state of hidden units given visible units '''
+  def sample_h_given_v(self, v0_sample, rng=None):
+    ''' This function infers state of hidden units given visible units
+
+    Samples are drawn from rng, by default the training streams.
+    '''
+    rng = rng or self.theano_rng
     # compute the activation of the hidden units given a sample of
     # the visibles
     pre_sigmoid_h1, h1_mean = self.propup(v0_sample)
@@ -157,9 +163,9 @@ class RBM(Model):
     # Note that theano_rng.binomial returns a symbolic sample of dtype
     # int64 by default. If we want to keep our computations in floatX
     # for the GPU we need to specify to return the dtype floatX
-    h1_sample = self.theano_rng.binomial(size=h1_mean.shape,
-                                         n=1, p=h1_mean,
-                                         dtype=theano.config.floatX)
+    h1_sample = rng.binomial(size=h1_mean.shape,
+                             n=1, p=h1_mean,
+                             dtype=theano.config.floatX)
     return [pre_sigmoid_h1, h1_mean, h1_sample]
 
   def propdown(self, hid):
@@ -176,24 +182,28 @@ class RBM(Model):
     pre_sigmoid_activation = T.dot(hid, self.W.T) + self.vbias
     return [pre_sigmoid_activation, T.nnet.sigmoid(pre_sigmoid_activation)]
 
-  def sample_v_given_h(self, h0_sample):
-    ''' This function infers state of visible units given hidden units '''
+  def sample_v_given_h(self, h0_sample, rng=None):
+    ''' This function infers state of visible units given hidden units
+
+    Samples are drawn from rng, by default the training streams.
+    '''
+    rng = rng or self.theano_rng
     # compute the activation of the visible given the hidden sample
     pre_sigmoid_v1, v1_mean = self.propdown(h0_sample)
     # get a sample of the visible given their activation
     # Note that theano_rng.binomial returns a symbolic sample of dtype
     # int64 by default. If we want to keep our computations in floatX
     # for the GPU we need to specify to return the dtype floatX
-    v1_sample = self.theano_rng.binomial(size=v1_mean.shape,
-                                         n=1, p=v1_mean,
-                                         dtype=theano.config.floatX)
+    v1_sample = rng.binomial(size=v1_mean.shape,
+                             n=1, p=v1_mean,
+                             dtype=theano.config.floatX)
     return [pre_sigmoid_v1, v1_mean, v1_sample]
 
-  def gibbs_hvh(self, h0_sample):
+  def gibbs_hvh(self, h0_sample, rng=None):
     ''' This function implements one step of Gibbs sampling,
         starting from the hidden state'''
-    pre_sigmoid_v1, v1_mean, v1_sample = self.sample_v_given_h(h0_sample)
-    pre_sigmoid_h1, h1_mean, h1_sample = self.sample_h_given_v(v1_sample)
+    pre_sigmoid_v1, v1_mean, v1_sample = self.sample_v_given_h(h0_sample, rng)
+    pre_sigmoid_h1, h1_mean, h1_sample = self.sample_h_given_v(v1_sample, rng)
     return [pre_sigmoid_v1, v1_mean, v1_sample,
             pre_sigmoid_h1, h1_mean, h1_sample]
 
@@ -208,6 +218,41 @@ class RBM(Model):
   def get_params(self):
     return self.params
 
+  def sample_chunk(self, n, rng, n_chains=100, n_burnin=1000):
+    ''' Visible means along persistent Gibbs chains started from rng '''
+    if self.gibbs_chain is None:
+      # the chains draw from streams of their own, so sampling leaves the
+      # training chain (and thus training and resuming) untouched
+      self.sample_rng = RandomStreams(0)
+      # k_steps of block Gibbs sampling starting from a hidden state
+      h = T.matrix('h')
+      (_, nv_means, _, _, _, nh_samples), updates = theano.scan(
+        lambda h0: self.gibbs_hvh(h0, self.sample_rng),
+        outputs_info=[None, None, None, None, None, h],
+        n_steps=self.k_steps,
+        name='gibbs_sample'
+      )
+      self.gibbs_chain = theano.function([h], [nv_means[-1], nh_samples[-1]],
+                                         updates=updates, name='gibbs_chain')
+
+    # the chains (and the theano streams they draw from) depend only on rng
+    self.sample_rng.seed(rng.randint(2 ** 30))
+    h = rng.binomial(1, 0.5, size=(min(n, n_chains), self.n_hidden))
+    h = h.astype(theano.config.floatX)
+    for step in range(n_burnin // self.k_steps):
+      _, h = self.gibbs_chain(h)
+
+    # successive states of the chains, k_steps apart
+    X = np.empty((n, self.n_visible), dtype=theano.config.floatX)
+    for idx1, idx2 in iterate_chunk_idx(n, len(h)):
+      v, h = self.gibbs_chain(h)
+      X[idx1:idx2] = v[:idx2 - idx1]
+    return X
+
+  def get_inference_layers(self):
+    # the RBM is not built from lasagne layers; see propup / propdown
+    return OrderedDict()
+
   def get_cost_updates(self, X, lr=0.1, persistent=None):
     '''
     Returns the updates dictionary. The dictionary contains the update rules
@@ -353,8 +398,14 @@ class RBM(Model):
 
     return cross_entropy
 
-  def fit(self, X_train, Y_train, X_val, Y_val, n_epoch=10, n_batch=100, logname='run'):
-    ''' Train the model'''
+  def fit(self, X_train, Y_train, X_val, Y_val, n_epoch=10, n_batch=100, logname='run',
+          checkpoint=None, checkpoint_every=0, log_format='tsv', registry=None, config=None,
+          timing=False, memory=False, resume=False):
+    ''' Train the model (see Model.fit for the options)
+
+    The RBM only writes the timing and memory logs; the registry gets the
+    training cost.
+    '''
     X_train = X_train.reshape(-1, np.prod(X_train.shape[1:]))
     X_val = X_val.reshape(-1, np.prod(X_val.shape[1:]))
 
@@ -362,27 +413,57 @@ class RBM(Model):
 
     # compute number of minibatches for training, validation and testing
     n_train_batches = X_train.shape[0] // n_batch
-    self.load_data(X_train, Y_train, dest='train')
-
-    # go through training epochs
-    for epoch in range(n_epoch):
-      # go through the training set
-      mean_cost = []
-      for batch_index in range(n_train_batches):
-          mean_cost += [self.train(batch_index)]
 
-      print "Epoch {} of {} took {:.3f}s ({} minibatches)".format(
-        epoch + 1, n_epoch, time.time() - start_time, n_train_batches)
-      print "  training loss/acc:\t\t{:.6f}\t{}".format(np.mean(mean_cost), None)
+    with self._fit_context(logname, self.n_batch, checkpoint, checkpoint_every, log_format,
+                           registry, config, timing, memory, resume) as run:
+      timer = run.timer
+      if self.binarizer is None:
+        with timer.phase('load_data'):
+          self.load_data(X_train, Y_train, dest='train')
+
+      # go through training epochs
+      for epoch in range(run.first_epoch, n_epoch):
+        # go through the training set
+        run.start_epoch(epoch)
+        mean_cost = []
+        if self.binarizer is not None:
+          # the RBM trains on the whole set at once, so it is redrawn as a whole
+          with timer.phase('load_data'):
+            self.load_data(self.binarizer(X_train, 'train', epoch, 0), Y_train, dest='train')
+        for batch_index in range(n_train_batches):
+          with timer.phase('train'):
+            mean_cost += [self.train(batch_index)]
+
+        print "Epoch {} of {} took {:.3f}s ({} minibatches)".format(
+          epoch + 1, n_epoch, time.time() - start_time, n_train_batches)
+        print "  training loss/acc:\t\t{:.6f}\t{}".format(np.mean(mean_cost), None)
+
+        run.end_epoch(epoch, [epoch, np.mean(mean_cost), None, None, None],
+                      n_batch * n_train_batches, log_val=False)
 
     end_time = timeit.default_timer()
     pretraining_time = (end_time - start_time)
     print ('Training took %f minutes' % (pretraining_time / 60.))
 
+  def profile_steps(self, X_train, Y_train, X_val, Y_val, n_steps=100, n_batch=100):
+    ''' Run n_steps CD updates and as many loss evaluations (see Model) '''
+    X_train = X_train.reshape(-1, np.prod(X_train.shape[1:]))
+    X_val = X_val.reshape(-1, np.prod(X_val.shape[1:]))
+    n_steps = min(n_steps, len(X_train) // self.n_batch)
+    if self.binarizer is not None:
+      X_train = self.binarizer(X_train[:n_steps * self.n_batch], 'train', 0, 0)
+      X_val = self.binarizer(X_val[:n_steps * n_batch], 'eval-val', 0, 0)
+    self.load_data(X_train[:n_steps * self.n_batch], Y_train[:n_steps * self.n_batch], dest='train')
+    for batch_index in range(n_steps):
+      self.train(batch_index)
+    for idx1, idx2 in iterate_minibatch_idx(min(len(X_val), n_steps * n_batch), n_batch):
+      self.loss(X_val[idx1:idx2])
+
   def load_params(self, params):
     ''' Load a given set of parameters '''
-    self.params = params
+    for param, value in zip(self.params, params):
+      param.set_value(value)
 
   def dump_params(self):
     ''' Dump a given set of parameters '''
-    return self.params
+    return [param.get_value() for param in self.params]
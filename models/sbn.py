@@ -11,7 +11,7 @@ import lasagne
 from model import Model
 
 from layers import BernoulliSampleLayer
-from distributions import log_bernoulli
+from distributions import log_bernoulli, log_bernoulli_logit
 
 # ----------------------------------------------------------------------------
 
@@ -56,8 +56,9 @@ class SBN(Model):
         l_p_in, num_units=n_hid,
         nonlinearity=hid_nl,
         W=lasagne.init.GlorotUniform())
+    # the decoder outputs logits; the likelihood is computed in logit space
     l_p_mu = lasagne.layers.DenseLayer(l_p_hid, num_units=n_out,
-        nonlinearity = lasagne.nonlinearities.sigmoid,
+        nonlinearity = None,
         W=lasagne.init.GlorotUniform(),
         b=lasagne.init.Constant(0.))
 
@@ -72,8 +73,8 @@ class SBN(Model):
         nonlinearity=None)
 
     # create variables for centering signal
-    c = theano.shared(np.zeros((1,1), dtype=np.float64), broadcastable=(True,True))
-    v = theano.shared(np.zeros((1,1), dtype=np.float64), broadcastable=(True,True))
+    c = theano.shared(np.zeros((1,1), dtype=theano.config.floatX), broadcastable=(True,True))
+    v = theano.shared(np.zeros((1,1), dtype=theano.config.floatX), broadcastable=(True,True))
 
     return l_p_mu, l_q_mu, l_q_sample, l_cv, c, v
 
@@ -87,7 +88,7 @@ class SBN(Model):
 
     # load network output
     z, q_mu = lasagne.layers.get_output([l_q_sample, l_q_mu], deterministic=deterministic)
-    p_mu = lasagne.layers.get_output(l_p_mu, z, deterministic=deterministic)
+    p_logit = lasagne.layers.get_output(l_p_mu, z, deterministic=deterministic)
 
     # entropy term
     log_qz_given_x = log_bernoulli(dg(z), q_mu).sum(axis=1)
@@ -95,7 +96,7 @@ class SBN(Model):
     # expected p(x,z) term
     z_prior = T.ones_like(z)*np.float32(0.5)
     log_pz = log_bernoulli(z, z_prior).sum(axis=1)
-    log_px_given_z = log_bernoulli(x, p_mu).sum(axis=1)
+    log_px_given_z = log_bernoulli_logit(x, p_logit).sum(axis=1)
     log_pxz = log_pz + log_px_given_z
 
     # save them for later
@@ -164,6 +165,19 @@ class SBN(Model):
     cv_params = lasagne.layers.get_all_params(l_cv, trainable=True)
     return p_params + q_params + cv_params #+ [c]
 
+  def get_inference_layers(self):
+    l_p_mu, l_q_mu, _, _, _, _ = self.network
+    l_p_in = lasagne.layers.get_all_layers(l_p_mu)[0]
+    return OrderedDict([
+      ('encode', dict(output=l_q_mu)),
+      ('posterior', dict(output=[l_q_mu], names=['q_mu'])),
+      ('decode', dict(input=l_p_in, output=l_p_mu, post='sigmoid')),
+    ])
+
+  def sample_prior(self, n, rng=np.random):
+    n_lat = self.network[1].output_shape[1]
+    return rng.binomial(1, 0.5, size=(n, n_lat)).astype(theano.config.floatX)
+
   def create_updates(self, grads, params, alpha, opt_alg, opt_params):
     # call super-class to generate SGD/ADAM updates
     grad_updates = Model.create_updates(self, grads, params, alpha, opt_alg, opt_params)
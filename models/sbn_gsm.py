@@ -32,11 +32,12 @@ class SBN_GSM(GSM):
     q_net_mu = DenseLayer(q_net, num_units=n_lat, nonlinearity=None)
     q_net_mu = reshape(q_net_mu, (-1, n_class))
     # sample from Gumble-Softmax posterior
-    q_sample = GumbelSoftmaxSampleLayer(q_net_mu, tau)
+    q_sample = GumbelSoftmaxSampleLayer(q_net_mu, tau,
+                                        straight_through=self.straight_through)
     q_sample = reshape(q_sample, (-1, n_cat, n_class))
     # create the decoder network
     p_net = DenseLayer(flatten(q_sample), num_units=n_hid, nonlinearity=T.nnet.relu)
-    p_net_mu = DenseLayer(p_net, num_units=n_out, nonlinearity=T.nnet.sigmoid)
+    p_net_mu = DenseLayer(p_net, num_units=n_out, nonlinearity=None)
 
     # save network params
     self.n_class = n_class
@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import numpy as np
+import theano
+
+from models.vae import VAE
+
+floatX = theano.config.floatX
+
+# ----------------------------------------------------------------------------
+
+def test_checkpoint_round_trip():
+  rng = np.random.RandomState(0)
+  X = rng.binomial(1, 0.5, size=(100, 1, 28, 28)).astype(floatX)
+  Y = rng.randint(10, size=100).astype(floatX)
+  model = VAE(n_dim=28, n_out=10, n_chan=1, n_superbatch=100)
+  model.load_data(X, Y)
+  model.train(0, 50, 1.0)
+
+  fd, fname = tempfile.mkstemp(suffix='.npz')
+  os.close(fd)
+  try:
+    np.random.seed(1)
+    model.dump(fname, epoch=3, alpha=0.5)
+    state = model.get_state()
+    draws = np.random.rand(5)
+    loss = model.train(50, 100, 1.0)
+
+    # train on, then go back to the checkpoint
+    for i in range(3):
+      model.train(0, 50, 1.0)
+    np.random.seed(2)
+    cursor = model.load(fname)
+  finally:
+    os.remove(fname)
+
+  assert cursor == dict(epoch=3, alpha=0.5)
+  for key, value in model.get_state().items():
+    assert np.array_equal(value, state[key]), key
+
+  # the random streams continue where they were, so the next step repeats
+  assert np.array_equal(np.random.rand(5), draws)
+  assert np.allclose(model.train(50, 100, 1.0), loss)
+
+def test_checkpoint_mismatch():
+  model = VAE(n_dim=28, n_out=10, n_chan=1, n_superbatch=10)
+  state = model.get_state()
+  key = [k for k in state if k.startswith('var.') and state[k].ndim == 2][0]
+  state[key] = np.zeros((1, 1), dtype=state[key].dtype)
+  try:
+    model.set_state(state)
+  except ValueError:
+    return
+  assert False, 'loaded a parameter of the wrong shape'
@@ -0,0 +1,83 @@
+import numpy as np
+import theano
+import lasagne
+from lasagne.layers import (InputLayer, DenseLayer, Conv2DLayer, MaxPool2DLayer,
+                            BatchNormLayer, batch_norm)
+
+from models.model import Model
+from models.mlp import MLP
+from models.cnn import CNN
+from models.vae import VAE
+from models.export import export_plan, weight_layers
+from util.engine import Engine, optimize
+
+floatX = theano.config.floatX
+
+# ----------------------------------------------------------------------------
+# NumPy engine vs. the compiled Theano function
+
+def engine_vs_theano(model, mode=None):
+  """Largest difference between the engine and apply_inference on random inputs"""
+  precision = dict((layer, mode) for layer in weight_layers(model, 'predict')) if mode else None
+  plan, weights = export_plan(model, 'predict', precision)
+  optimize(plan, weights)
+
+  X = np.random.RandomState(0).rand(64, 1, 28, 28).astype(floatX)
+  expected = model.apply_inference('predict', X)
+  actual = Engine(plan, weights)(X, batchsize=20)
+  assert actual.shape == expected.shape
+  return np.abs(actual - expected).max()
+
+def test_mlp_engine_matches_theano():
+  model = MLP(n_dim=28, n_out=10, n_superbatch=64, n_hidden=[100, 100])
+  assert engine_vs_theano(model) < 1e-4
+  assert engine_vs_theano(model, 'float16') < 1e-2
+  assert engine_vs_theano(model, 'int8') < 5e-2
+
+def test_cnn_engine_matches_theano():
+  model = CNN(n_dim=28, n_out=10, n_chan=1, n_superbatch=64, model='mnist')
+  assert engine_vs_theano(model) < 1e-4
+  assert engine_vs_theano(model, 'int8') < 5e-2
+
+def test_weight_layers_match_the_plan():
+  # decode starts at the latent input, so the encoder must not be counted
+  model = VAE(n_dim=28, n_out=10, n_chan=1, n_superbatch=64)
+  for name in ('encode', 'decode'):
+    plan, weights = export_plan(model, name)
+    n_weighted = sum(op['op'] in ('dense', 'conv') for op in plan['ops'])
+    assert len(weight_layers(model, name)) == n_weighted, name
+
+# ----------------------------------------------------------------------------
+# batch norm folding
+
+class BNCNN(Model):
+  """Small CNN with batch norm after each convolution"""
+  def __init__(self, n_dim=28, n_out=10, n_chan=1, n_superbatch=64):
+    Model.__init__(self, n_dim, n_chan, n_out, n_superbatch, 'adam', {'lr': 1e-3})
+
+  def create_model(self, X, Y, n_dim, n_out, n_chan=1):
+    rectify = lasagne.nonlinearities.rectify
+    l = InputLayer(shape=(None, n_chan, n_dim, n_dim), input_var=X)
+    l = batch_norm(Conv2DLayer(l, num_filters=8, filter_size=(3, 3), pad='same',
+                               nonlinearity=rectify))
+    l = MaxPool2DLayer(l, pool_size=(2, 2))
+    l = batch_norm(Conv2DLayer(l, num_filters=8, filter_size=(3, 3),
+                               nonlinearity=rectify))
+    return DenseLayer(l, num_units=n_out, nonlinearity=lasagne.nonlinearities.softmax)
+
+def test_batch_norm_folds_into_convolutions():
+  model = BNCNN()
+  # give the statistics values that change the output, unlike their defaults
+  rng = np.random.RandomState(1)
+  for layer in lasagne.layers.get_all_layers(model.network):
+    if isinstance(layer, BatchNormLayer):
+      for param, lo in ((layer.mean, -1), (layer.inv_std, 0.5), (layer.gamma, 0.5),
+                        (layer.beta, -1)):
+        shape = param.get_value().shape
+        param.set_value(rng.uniform(lo, lo + 1.5, size=shape).astype(floatX))
+
+  plan, weights = export_plan(model, 'predict')
+  assert sum(op['op'] == 'affine' for op in plan['ops']) == 2
+  optimize(plan, weights)
+  assert not [op for op in plan['ops'] if op['op'] in ('affine', 'nonlinearity')]
+  assert engine_vs_theano(model) < 1e-4
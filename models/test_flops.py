@@ -0,0 +1,18 @@
+from models.mlp import MLP
+from models.sbn import SBN
+from models.dadgm import DADGM
+from models import flops
+
+# ----------------------------------------------------------------------------
+
+def test_count_dense_network():
+  model = MLP(n_dim=28, n_out=10, n_superbatch=100, n_hidden=[100, 50])
+  total = flops.totals(flops.count(model))
+  assert total['macs'] == 784 * 100 + 100 * 50 + 50 * 10
+  assert total['params'] == total['macs'] + 100 + 50 + 10
+
+def test_count_networks_with_shared_variables():
+  # the SBN and DADGM network tuples end with the centering signals c and v
+  for model in (SBN(n_dim=28, n_out=10, n_chan=1, n_superbatch=100),
+                DADGM(n_dim=28, n_out=10, n_chan=1, n_superbatch=100)):
+    assert flops.totals(flops.count(model))['macs'] > 0
@@ -1,6 +1,7 @@
 import time
 import pickle
 import numpy as np
+from collections import OrderedDict
 
 import theano
 import theano.tensor as T
@@ -9,16 +10,23 @@ import lasagne
 from model import Model
 
 from layers import GaussianSampleLayer
+from distributions import log_bernoulli_logit, log_normal, log_normal2, log_mean_exp
 
 # ----------------------------------------------------------------------------
 
 class VAE(Model):
   """Variational Autoencoder with Gaussian visible and latent variables"""
   def __init__(self, n_dim, n_out, n_chan=1, n_superbatch=12800, model='bernoulli',
-                opt_alg='adam', opt_params={'lr' : 1e-3, 'b1': 0.9, 'b2': 0.99}):
+                opt_alg='adam', opt_params={'lr' : 1e-3, 'b1': 0.9, 'b2': 0.99},
+                n_samples=1, iwae=False):
     # save model that wil be created
     self.model = model
 
+    # number of latent samples drawn per datapoint during training, and
+    # whether to combine them into an importance-weighted bound
+    self.n_samples = n_samples
+    self.iwae = iwae
+
     # invoke parent constructor
     Model.__init__(self, n_dim, n_chan, n_out, n_superbatch, opt_alg, opt_params)
 
@@ -44,7 +52,7 @@ class VAE(Model):
         nonlinearity=None)
 
     # create the decoder network
-    l_p_z = GaussianSampleLayer(l_q_mu, l_q_logsigma)
+    l_p_z = GaussianSampleLayer(l_q_mu, l_q_logsigma, n_samples=self.n_samples)
 
     l_p_hid = lasagne.layers.DenseLayer(
         l_p_z, num_units=n_hid,
@@ -53,8 +61,9 @@ class VAE(Model):
     l_p_mu, l_p_logsigma = None, None
 
     if self.model == 'bernoulli':
+      # the decoder outputs logits; the likelihood is computed in logit space
       l_sample = lasagne.layers.DenseLayer(l_p_hid, num_units=n_out,
-          nonlinearity = lasagne.nonlinearities.sigmoid,
+          nonlinearity = None,
           W=lasagne.init.GlorotUniform(),
           b=lasagne.init.Constant(0.))
 
@@ -73,18 +82,23 @@ class VAE(Model):
 
       l_sample = GaussianSampleLayer(l_p_mu, l_p_logsigma)
 
-    return l_p_mu, l_p_logsigma, l_q_mu, l_q_logsigma, l_sample
+    return l_p_mu, l_p_logsigma, l_q_mu, l_q_logsigma, l_sample, l_p_z
 
   def create_objectives(self, deterministic=False):
     # load network input
     X = self.inputs[0]
+    x = X.flatten(2)
+
+    # the encoder runs once per datapoint; the decoder sees k samples of z
+    k = 1 if deterministic else self.n_samples
+    x_k = T.tile(x, (k, 1)) if k > 1 else x
 
     # load network output
     if self.model == 'bernoulli':
-      q_mu, q_logsigma, sample \
+      q_mu, q_logsigma, sample, z \
           = lasagne.layers.get_output(self.network[2:], deterministic=deterministic)
     elif self.model == 'gaussian':
-      p_mu, p_logsigma, q_mu, q_logsigma, _ \
+      p_mu, p_logsigma, q_mu, q_logsigma, _, z \
           = lasagne.layers.get_output(self.network, deterministic=deterministic)
 
     # first term of the ELBO: kl-divergence (using the closed form expression)
@@ -93,18 +107,41 @@ class VAE(Model):
 
     # second term: log-likelihood of the data under the model
     if self.model == 'bernoulli':
-      logpxz = -lasagne.objectives.binary_crossentropy(sample, X.flatten(2)).sum(axis=1).mean()
+      log_px_given_z = log_bernoulli_logit(x_k, sample).sum(axis=1)
     elif self.model == 'gaussian':
       def log_lik(x, mu, log_sig):
           return T.sum(-(np.float32(0.5 * np.log(2 * np.pi)) + log_sig)
                         - 0.5 * T.sqr(x - mu) / T.exp(2 * log_sig), axis=1)
-      logpxz = log_lik(X.flatten(2), p_mu, p_logsigma).mean()
-
-    loss = -1 * (logpxz + kl_div)
+      log_px_given_z = log_lik(x_k, p_mu, p_logsigma)
+
+    if self.iwae and k > 1:
+      # importance-weighted bound: log-mean-exp of the k weights per datapoint
+      q_mu_k, q_logsigma_k = T.tile(q_mu, (k, 1)), T.tile(q_logsigma, (k, 1))
+      log_qz_given_x = log_normal2(z, q_mu_k, 2 * q_logsigma_k).sum(axis=1)
+      log_pz = log_normal(z, T.zeros_like(z), T.ones_like(z)).sum(axis=1)
+      log_w = (log_px_given_z + log_pz - log_qz_given_x).reshape((k, -1))
+      loss = -1 * log_mean_exp(log_w, axis=0).mean()
+    else:
+      # average the log-likelihood over all k*batch samples
+      logpxz = log_px_given_z.mean()
+      loss = -1 * (logpxz + kl_div)
 
     # we don't use the spearate accuracy metric right now
     return loss, -kl_div
 
   def get_params(self):
-    _, _, _, _, l_sample = self.network
+    l_sample = self.network[4]
     return lasagne.layers.get_all_params(l_sample, trainable=True)
+
+  def get_inference_layers(self):
+    l_p_mu, l_p_logsigma, l_q_mu, l_q_logsigma, l_sample, l_p_z = self.network
+    post = 'sigmoid' if self.model == 'bernoulli' else None
+    return OrderedDict([
+      ('encode', dict(output=l_q_mu)),
+      ('posterior', dict(output=[l_q_mu, l_q_logsigma], names=['q_mu', 'q_logsigma'])),
+      ('decode', dict(input=l_p_z, output=l_sample, post=post)),
+    ])
+
+  def sample_prior(self, n, rng=np.random):
+    n_lat = self.network[2].output_shape[1]
+    return rng.normal(size=(n, n_lat)).astype(theano.config.floatX)
@@ -1,6 +1,7 @@
 import time
 import pickle
 import numpy as np
+from collections import OrderedDict
 
 import theano
 import theano.tensor as T
@@ -10,7 +11,7 @@ import lasagne
 from model import Model
 
 from layers import GaussianSampleLayer
-from distributions import log_bernoulli, log_normal, log_normal2
+from distributions import log_bernoulli_logit, log_normal, log_normal2
 
 # ----------------------------------------------------------------------------
 
@@ -55,8 +56,9 @@ class VAE_REINFORCE(Model):
     l_p_mu, l_p_logsigma = None, None
 
     if self.model == 'bernoulli':
+      # the decoder outputs logits; the likelihood is computed in logit space
       l_sample = lasagne.layers.DenseLayer(l_p_hid, num_units=n_out,
-          nonlinearity = lasagne.nonlinearities.sigmoid,
+          nonlinearity = None,
           W=lasagne.init.GlorotUniform(),
           b=lasagne.init.Constant(0.), name='p_sigma')
 
@@ -99,7 +101,7 @@ class VAE_REINFORCE(Model):
 
     # second term: log-likelihood of the data under the model
     if self.model == 'bernoulli':
-      logpxz = -lasagne.objectives.binary_crossentropy(sample, X.flatten(2)).sum(axis=1).mean()
+      logpxz = log_bernoulli_logit(X.flatten(2), sample).sum(axis=1).mean()
     elif self.model == 'gaussian':
       def log_lik(x, mu, log_sig):
           return T.sum(-(np.float32(0.5 * np.log(2 * np.pi)) + log_sig)
@@ -131,7 +133,7 @@ class VAE_REINFORCE(Model):
     z_prior_sigma = T.cast(T.ones_like(q_logsigma), dtype=theano.config.floatX)
     z_prior_mu = T.cast(T.zeros_like(q_mu), dtype=theano.config.floatX)
     log_pz = log_normal(z, z_prior_mu,  z_prior_sigma).sum(axis=1)
-    log_px_given_z = log_bernoulli(x, p_mu).sum(axis=1)
+    log_px_given_z = log_bernoulli_logit(x, p_mu).sum(axis=1)
     log_pxz = log_pz + log_px_given_z
 
     self.log_pxz = log_pxz
@@ -198,3 +200,16 @@ class VAE_REINFORCE(Model):
   def get_params(self):
     p_params, q_params = self._get_net_params()
     return p_params + q_params
+
+  def get_inference_layers(self):
+    l_p_mu, l_p_logsigma, l_q_mu, l_q_logsigma, l_sample, l_p_z = self.network
+    post = 'sigmoid' if self.model == 'bernoulli' else None
+    return OrderedDict([
+      ('encode', dict(output=l_q_mu)),
+      ('posterior', dict(output=[l_q_mu, l_q_logsigma], names=['q_mu', 'q_logsigma'])),
+      ('decode', dict(input=l_p_z, output=l_sample, post=post)),
+    ])
+
+  def sample_prior(self, n, rng=np.random):
+    n_lat = self.network[2].output_shape[1]
+    return rng.normal(size=(n, n_lat)).astype(theano.config.floatX)
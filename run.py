@@ -1,5 +1,6 @@
 import argparse
-from util import data, fig, launch
+from util import data, fig, launch, tune
+from benchmarks import suite
 
 # ----------------------------------------------------------------------------
 
@@ -12,16 +13,176 @@ def make_parser():
   train_parser = subparsers.add_parser('train', help='Train model')
   train_parser.set_defaults(func=train)
 
-  train_parser.add_argument('--dataset', default='mnist')
-  train_parser.add_argument('--model', default='softmax')
+  add_model_args(train_parser)
   train_parser.add_argument('-e', '--epochs', type=int, default=10)
   train_parser.add_argument('-l', '--logname', default='mnist-run')
-  train_parser.add_argument('--alg', default='adam')
-  train_parser.add_argument('--lr', type=float, default=1e-3)
-  train_parser.add_argument('--b1', type=float, default=0.9)
-  train_parser.add_argument('--b2', type=float, default=0.999)
-  train_parser.add_argument('--n_batch', type=int, default=128)
-  train_parser.add_argument('--n_superbatch', type=int, default=1280)
+  train_parser.add_argument('--check-dtypes', default='off',
+                            choices=['off', 'warn', 'raise'])
+  train_parser.add_argument('--checkpoint',
+                            help='Checkpoint file (default: <logname>.ckpt.npz)')
+  train_parser.add_argument('--checkpoint-every', type=int, default=0,
+                            help='Write a checkpoint every this many epochs')
+  train_parser.add_argument('--resume', action='store_true',
+                            help='Continue training from the checkpoint')
+  train_parser.add_argument('--log-format', default='tsv', choices=['tsv', 'binary'],
+                            help='Text or fixed-width binary metrics logs')
+  train_parser.add_argument('--registry', default='runs.db',
+                            help="SQLite run registry ('' to skip registering)")
+  train_parser.add_argument('--timing', action='store_true',
+                            help='Print and log a per-phase time breakdown every epoch')
+  train_parser.add_argument('--memory', action='store_true',
+                            help='Print the memory footprint and log RSS every epoch')
+  train_parser.add_argument('--augment', action='store_true',
+                            help='Random crops and flips of each training superbatch '
+                                 '(image datasets), prepared by worker processes')
+  train_parser.add_argument('--augment-pad', type=int, default=4,
+                            help='Largest crop offset in pixels')
+  train_parser.add_argument('--augment-workers', type=int, default=2)
+  train_parser.add_argument('--binarize', action='store_true',
+                            help='Keep MNIST as bytes and draw binary pixels for '
+                                 'every superbatch (dynamic binarization)')
+  train_parser.add_argument('--binarize-seed', type=int, default=0)
+  train_parser.add_argument('--tune-profile', default=tune.PROFILE,
+                            help="Settings from 'run.py tune' ('' to ignore)")
+  train_parser.add_argument('--profile', type=int, default=0, metavar='N',
+                            help='Instead of training, profile N steps per Theano op '
+                                 'and write <logname>.profile.{json,txt}')
+
+  # serve
+
+  serve_parser = subparsers.add_parser('serve',
+    help='Serve a trained model over local HTTP')
+  serve_parser.set_defaults(func=serve)
+
+  add_model_args(serve_parser)
+  serve_parser.add_argument('--checkpoint',
+                            help='Model checkpoint to serve')
+  serve_parser.add_argument('--plans', nargs='+',
+                            help='Serve exported plans with the NumPy engine instead')
+  serve_parser.add_argument('--host', default='127.0.0.1')
+  serve_parser.add_argument('--port', type=int, default=8000)
+  serve_parser.add_argument('--max-batch', type=int, default=256,
+                            help='Largest coalesced batch (rows)')
+  serve_parser.add_argument('--max-latency', type=float, default=5.0,
+                            help='Longest wait for a batch to fill (ms)')
+  serve_parser.add_argument('--threads', type=int, default=8,
+                            help='Request handling threads')
+
+  # export
+
+  export_parser = subparsers.add_parser('export',
+    help='Export inference functions for the NumPy engine')
+  export_parser.set_defaults(func=export)
+
+  add_model_args(export_parser)
+  export_parser.add_argument('--checkpoint', required=True)
+  export_parser.add_argument('--method', nargs='+', default=['predict'],
+                             help='Inference functions to export')
+  export_parser.add_argument('--out', required=True,
+                             help='Output prefix; writes <out>.<method>.npz')
+  export_parser.add_argument('--quantize', default='none',
+                             choices=['none', 'int8', 'float16'],
+                             help='Per-channel weight quantization')
+  export_parser.add_argument('--calibrate', type=int, default=1000,
+                             help='Training examples used to calibrate quantization')
+  export_parser.add_argument('--tol', type=float, default=0.01,
+                             help='Largest relative loss increase per quantized layer')
+
+  # index
+
+  index_parser = subparsers.add_parser('index',
+    help='Build a Hamming nearest-neighbor index of binary latent codes')
+  index_parser.set_defaults(func=index)
+
+  add_model_args(index_parser)
+  index_parser.add_argument('--checkpoint', required=True)
+  index_parser.add_argument('--out', required=True,
+                            help='Output prefix; writes <out>.codes.npy and <out>.index.npz')
+  index_parser.add_argument('--queries', type=int, default=100,
+                            help='Validation examples used to time k-NN queries')
+  index_parser.add_argument('-k', type=int, default=10)
+
+  # export-latents
+
+  latents_parser = subparsers.add_parser('export-latents',
+    help='Write posterior parameters for a whole dataset to .npy files')
+  latents_parser.set_defaults(func=export_latents)
+
+  add_model_args(latents_parser)
+  latents_parser.add_argument('--checkpoint', required=True)
+  latents_parser.add_argument('--out', required=True,
+                              help='Output prefix; writes <out>.<output>.npy')
+  latents_parser.add_argument('--method', default='posterior',
+                              help='Inference function to export')
+  latents_parser.add_argument('--split', default='train', choices=['train', 'val'])
+
+  # sample
+
+  sample_parser = subparsers.add_parser('sample',
+    help='Draw samples from a generative model into an .npy file')
+  sample_parser.set_defaults(func=sample)
+
+  add_model_args(sample_parser)
+  sample_parser.add_argument('--checkpoint', required=True)
+  sample_parser.add_argument('--out', required=True)
+  sample_parser.add_argument('-n', type=int, default=10000)
+  sample_parser.add_argument('--chunk', type=int, default=1000,
+                             help='Samples drawn per RNG seed')
+  sample_parser.add_argument('--seed', type=int, default=0)
+  sample_parser.add_argument('--workers', type=int, default=1,
+                             help='Processes drawing disjoint slices of chunks')
+
+  # query
+
+  query_parser = subparsers.add_parser('query',
+    help='Find runs in the run registry')
+  query_parser.set_defaults(func=query)
+
+  query_parser.add_argument('--registry', default='runs.db')
+  query_parser.add_argument('--ingest', nargs='+', default=[], metavar='LOG',
+                            help='Register existing <logname>.val.log files first')
+  query_parser.add_argument('--dataset')
+  query_parser.add_argument('--model')
+  query_parser.add_argument('--alg')
+  query_parser.add_argument('--status')
+  query_parser.add_argument('--where', help="SQL condition, e.g. 'lr < 0.01'")
+  query_parser.add_argument('--order', default='best_val_err')
+  query_parser.add_argument('--desc', action='store_true')
+  query_parser.add_argument('--limit', type=int, default=20)
+
+  # bench
+
+  bench_parser = subparsers.add_parser('bench',
+    help='Benchmark build/compile time, throughput and memory of the models')
+  bench_parser.set_defaults(func=bench)
+  suite.add_bench_args(bench_parser)
+
+  # flops
+
+  flops_parser = subparsers.add_parser('flops',
+    help='Count parameters and multiply-accumulates per layer')
+  flops_parser.set_defaults(func=flops)
+
+  add_model_args(flops_parser)
+  flops_parser.add_argument('--measure', type=int, default=0, metavar='STEPS',
+                            help='Also time this many training steps on synthetic data '
+                                 'and report the achieved GFLOP/s')
+
+  # tune
+
+  tune_parser = subparsers.add_parser('tune',
+    help='Find the fastest thread and conv settings for a model on this host')
+  tune_parser.set_defaults(func=tune_threads)
+
+  add_model_args(tune_parser)
+  tune_parser.add_argument('--threads', nargs='+', type=int,
+                           help='Thread counts to try (default: powers of 2 up to #cores)')
+  tune_parser.add_argument('--conv', nargs='+', default=tune.CONV_IMPLS, choices=tune.CONV_IMPLS,
+                           help='CPU conv implementations to try (only matters for conv models)')
+  tune_parser.add_argument('--batch-sizes', nargs='+', type=int, default=[32, 128, 512])
+  tune_parser.add_argument('--steps', type=int, default=20,
+                           help='Timed train steps per trial and batch size')
+  tune_parser.add_argument('--profile', default=tune.PROFILE)
 
   # plot
 
@@ -30,11 +191,23 @@ def make_parser():
 
   plot_parser.add_argument('logfiles', metavar='log', nargs='+')
   plot_parser.add_argument('--type', default='two',
-                           choices=['two', 'many', 'one-vs-many', 'many-vs-many'])
+                           choices=['two', 'many', 'one-vs-many', 'many-vs-many', 'bands'])
   plot_parser.add_argument('--out', required=True)
   plot_parser.add_argument('--double', nargs='+', default=[0], type=int)
   plot_parser.add_argument('--col', type=int, default=2)
   plot_parser.add_argument('--log2', nargs='+')
+  plot_parser.add_argument('--max-points', type=int, default=2000,
+                           help='Downsample each curve to this many points (0: off)')
+
+  # plot-batch
+
+  batch_parser = subparsers.add_parser('plot-batch',
+    help='Render the figures listed in a JSON file in parallel')
+  batch_parser.set_defaults(func=plot_batch)
+
+  batch_parser.add_argument('spec',
+    help='JSON list of figures, each a dict of plot options (logfiles, out, type, ...)')
+  batch_parser.add_argument('--workers', type=int, default=4)
 
   # grid
 
@@ -54,28 +227,50 @@ def make_parser():
 
   return parser
 
+def add_model_args(parser):
+  parser.add_argument('--dataset', default='mnist')
+  parser.add_argument('--model', default='softmax')
+  parser.add_argument('--alg', default='adam')
+  parser.add_argument('--lr', type=float, default=1e-3)
+  parser.add_argument('--b1', type=float, default=0.9)
+  parser.add_argument('--b2', type=float, default=0.999)
+  parser.add_argument('--n_batch', type=int, default=128)
+  parser.add_argument('--n_superbatch', type=int, default=1280)
+  parser.add_argument('--straight-through', action='store_true',
+                      help='Hard Gumbel-Softmax samples (gsm models)')
+  parser.add_argument('--n_samples', type=int, default=1,
+                      help='Latent samples per datapoint (vae, adgm)')
+  parser.add_argument('--iwae', action='store_true',
+                      help='Use the importance-weighted bound (vae, adgm)')
+
 # ----------------------------------------------------------------------------
 
-def train(args):
-  import models
-  import numpy as np
-  np.random.seed(1234)
+# (n_dim, n_out, n_channels) of each dataset
+DATASET_DIMS = {
+  'mnist'   : (28, 10, 1),
+  'digits'  : (8, 10, 1),
+  'cifar10' : (32, 10, 3),
+}
 
-  if args.dataset == 'mnist':
-    n_dim, n_out, n_channels = 28, 10, 1
-    X_train, Y_train, X_val, Y_val, _, _ = data.load_mnist()
-  elif args.dataset == 'digits':
-    n_dim, n_out, n_channels = 8, 10, 1
+def load_dataset(name, binarize=False):
+  """Training and validation sets; binarize keeps MNIST as uint8 bytes"""
+  if binarize and name != 'mnist':
+    raise ValueError('Dynamic binarization is only supported on mnist')
+  if name == 'mnist':
+    dtype = 'uint8' if binarize else 'float32'
+    X_train, Y_train, X_val, Y_val, _, _ = data.load_mnist(dtype=dtype)
+  elif name == 'digits':
     X_train, Y_train, X_val, Y_val, _, _ = data.load_digits10()
-  elif args.dataset == 'cifar10':
-    n_dim, n_out, n_channels = 32, 10, 3
+  elif name == 'cifar10':
     X_train, Y_train, X_val, Y_val = data.load_cifar10()
     X_train, X_val = data.whiten(X_train, X_val)
   else:
-    X_train, Y_train = data.load_h5(args.train)
-    X_val, Y_val = data.load_h5(args.test)
-    # also get the data dimensions
-  print 'dataset loaded.'
+    raise ValueError('Invalid dataset')
+  return X_train, Y_train, X_val, Y_val
+
+def make_model(args):
+  import models
+  n_dim, n_out, n_channels = DATASET_DIMS[args.dataset]
 
   # set up optimization params
   p = { 'lr' : args.lr, 'b1': args.b1, 'b2': args.b2, 'nb': args.n_batch }
@@ -95,7 +290,8 @@ def train(args):
                           n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
   elif args.model == 'vae':
     model = models.VAE(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
-                       n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
+                       n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p,
+                       n_samples=args.n_samples, iwae=args.iwae)
   elif args.model == 'vae_reinforce':
     model = models.VAE_REINFORCE(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
                                  n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
@@ -104,29 +300,261 @@ def train(args):
                        n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
   elif args.model == 'sbn_gsm':
     model = models.SBN_GSM(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
-                           n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
+                           n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p,
+                           straight_through=args.straight_through)
   elif args.model == 'adgm':
     model = models.ADGM(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
-                        n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
+                        n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p,
+                        n_samples=args.n_samples, iwae=args.iwae)
   elif args.model == 'dadgm':
     model = models.DADGM(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
                          n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
   elif args.model == 'adgm_gsm':
     model = models.ADGM_GSM(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
-                             n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
+                             n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p,
+                             straight_through=args.straight_through)
   elif args.model == 'gsm':
     model = models.GSM(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
-                       n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
+                       n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p,
+                       straight_through=args.straight_through)
   elif args.model == 'rbm':
     model = models.RBM(n_dim=n_dim, n_out=n_out, n_chan=n_channels,
                        n_superbatch=args.n_superbatch, opt_alg=args.alg, opt_params=p)
   else:
     raise ValueError('Invalid model')
 
-  # train model
-  model.fit(X_train, Y_train, X_val, Y_val,
-            n_epoch=args.epochs, n_batch=args.n_batch,
-            logname=args.logname)
+  return model
+
+def train(args):
+  import numpy as np
+  np.random.seed(1234)
+
+  X_train, Y_train, X_val, Y_val = load_dataset(args.dataset, binarize=args.binarize)
+  print 'dataset loaded.'
+
+  # profiling has to be on when the functions are compiled
+  if args.profile:
+    import theano
+    theano.config.profile = True
+
+  model = make_model(args)
+  if args.binarize:
+    import theano
+    model.binarizer = data.DynamicBinarizer(args.binarize_seed, dtype=theano.config.floatX)
+
+  if args.profile:
+    from util import theano_profile
+    model.profile_steps(X_train, Y_train, X_val, Y_val, args.profile, args.n_batch)
+    report = theano_profile.collect(model.compiled_functions())
+    for fname in theano_profile.write_report(report, args.logname):
+      print 'Wrote {}'.format(fname)
+    return
+
+  # look for float64 upcasts in the compiled graphs
+  if args.check_dtypes != 'off':
+    model.audit_dtypes(strict=(args.check_dtypes == 'raise'))
+
+  # record the run's config and metrics in the registry
+  registry, config = None, {}
+  if args.registry:
+    from util.registry import Registry
+    registry = Registry(args.registry)
+    config = dict((k, v) for k, v in vars(args).items() if k != 'func')
+
+  # workers share X_train with this process and only use NumPy
+  if args.augment:
+    from util.augment import Augmenter
+    from models.model import Model
+    if X_train.ndim != 4:
+      raise ValueError('Augmentation needs an image dataset')
+    # GSM and RBM flatten the images in their own fit, which never augments
+    if type(model).fit.__func__ is not Model.fit.__func__:
+      raise ValueError('--augment is not supported for %s' % args.model)
+    model.augmenter = Augmenter(X_train, Y_train, min(args.n_superbatch, len(X_train)),
+                                pad=args.augment_pad, n_workers=args.augment_workers)
+
+  # train model; checkpoints are only written or resumed from when asked for
+  checkpoint = None
+  if args.checkpoint or args.checkpoint_every or args.resume:
+    checkpoint = args.checkpoint or args.logname + '.ckpt.npz'
+  try:
+    model.fit(X_train, Y_train, X_val, Y_val,
+              n_epoch=args.epochs, n_batch=args.n_batch,
+              logname=args.logname, checkpoint=checkpoint,
+              checkpoint_every=args.checkpoint_every, log_format=args.log_format,
+              registry=registry, config=config, timing=args.timing,
+              memory=args.memory, resume=args.resume)
+  finally:
+    if model.augmenter: model.augmenter.close()
+    if registry: registry.close()
+
+def serve(args):
+  from util import serve as server
+  if args.plans:
+    from util.engine import Engine
+    engines = [Engine.load(fname) for fname in args.plans]
+    # like model_methods, skip plans with several outputs
+    methods = dict((e.method, lambda X, e=e: e(X, batchsize=args.max_batch))
+                   for e in engines if e.plan['single_output'])
+  elif args.checkpoint:
+    model = make_model(args)
+    model.load(args.checkpoint)
+    methods = server.model_methods(model, args.max_batch)
+  else:
+    raise ValueError('Need a --checkpoint or --plans to serve')
+  server.serve(methods, args.host, args.port, max_batch=args.max_batch,
+               max_latency=args.max_latency / 1000., n_threads=args.threads)
+
+def export(args):
+  from models.export import export as export_model, calibrate, quantization_report
+  model = make_model(args)
+  model.load(args.checkpoint)
+  if args.quantize != 'none':
+    X_train, Y_train, X_val, Y_val = load_dataset(args.dataset)
+    X_calib, Y_calib = X_train[:args.calibrate], Y_train[:args.calibrate]
+
+  for method in args.method:
+    precision = None
+    if args.quantize != 'none':
+      precision = calibrate(model, method, args.quantize, X_calib, Y_calib, tol=args.tol)
+      report = quantization_report(model, precision, X_val, Y_val)
+      print '{}: layers {}'.format(method, dict(report['layers']))
+      print '  float32 loss/acc:\t\t{:.6f}\t{:.6f}'.format(*report['float32'])
+      print '  quantized loss/acc:\t\t{:.6f}\t{:.6f}'.format(*report['quantized'])
+
+    fname = '{}.{}.npz'.format(args.out, method)
+    plan = export_model(model, method, fname, precision=precision)
+    print 'Wrote {} ({} ops)'.format(fname, len(plan['ops']))
+
+def index(args):
+  import time
+  from util import hamming
+  X_train, _, X_val, _ = load_dataset(args.dataset)
+  model = make_model(args)
+  model.load(args.checkpoint)
+
+  # encode the training set into packed codes on disk
+  n_bits = model.encode(X_train[:1]).shape[1]
+  start_time = time.time()
+  codes = hamming.encode_to_file(model.encode, model.binarize_codes, X_train,
+                                 args.out + '.codes.npy', n_bits, batchsize=1000)
+  print 'Encoded {} examples into {}-bit codes in {:.3f}s'.format(
+      len(codes), n_bits, time.time() - start_time)
+
+  start_time = time.time()
+  nn_index = hamming.HammingIndex(codes, n_bits)
+  nn_index.save(args.out + '.index.npz')
+  print 'Built index in {:.3f}s'.format(time.time() - start_time)
+
+  # time queries from the validation set against a linear scan
+  queries = hamming.pack_bits(model.binarize_codes(model.encode(X_val[:args.queries])))
+  start_time = time.time()
+  nn_index.search(queries, args.k)
+  index_time = (time.time() - start_time) / len(queries)
+  start_time = time.time()
+  for query in queries:
+    hamming.knn_linear(codes, query, args.k)
+  linear_time = (time.time() - start_time) / len(queries)
+  print '{}-NN query: {:.3f}ms (index), {:.3f}ms (linear scan)'.format(
+      args.k, 1000 * index_time, 1000 * linear_time)
+
+def export_latents(args):
+  from models.export import export_latents as export_model_latents
+  X_train, _, X_val, _ = load_dataset(args.dataset)
+  X = X_train if args.split == 'train' else X_val
+  model = make_model(args)
+  model.load(args.checkpoint)
+  fnames = export_model_latents(model, X, args.out, args.method,
+                                batchsize=args.n_batch, superbatch=args.n_superbatch)
+  print 'Wrote {}'.format(', '.join(fnames))
+
+def sample_slice(job):
+  import numpy as np
+  args, start, stop = job
+  model = make_model(args)
+  model.load(args.checkpoint)
+  out = np.load(args.out, mmap_mode='r+')
+  for idx1, idx2, X in model.iterate_samples(args.n, args.chunk, args.seed, start, stop):
+    out[idx1:idx2] = X
+  out.flush()
+
+def sample(args):
+  import time
+  import numpy as np
+  import multiprocessing
+  n_dim, _, n_channels = DATASET_DIMS[args.dataset]
+  out = np.lib.format.open_memmap(args.out, mode='w+', dtype='float32',
+                                  shape=(args.n, n_channels * n_dim * n_dim))
+  del out
+
+  # split the chunks into one contiguous slice per worker
+  n_chunks = (args.n + args.chunk - 1) // args.chunk
+  bounds = [args.chunk * (i * n_chunks // args.workers) for i in range(args.workers + 1)]
+  jobs = [(args, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+  start_time = time.time()
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    pool.map(sample_slice, jobs)
+    pool.close()
+  else:
+    sample_slice(jobs[0])
+  print 'Drew {} samples in {:.3f}s'.format(args.n, time.time() - start_time)
+
+def query(args):
+  from util.registry import Registry
+  registry = Registry(args.registry)
+  if args.ingest:
+    n_read, skipped = registry.ingest(args.ingest)
+    for fname, reason in skipped:
+      print 'Skipped {}: {}'.format(fname, reason)
+    print 'Ingested {} new or changed logs'.format(n_read)
+
+  filters = dict((key, getattr(args, key)) for key in ['dataset', 'model', 'alg', 'status']
+                 if getattr(args, key) is not None)
+  try:
+    runs = registry.query(filters, args.where, args.order, args.desc, args.limit)
+  except ValueError as e:
+    raise SystemExit('query: %s' % e)
+  finally:
+    registry.close()
+
+  print '{:<48}{:>10}{:>10}{:>8}{:>12}{:>12}'.format(
+      'logname', 'model', 'lr', 'epochs', 'best err', 'best acc')
+  for run in runs:
+    print '{:<48}{:>10}{:>10}{:>8}{:>12.6f}{:>12.6f}'.format(
+        run['logname'][-48:], run['model'], run['lr'], run['n_epochs'],
+        run['best_val_err'] or float('nan'), run['best_val_acc'] or float('nan'))
+
+def bench(args):
+  suite.bench(args)
+
+def flops(args):
+  from models import flops as cost
+  model = make_model(args)
+  costs = cost.count(model)
+  for line in cost.format_costs(costs):
+    print line
+
+  if args.measure:
+    _, n_out, _ = DATASET_DIMS[args.dataset]
+    X, Y = suite.load_synthetic(model, args.n_superbatch, n_out)
+    (b, train), _ = suite.step_throughput(model, X, Y, args.n_batch, args.measure)
+    print 'batch {}: {:.1f} examples/s, {:.2f} GFLOP/s (training counted as {}x forward)'.format(
+      b, train, cost.train_gflops(costs, train), cost.TRAIN_FACTOR)
+
+def tune_threads(args):
+  import os
+  run_py = os.path.abspath(__file__)
+  best = tune.tune(args.model, args.dataset, args.batch_sizes, args.steps,
+                   args.threads, args.conv, run_py)
+  if not best:
+    raise ValueError('Every trial failed')
+  tune.save_profile(args.model, args.dataset, best, args.profile)
+  for b in sorted(best):
+    print 'batch {}: {threads} threads, openmp={openmp}, conv={conv} ({examples_per_sec:.0f}/s)'.format(
+      b, **best[b])
+  print 'Saved to {}'.format(args.profile)
 
 def plot(args):
   curves = []
@@ -135,28 +563,78 @@ def plot(args):
     curves.append( (x,y) )
 
   if args.type == 'two':
-    fig.plot_many(args.out, curves, names=[], double=args.double)
+    fig.plot_many(args.out, curves, names=[], double=args.double,
+                  max_points=args.max_points)
   elif args.type == 'many':
-    fig.plot_many(args.out, curves, args.logfiles, double=args.double)
+    fig.plot_many(args.out, curves, args.logfiles, double=args.double,
+                  max_points=args.max_points)
   elif args.type == 'one-vs-many':
     main_curve = curves[0]
     other_curves = curves[1:]
     double_main = True if args.double else False
-    fig.plot_one_vs_many(args.out, main_curve, other_curves, double_main)
+    fig.plot_one_vs_many(args.out, main_curve, other_curves, double_main,
+                         max_points=args.max_points)
   elif args.type == 'many-vs-many':
     curves2 = []
     for f in args.log2:
       x, y = fig.parselog(f, yi=args.col)
       curves2.append( (x,y) )
     double1, double2 = (0 in args.double), (1 in args.double)
-    fig.plot_many_vs_many(args.out, curves, curves2, double1, double2)
+    fig.plot_many_vs_many(args.out, curves, curves2, double1, double2,
+                          max_points=args.max_points)
+  elif args.type == 'bands':
+    # one band for the logs and, if given, one for the --log2 logs
+    groups, names = [curves], ['logfiles']
+    if args.log2:
+      groups.append([fig.parselog(f, yi=args.col) for f in args.log2])
+      names.append('log2')
+    # the error-curve range only suits the default accuracy column
+    ylim = (0, 0.05) if args.col == 2 else None
+    fig.plot_bands(args.out, groups, names, double=args.double, ylim=ylim)
+
+# defaults of the plot command, for figures in a plot-batch spec
+PLOT_DEFAULTS = dict(type='two', double=[0], col=2, log2=None, max_points=2000)
+
+def render(spec):
+  opts = dict(PLOT_DEFAULTS, **spec)
+  plot(argparse.Namespace(**opts))
+  return opts['out']
+
+def plot_batch(args):
+  import json
+  import time
+  import multiprocessing
+  with open(args.spec) as f:
+    specs = json.load(f)
+
+  start_time = time.time()
+  pool = multiprocessing.Pool(args.workers)
+  try:
+    for out in pool.imap_unordered(render, specs):
+      print 'Wrote {}'.format(out)
+  finally:
+    pool.close()
+    pool.join()
+  print 'Rendered {} figures in {:.3f}s'.format(len(specs), time.time() - start_time)
 
 def grid(args):
   launch.print_grid(args)
 
 def main():
+  import os
   parser = make_parser()
   args = parser.parse_args()
+
+  # thread settings only take effect in a fresh process, so restart in one;
+  # threads set explicitly in the environment win over the profile
+  if (args.func == train and args.tune_profile and tune.TUNED_VAR not in os.environ
+      and not any(var in os.environ for var in tune.THREAD_VARS)):
+    settings = tune.lookup(args.model, args.dataset, args.n_batch, args.tune_profile)
+    if settings:
+      print 'Using tuned settings: {} threads, openmp={}, conv={}'.format(
+        settings['threads'], settings['openmp'], settings.get('conv', 'corrmm'))
+      tune.restart_with(settings)
+
   args.func(args)
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+import ctypes
+import traceback
+import multiprocessing
+import multiprocessing.sharedctypes
+from collections import deque
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# transformations
+
+def crop_flip(X, pad, flip, rng, out=None):
+  """Random crops of zero-padded images, each mirrored with probability 1/2
+
+  X is (n, channels, height, width). Every example is shifted by up to pad
+  pixels in each direction, with zeros filling in. Examples are grouped by
+  shift so that each group is copied with one slice assignment, without
+  building the padded images.
+  """
+  n, n_chan, h, w = X.shape
+  if out is None:
+    out = np.empty_like(X)
+  out[...] = 0
+
+  shift = rng.randint(2 * pad + 1, size=(n, 2)) - pad
+  keys = (shift[:, 0] + pad) * (2 * pad + 1) + shift[:, 1] + pad
+  for key in np.unique(keys):
+    idx = np.flatnonzero(keys == key)
+    dy, dx = shift[idx[0]]
+    out[idx, :, max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)] = \
+      X[idx, :, max(0, dy):h - max(0, -dy), max(0, dx):w - max(0, -dx)]
+
+  if flip:
+    mirror = np.flatnonzero(rng.rand(n) < 0.5)
+    out[mirror] = out[mirror, :, :, ::-1]
+  return out
+
+# ----------------------------------------------------------------------------
+# worker pool
+
+def _work(X, buffers, tasks, done, pad, flip):
+  views = [np.frombuffer(buf, dtype=X.dtype).reshape((-1,) + X.shape[1:]) for buf in buffers]
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    i, indices, seed = task
+    try:
+      crop_flip(X[indices], pad, flip, np.random.RandomState(seed),
+                out=views[i][:len(indices)])
+      done.put((i, None))
+    except Exception:
+      done.put((i, traceback.format_exc()))
+
+class Augmenter(object):
+  """Augments superbatches of X on worker processes ahead of training
+
+  Workers are forked with X, crop and flip each superbatch into one of
+  n_buffers shared-memory buffers and the buffers are handed out in order,
+  so up to n_buffers superbatches are prepared while the model trains on
+  the current one. A buffer is reused once the consumer asks for the next
+  superbatch, so it must copy the data out first (load_data does).
+  """
+  def __init__(self, X, Y, batchsize, pad=4, flip=True, n_workers=2, n_buffers=None):
+    assert X.ndim == 4, 'augmentation needs (n, channels, height, width) images'
+    self.X, self.Y = X, Y
+    self.batchsize = batchsize
+    n_buffers = n_buffers or n_workers + 1
+
+    nbytes = batchsize * X[0].nbytes
+    self._buffers = [multiprocessing.sharedctypes.RawArray(ctypes.c_char, nbytes)
+                     for i in range(n_buffers)]
+    self._views = [np.frombuffer(buf, dtype=X.dtype).reshape((-1,) + X.shape[1:])
+                   for buf in self._buffers]
+    self._tasks = multiprocessing.Queue()
+    self._done = multiprocessing.Queue()
+    self._workers = [multiprocessing.Process(
+                       target=_work, name='augment-%d' % i,
+                       args=(X, self._buffers, self._tasks, self._done, pad, flip))
+                     for i in range(n_workers)]
+    for worker in self._workers:
+      worker.daemon = True
+      worker.start()
+
+  def epoch(self, shuffle=True):
+    """Yield augmented (X, Y) superbatches covering X once, like iterate_minibatches"""
+    order = np.random.permutation(len(self.X)) if shuffle else np.arange(len(self.X))
+    batches = deque(order[i:i + self.batchsize]
+                    for i in range(0, len(self.X) - self.batchsize + 1, self.batchsize))
+    free = deque(range(len(self._buffers)))
+    pending, finished = deque(), {}
+
+    try:
+      while batches or pending:
+        # keep every free buffer busy
+        while batches and free:
+          i, indices = free.popleft(), batches.popleft()
+          self._tasks.put((i, indices, np.random.randint(2 ** 31 - 1)))
+          pending.append((i, indices))
+
+        i, indices = pending.popleft()
+        while i not in finished:
+          j, error = self._done.get()
+          finished[j] = error
+        error = finished.pop(i)
+        if error is not None:
+          raise RuntimeError('augmentation failed:\n' + error)
+        yield self._views[i][:len(indices)], self.Y[indices]
+        free.append(i)
+    finally:
+      # let work still in flight finish before its buffers are reused
+      for i, indices in pending:
+        while i not in finished:
+          j, error = self._done.get()
+          finished[j] = error
+
+  def close(self):
+    for worker in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join()
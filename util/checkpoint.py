@@ -0,0 +1,124 @@
+import os
+import struct
+import zipfile
+import threading
+import Queue
+from collections import OrderedDict
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# uncompressed .npz files with memory-mappable members
+
+def save_npz(fname, arrays):
+  """Write a dict of arrays to an uncompressed .npz file
+
+  The file is written next to its destination and renamed into place, so an
+  interrupted write never leaves a truncated checkpoint behind.
+  """
+  tmpname = fname + '.tmp'
+  with open(tmpname, 'wb') as f:
+    np.savez(f, **arrays)
+  os.rename(tmpname, fname)
+
+def load_npz(fname, mmap_mode='r'):
+  """Load a dict of arrays from an uncompressed .npz file
+
+  With mmap_mode set, every non-empty array is returned as a np.memmap into
+  the archive, so nothing is read until it is used.
+  """
+  if mmap_mode is None:
+    data = np.load(fname)
+    try:
+      return OrderedDict((name, data[name]) for name in data.files)
+    finally:
+      data.close()
+
+  with zipfile.ZipFile(fname) as zf:
+    infos = zf.infolist()
+
+  arrays = OrderedDict()
+  with open(fname, 'rb') as f:
+    for info in infos:
+      if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('%s: %s is compressed and cannot be memory-mapped'
+                         % (fname, info.filename))
+
+      # skip the zip local file header to reach the .npy payload
+      f.seek(info.header_offset)
+      name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+      f.seek(info.header_offset + 30 + name_len + extra_len)
+
+      version = np.lib.format.read_magic(f)
+      if version == (1, 0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+      else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+      if dtype.hasobject:
+        raise ValueError('%s: %s holds Python objects' % (fname, info.filename))
+
+      name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+      size = int(np.prod(shape))
+      if size == 0 or shape == ():
+        arrays[name] = np.fromfile(f, dtype=dtype, count=size).reshape(shape)
+      else:
+        arrays[name] = np.memmap(fname, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+                                 shape=shape, order='F' if fortran else 'C')
+  return arrays
+
+# ----------------------------------------------------------------------------
+# random number generator state
+
+def pack_rng(rng_state, prefix):
+  """Store a np.random.RandomState state tuple as plain arrays"""
+  _, keys, pos, has_gauss, cached_gaussian = rng_state
+  return OrderedDict([
+    (prefix + '.keys', np.array(keys, dtype=np.uint32)),
+    (prefix + '.pos', np.array([pos, has_gauss], dtype=np.int64)),
+    (prefix + '.gauss', np.array([cached_gaussian], dtype=np.float64)),
+  ])
+
+def unpack_rng(arrays, prefix):
+  """Inverse of pack_rng; returns a tuple for RandomState.set_state"""
+  pos, has_gauss = arrays[prefix + '.pos']
+  return ('MT19937', np.array(arrays[prefix + '.keys']), int(pos), int(has_gauss),
+          float(arrays[prefix + '.gauss'][0]))
+
+# ----------------------------------------------------------------------------
+# background writer
+
+class CheckpointWriter(object):
+  """Writes checkpoints on a background thread
+
+  At most one checkpoint is pending at a time: save() blocks while the
+  previous write is still queued, which bounds the memory held by snapshots.
+  """
+  def __init__(self):
+    self.error = None
+    self._queue = Queue.Queue(maxsize=1)
+    self._thread = threading.Thread(target=self._run, name='checkpoint-writer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def save(self, fname, arrays):
+    """Queue a write; arrays must be private copies the caller won't modify"""
+    if self.error is not None:
+      raise self.error
+    self._queue.put((fname, arrays))
+
+  def close(self):
+    """Wait for pending writes to finish"""
+    self._queue.put(None)
+    self._thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      try:
+        save_npz(*item)
+      except Exception as e:
+        self.error = e
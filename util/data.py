@@ -13,6 +13,44 @@ def whiten(X_train, X_valid):
   X_valid = (X_valid - offset) / scale
   return X_train, X_valid
 
+# random streams of a DynamicBinarizer; each superbatch gets one of its own
+STREAMS = {'train': 0, 'val': 1, 'eval-train': 2, 'eval-val': 3}
+
+def binarize(X, rng, dtype='float32', out=None):
+  """Bernoulli draw of every pixel, with grey level as the probability
+
+  X holds either floats in [0, 1] or the raw uint8 bytes of load_mnist
+  (level v is then on with probability v / 256, like the float version).
+  """
+  if out is None:
+    out = np.empty(X.shape, dtype=dtype)
+  if X.dtype == np.uint8:
+    noise = np.frombuffer(rng.bytes(X.size), dtype=np.uint8).reshape(X.shape)
+    np.less(noise, X, out=out)
+  else:
+    np.less(rng.random_sample(X.shape), X, out=out)
+  return out
+
+class DynamicBinarizer(object):
+  """Binarizes data a superbatch at a time, with fresh draws every epoch
+
+  The draw for a superbatch is seeded by (seed, stream, epoch, index), so it
+  is reproducible (also when resuming) without keeping a binarized copy.
+  """
+  def __init__(self, seed=0, dtype='float32'):
+    self.seed = seed
+    self.dtype = dtype
+
+  def rng(self, stream, epoch, index):
+    return np.random.RandomState([self.seed, STREAMS[stream], epoch, index])
+
+  def __call__(self, X, stream, epoch, index):
+    return binarize(X, self.rng(stream, epoch, index), self.dtype)
+
+  def stream(self, stream, epoch):
+    """A function (X, index) -> binarized X, for helpers.evaluate"""
+    return lambda X, index: self(X, stream, epoch, index)
+
 # ----------------------------------------------------------------------------
 
 def load_cifar10():
@@ -62,7 +100,8 @@ def load_cifar10():
   return Xtr, Ytr, Xte, Yte
 
 
-def load_mnist():
+def load_mnist(dtype='float32'):
+  """MNIST as floats in [0, 255/256], or as raw bytes if dtype is uint8"""
   # We first define a download function, supporting both Python 2 and 3.
   if sys.version_info[0] == 2:
     from urllib import urlretrieve
@@ -86,6 +125,8 @@ def load_mnist():
     # The inputs are vectors now, we reshape them to monochrome 2D images,
     # following the shape convention: (examples, channels, rows, columns)
     data = data.reshape(-1, 1, 28, 28)
+    if dtype == 'uint8':
+      return data
     # The inputs come as bytes, we convert them to float32 in range [0,1].
     # (Actually to range [0, 255/256], for compatibility to the version
     # provided at http://deeplearning.net/data/mnist/mnist.pkl.gz.)
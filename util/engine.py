@@ -0,0 +1,330 @@
+import json
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from util.checkpoint import load_npz
+from util.quantize import dequantize
+
+# ----------------------------------------------------------------------------
+# nonlinearities, applied in place
+
+def _sigmoid(a, value=None):
+  np.negative(a, out=a)
+  np.exp(a, out=a)
+  a += 1
+  np.reciprocal(a, out=a)
+
+def _softmax(a, value=None):
+  a -= a.max(axis=-1, keepdims=True)
+  np.exp(a, out=a)
+  a /= a.sum(axis=-1, keepdims=True)
+
+NONLINEARITIES = {
+  'identity': lambda a, value=None: None,
+  'relu': lambda a, value=None: np.maximum(a, 0, out=a),
+  'sigmoid': _sigmoid,
+  'tanh': lambda a, value=None: np.tanh(a, out=a),
+  'softplus': lambda a, value=None: np.logaddexp(0, a, out=a),
+  'softmax': _softmax,
+  'floor': lambda a, value=None: np.maximum(a, value, out=a),
+}
+
+def apply_nonlinearity(spec, a):
+  NONLINEARITIES[spec['name']](a, spec.get('value'))
+
+# ----------------------------------------------------------------------------
+# plan optimization
+
+def _consumers(plan):
+  """Number of uses of each buffer id (outputs count as a use)"""
+  uses = dict((i, 0) for i in [0] + [op['id'] for op in plan['ops']])
+  for op in plan['ops']:
+    for i in op['inputs']:
+      uses[i] += 1
+  for i in plan['outputs']:
+    uses[i] += 1
+  return uses
+
+def _replace_uses(plan, old, new):
+  for op in plan['ops']:
+    op['inputs'] = [new if i == old else i for i in op['inputs']]
+  plan['outputs'] = [new if i == old else i for i in plan['outputs']]
+
+def drop_identities(plan, weights):
+  """Remove pass-through ops (dropout, sample means, identity nonlinearities)"""
+  for op in list(plan['ops']):
+    if op['op'] == 'identity' or (op['op'] == 'nonlinearity'
+                                  and op['nonlinearity']['name'] == 'identity'):
+      _replace_uses(plan, op['id'], op['inputs'][0])
+      plan['ops'].remove(op)
+
+def fold_affine(plan, weights):
+  """Fold per-channel affine ops (deterministic batch norm) into the
+  preceding linear conv or dense op's weights and bias"""
+  ops = dict((op['id'], op) for op in plan['ops'])
+  uses = _consumers(plan)
+  for op in list(plan['ops']):
+    if op['op'] != 'affine': continue
+    src = ops.get(op['inputs'][0])
+    if src is None or src['op'] not in ('conv', 'dense') or uses[src['id']] != 1 \
+        or src['nonlinearity']['name'] != 'identity':
+      continue
+
+    scale, shift = weights[op['scale']], weights[op['shift']]
+    axis = 1 # output channels / units
+    if scale.size != scale.shape[axis] or shift.size != shift.shape[axis]:
+      continue
+    scale, shift = scale.reshape(-1), shift.reshape(-1)
+
+    W = np.asarray(weights[src['W']])
+    if W.dtype != np.dtype(plan['dtype']):
+      continue # quantized weights stay as they are
+    if src['op'] == 'conv':
+      W = W * scale[:, None, None, None]
+    else:
+      W = W * scale[None, :]
+    b = np.asarray(weights[src['b']]) if 'b' in src else np.zeros_like(shift)
+    weights[src['W']] = W
+    src.setdefault('b', src['W'].rsplit('.', 1)[0] + '.b')
+    weights[src['b']] = (b * scale + shift).astype(W.dtype)
+
+    _replace_uses(plan, op['id'], src['id'])
+    plan['ops'].remove(op)
+
+def fuse_nonlinearities(plan, weights):
+  """Apply nonlinearity ops inside the conv, dense or sum op feeding them"""
+  ops = dict((op['id'], op) for op in plan['ops'])
+  uses = _consumers(plan)
+  for op in list(plan['ops']):
+    if op['op'] != 'nonlinearity': continue
+    src = ops.get(op['inputs'][0])
+    if src is None or src['op'] not in ('conv', 'dense', 'sum') or uses[src['id']] != 1:
+      continue
+    if src.get('nonlinearity', {'name': 'identity'})['name'] != 'identity':
+      continue
+    src['nonlinearity'] = op['nonlinearity']
+    _replace_uses(plan, op['id'], src['id'])
+    plan['ops'].remove(op)
+
+def prune_weights(plan, weights):
+  used = set(v for op in plan['ops'] for v in op.values() if isinstance(v, basestring))
+  for key in list(weights):
+    if key not in used:
+      del weights[key]
+
+PASSES = [drop_identities, fold_affine, fuse_nonlinearities, prune_weights]
+
+def optimize(plan, weights, passes=PASSES):
+  """Rewrite a plan (and its weights) in place for faster inference"""
+  for f in passes:
+    f(plan, weights)
+  return plan, weights
+
+# ----------------------------------------------------------------------------
+# runtime
+
+class Engine(object):
+  """Runs a layer plan written by models.export with NumPy only
+
+  Activation buffers are allocated for the largest batch seen so far and
+  smaller batches use their leading rows, so steady-state scoring does no
+  allocation besides BLAS scratch space.
+  """
+  def __init__(self, plan, weights, seed=None):
+    self.plan = plan
+    self.weights = weights
+    self.dtype = np.dtype(plan.get('dtype', 'float32'))
+    self.rng = np.random.RandomState(seed)
+    self._buffers = {}
+
+  @classmethod
+  def load(cls, fname, seed=None):
+    """Load an exported plan; weights stay memory-mapped until first use"""
+    weights = load_npz(fname)
+    plan = json.loads(np.asarray(weights.pop('plan')).tobytes())
+    return cls(plan, weights, seed)
+
+  @property
+  def method(self):
+    return self.plan['method']
+
+  def __call__(self, X, batchsize=256, out=None):
+    """Run the plan over X in chunks; the output layout matches apply_inference"""
+    outs = None if out is None else (out if isinstance(out, list) else [out])
+    for idx1 in range(0, len(X), batchsize):
+      idx2 = min(idx1 + batchsize, len(X))
+      Ys = self.run(X[idx1:idx2])
+      if outs is None:
+        outs = [np.empty((len(X),) + Y.shape[1:], dtype=Y.dtype) for Y in Ys]
+      for o, Y in zip(outs, Ys):
+        o[idx1:idx2] = Y
+    if outs is None:
+      outs = [np.empty((0,), dtype=self.dtype)]
+    return outs[0] if self.plan['single_output'] else outs
+
+  def run(self, X):
+    """Outputs for one batch, as (n, -1) views of internal buffers"""
+    n = len(X)
+    bufs = self._buffers
+    shape = [n] + list(self.plan['input_shape'][1:])
+    values = {0: np.asarray(X, dtype=self.dtype).reshape(shape)}
+    for op in self.plan['ops']:
+      inputs = [values[i] for i in op['inputs']]
+      values[op['id']] = getattr(self, '_' + op['op'])(op, inputs, bufs)
+    return [values[i].reshape(n, -1) for i in self.plan['outputs']]
+
+  def _buffer(self, bufs, key, shape, fill=None):
+    """Leading rows of a reusable buffer; shape[0] scales with the batch"""
+    shape = tuple(shape)
+    buf = bufs.get(key)
+    if buf is None or buf.shape[1:] != shape[1:] or len(buf) < shape[0]:
+      buf = bufs[key] = np.empty(shape, dtype=self.dtype)
+      if fill is not None:
+        buf.fill(fill)
+    return buf[:shape[0]]
+
+  # --------------------------------------------------------------------------
+  # ops
+
+  def _weight(self, op, bufs):
+    W = self.weights[op['W']]
+    if W.dtype == self.dtype:
+      return W
+    # quantized weights are expanded into a scratch buffer per weight shape,
+    # so only one float copy of each shape is resident at a time
+    scale = self.weights[op['W_scale']] if 'W_scale' in op else None
+    out = self._buffer(bufs, ('dequantized',) + W.shape, W.shape)
+    return dequantize(W, scale, out=out)
+
+  def _dense(self, op, inputs, bufs):
+    x = inputs[0]
+    x = x.reshape(len(x), -1)
+    W = self._weight(op, bufs)
+    out = self._buffer(bufs, op['id'], (len(x), W.shape[1]))
+    np.dot(x, W, out=out)
+    if 'b' in op:
+      out += self.weights[op['b']]
+    apply_nonlinearity(op['nonlinearity'], out)
+    return out
+
+  def _pad_spatial(self, op, x, bufs, pad, fill):
+    if not any(pad):
+      return x
+    n, c, h, w = x.shape
+    ph, pw = pad
+    xp = self._buffer(bufs, (op['id'], 'pad'), (n, c, h + 2*ph, w + 2*pw), fill=fill)
+    xp[:, :, ph:ph+h, pw:pw+w] = x
+    return xp
+
+  def _windows(self, x, size, stride):
+    """(n, c, oh, ow, kh, kw) view of the sliding windows of x"""
+    n, c, h, w = x.shape
+    (kh, kw), (sh, sw) = size, stride
+    oh, ow = (h - kh) // sh + 1, (w - kw) // sw + 1
+    s0, s1, s2, s3 = x.strides
+    return as_strided(x, (n, c, oh, ow, kh, kw),
+                      (s0, s1, s2 * sh, s3 * sw, s2, s3))
+
+  def _conv(self, op, inputs, bufs):
+    # im2col: gather the windows into a matrix, then one GEMM
+    W = self._weight(op, bufs)
+    f, c, kh, kw = W.shape
+    x = self._pad_spatial(op, np.ascontiguousarray(inputs[0]), bufs, op['pad'], 0)
+    windows = self._windows(x, (kh, kw), op['stride'])
+    n, _, oh, ow, _, _ = windows.shape
+
+    cols = self._buffer(bufs, (op['id'], 'cols'), (n, oh, ow, c, kh, kw))
+    cols[...] = windows.transpose(0, 2, 3, 1, 4, 5)
+    gemm = self._buffer(bufs, (op['id'], 'gemm'), (n * oh * ow, f))
+    np.dot(cols.reshape(n * oh * ow, -1), W.reshape(f, -1).T, out=gemm)
+    if 'b' in op:
+      gemm += self.weights[op['b']]
+    apply_nonlinearity(op['nonlinearity'], gemm)
+
+    out = self._buffer(bufs, op['id'], (n, f, oh, ow))
+    out[...] = gemm.reshape(n, oh, ow, f).transpose(0, 3, 1, 2)
+    return out
+
+  def _maxpool(self, op, inputs, bufs):
+    x = self._pad_spatial(op, inputs[0], bufs, op['pad'], -np.inf)
+    windows = self._windows(x, op['pool_size'], op['stride'])
+    out = self._buffer(bufs, op['id'], windows.shape[:4])
+    return windows.max(axis=(4, 5), out=out)
+
+  def _affine(self, op, inputs, bufs):
+    out = self._buffer(bufs, op['id'], inputs[0].shape)
+    np.multiply(inputs[0], self.weights[op['scale']], out=out)
+    out += self.weights[op['shift']]
+    return out
+
+  def _sum(self, op, inputs, bufs):
+    out = self._buffer(bufs, op['id'], inputs[0].shape)
+    np.multiply(inputs[0], op['coeffs'][0], out=out)
+    for coeff, x in zip(op['coeffs'][1:], inputs[1:]):
+      out += x if coeff == 1 else coeff * x
+    if 'nonlinearity' in op:
+      apply_nonlinearity(op['nonlinearity'], out)
+    return out
+
+  def _nonlinearity(self, op, inputs, bufs):
+    out = self._buffer(bufs, op['id'], inputs[0].shape)
+    out[...] = inputs[0]
+    apply_nonlinearity(op['nonlinearity'], out)
+    return out
+
+  def _globalpool(self, op, inputs, bufs):
+    x = inputs[0]
+    x = x.reshape(x.shape[0], x.shape[1], -1)
+    out = self._buffer(bufs, op['id'], x.shape[:2])
+    return getattr(np, op['function'])(x, axis=2, out=out)
+
+  def _reshape(self, op, inputs, bufs):
+    x = inputs[0]
+    shape = [x.shape[s[0]] if isinstance(s, list) else s for s in op['shape']]
+    return x.reshape(shape)
+
+  def _flatten(self, op, inputs, bufs):
+    x = inputs[0]
+    return x.reshape(x.shape[:op['outdim'] - 1] + (-1,))
+
+  def _pad(self, op, inputs, bufs):
+    x, batch_ndim = inputs[0], op['batch_ndim']
+    shape, index = list(x.shape[:batch_ndim]), [slice(None)] * batch_ndim
+    for size, (before, after) in zip(x.shape[batch_ndim:], op['width']):
+      shape.append(before + size + after)
+      index.append(slice(before, before + size))
+    out = self._buffer(bufs, op['id'], shape, fill=op['val'])
+    out[tuple(index)] = x
+    return out
+
+  def _slice(self, op, inputs, bufs):
+    return inputs[0][tuple(slice(a, None, s) for a, s in op['index'])]
+
+  def _identity(self, op, inputs, bufs):
+    return inputs[0]
+
+  def _bernoulli(self, op, inputs, bufs):
+    out = self._buffer(bufs, op['id'], inputs[0].shape)
+    out[...] = self.rng.random_sample(out.shape) < inputs[0]
+    return out
+
+  def _gumbel_softmax(self, op, inputs, bufs):
+    eps = op['eps']
+    out = self._buffer(bufs, op['id'], inputs[0].shape)
+    out[...] = self.rng.random_sample(out.shape)
+    out += eps
+    np.log(out, out=out)
+    np.negative(out, out=out)
+    out += eps
+    np.log(out, out=out)
+    np.subtract(inputs[0], out, out=out)
+    out /= op['tau']
+    if op['straight_through']:
+      flat = out.reshape(-1, out.shape[-1])
+      top = flat.argmax(axis=-1)
+      flat.fill(0)
+      flat[np.arange(len(flat)), top] = 1
+    else:
+      _softmax(out)
+    return out
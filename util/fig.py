@@ -1,23 +1,156 @@
+import os
+import zipfile
+import tempfile
 import numpy as np
 
+from util.metrics import is_binary_log, read_binary_log
+
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
 # ----------------------------------------------------------------------------
+# reading logs
+
+# parsed text logs by file name: (mtime, size, array)
+_log_cache = {}
 
 def parselog(fname, xi=0, yi=2):
-  x, y = [], []
+  log = readlog(fname)
+  if not len(log):
+    # an empty log has no columns to pick from
+    return np.zeros(0), np.zeros(0)
+  return np.array(log[:, xi]), np.array(log[:, yi])
+
+def readlog(fname):
+  """All records of a metrics log as an (n_records, n_fields) array
+
+  Binary logs are memory-mapped. Text logs are parsed in one pass and the
+  result is cached in memory and in <fname>.cache.npz, both keyed by the
+  log's mtime and size, so unchanged logs are only parsed once. The cache
+  file is written to a temporary file and renamed into place, and one
+  that cannot be read is treated as missing, so concurrent readers (e.g.
+  plot-batch workers) never see a partial cache.
+  """
+  if is_binary_log(fname):
+    return read_binary_log(fname)
+
+  stat = os.stat(fname)
+  key = (stat.st_mtime, stat.st_size)
+  if fname in _log_cache and _log_cache[fname][0] == key:
+    return _log_cache[fname][1]
+
+  cache = fname + '.cache.npz'
+  log = _read_cache(cache, key)
+  if log is None:
+    log = _parse_tsv(fname)
+    _write_cache(cache, key, log)
+
+  _log_cache[fname] = (key, log)
+  return log
+
+def _read_cache(cache, key):
+  """The cached log if cache exists, is readable and matches key, else None"""
+  if not os.path.exists(cache):
+    return None
+  try:
+    with np.load(cache) as arrays:
+      if tuple(arrays['key']) == key:
+        return arrays['log']
+  except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipfile):
+    pass # written by an older version, or corrupted
+  return None
+
+def _write_cache(cache, key, log):
+  try:
+    fd, tmp = tempfile.mkstemp(suffix='.npz', prefix='.tmp-',
+                               dir=os.path.dirname(os.path.abspath(cache)))
+  except (IOError, OSError):
+    return # e.g. a read-only log directory
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      np.savez(f, key=np.array(key), log=log)
+    os.rename(tmp, cache)
+  except (IOError, OSError):
+    pass
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+def _parse_tsv(fname):
   with open(fname) as f:
-    for line in f:
-      fields = line.strip().split()
-      x.append(float(fields[xi]))
-      y.append(float(fields[yi]))
-  return np.array(x), np.array(y)
+    text = f.read()
+
+  # drop a last line that is still being written
+  text = text[:text.rfind('\n') + 1]
+  if not text:
+    return np.zeros((0, 0))
+  n_fields = len(text[:text.index('\n')].split())
+  return np.array(text.split(), dtype=np.float64).reshape(-1, n_fields)
+
+# ----------------------------------------------------------------------------
+# downsampling
+
+def downsample(x, y, n_out):
+  """Largest-Triangle-Three-Buckets: n_out points that keep the curve's shape
+
+  Keeps the first and last point and, in each of n_out - 2 equal buckets in
+  between, the point forming the largest triangle with the point kept in the
+  previous bucket and the mean of the next bucket.
+  (Steinarsson, Downsampling Time Series for Visual Representation)
+  """
+  n = len(x)
+  if n_out >= n or n_out < 3:
+    return x, y
+
+  # bucket boundaries and the mean of every bucket
+  edges = (1 + np.arange(n_out - 1) * (n - 2) / float(n_out - 2)).astype(int)
+  edges[-1] = n - 1
+  counts = np.diff(edges)
+  mean_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts
+  mean_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / counts
+  mean_x = np.append(mean_x, x[-1])
+  mean_y = np.append(mean_y, y[-1])
+
+  keep = np.empty(n_out, dtype=int)
+  keep[0], keep[-1] = 0, n - 1
+  for i in range(n_out - 2):
+    a = keep[i]
+    bx, by = x[edges[i]:edges[i + 1]], y[edges[i]:edges[i + 1]]
+    # twice the triangle areas; the constant factor does not change argmax
+    area = np.abs((x[a] - mean_x[i + 1]) * (by - y[a]) - (x[a] - bx) * (mean_y[i + 1] - y[a]))
+    keep[i + 1] = edges[i] + np.argmax(area)
+  return x[keep], y[keep]
+
+def _downsample(curves, n_out):
+  if not n_out:
+    return curves
+  return [downsample(x, y, n_out) for x, y in curves]
+
+# ----------------------------------------------------------------------------
+# aggregation
+
+def align(curves, n_grid=500):
+  """Interpolate curves onto n_grid points of the x range they all cover"""
+  lo = max(x[0] for x, y in curves)
+  hi = min(x[-1] for x, y in curves)
+  if hi <= lo:
+    raise ValueError('Curves have no x range in common (%g to %g)' % (lo, hi))
+  grid = np.linspace(lo, hi, n_grid)
+  return grid, np.array([np.interp(grid, x, y) for x, y in curves])
+
+def bands(curves, quantiles=(10, 90), n_grid=500):
+  """Mean and lower/upper percentiles of curves across runs (e.g. seeds)"""
+  grid, Y = align(curves, n_grid)
+  lo, hi = np.percentile(Y, quantiles, axis=0)
+  return grid, Y.mean(axis=0), lo, hi
+
+# ----------------------------------------------------------------------------
+# plotting
 
-def plot_many(fname, curves, names=None, double=[]):
+def plot_many(fname, curves, names=None, double=[], max_points=2000):
   plt.figure(figsize=(12,8))
-  curves = _flip_and_stretch(curves, double)
+  curves = _downsample(_flip_and_stretch(curves, double), max_points)
 
   plt_list = [itm for lst in curves for itm in lst]
   plt.plot(*plt_list)
@@ -29,12 +162,12 @@ def plot_many(fname, curves, names=None, double=[]):
   plt.savefig(fname)
   plt.close()
 
-def plot_one_vs_many(fname, main_curve, curves, double_main=False):
+def plot_one_vs_many(fname, main_curve, curves, double_main=False, max_points=2000):
   plt.figure(figsize=(12,8))
   
   idx = [0] if double_main else []
-  main_curve = _flip_and_stretch([main_curve], idx)[0]
-  curves = _flip_and_stretch(curves)
+  main_curve = _downsample(_flip_and_stretch([main_curve], idx), max_points)[0]
+  curves = _downsample(_flip_and_stretch(curves), max_points)
 
   plt.plot(main_curve[0], main_curve[1])
 
@@ -46,13 +179,14 @@ def plot_one_vs_many(fname, main_curve, curves, double_main=False):
   plt.savefig(fname)
   plt.close()
 
-def plot_many_vs_many(fname, curves1, curves2, double1=False, double2=False):
+def plot_many_vs_many(fname, curves1, curves2, double1=False, double2=False,
+                      max_points=2000):
   plt.figure(figsize=(12,8))
   
   idx = range(len(curves1)) if double1 else []
-  curves1 = _flip_and_stretch(curves1, idx)
+  curves1 = _downsample(_flip_and_stretch(curves1, idx), max_points)
   idx = range(len(curves2)) if double2 else []
-  curves2 = _flip_and_stretch(curves2, idx)
+  curves2 = _downsample(_flip_and_stretch(curves2, idx), max_points)
 
   plt_list = [itm for lst in curves1 for itm in lst]
   plt.plot(*plt_list, alpha=0.25, color='blue')
@@ -66,6 +200,23 @@ def plot_many_vs_many(fname, curves1, curves2, double1=False, double2=False):
   plt.savefig(fname)
   plt.close()
 
+def plot_bands(fname, groups, names=None, double=[], quantiles=(10, 90), ylim=None):
+  """One mean line and percentile band per group of curves; ylim=None autoscales"""
+  plt.figure(figsize=(12,8))
+
+  for i, curves in enumerate(groups):
+    curves = _flip_and_stretch(curves, range(len(curves)) if i in double else [])
+    grid, mean, lo, hi = bands(curves, quantiles)
+    line, = plt.plot(grid, mean)
+    plt.fill_between(grid, lo, hi, color=line.get_color(), alpha=0.25, linewidth=0)
+
+  if ylim: plt.ylim(ylim)
+
+  if names: plt.legend(names, prop={'size':8})
+
+  plt.savefig(fname)
+  plt.close()
+
 def _flip_and_stretch(curves, idx=[]):
   curves2 = list()
   for i, (x,y) in enumerate(curves):
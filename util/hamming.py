@@ -0,0 +1,164 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+from util.checkpoint import save_npz, load_npz
+
+# ----------------------------------------------------------------------------
+# bit packing
+
+def n_words(n_bits):
+  return (n_bits + 63) // 64
+
+def pack_bits(B):
+  """Pack an (n, n_bits) array of 0/1 into (n, n_words) uint64 codes"""
+  B = np.asarray(B, dtype=bool)
+  n, n_bits = B.shape
+  padded = np.zeros((n, 64 * n_words(n_bits)), dtype=bool)
+  padded[:, :n_bits] = B
+  # little-endian bit order within each byte, bytes in word order
+  return np.packbits(padded.reshape(n, -1, 8)[:, :, ::-1], axis=-1) \
+           .reshape(n, -1).view('<u8')
+
+def unpack_bits(codes, n_bits):
+  """Inverse of pack_bits"""
+  codes = np.ascontiguousarray(codes, dtype='<u8')
+  bits = np.unpackbits(codes.view(np.uint8).reshape(len(codes), -1, 1), axis=-1)
+  return bits[:, :, ::-1].reshape(len(codes), -1)[:, :n_bits]
+
+def encode_to_file(encode, binarize, X, fname, n_bits, batchsize=1000):
+  """Encode X in batches and write packed binary codes to an .npy memmap"""
+  codes = np.lib.format.open_memmap(fname, mode='w+', dtype='<u8',
+                                    shape=(len(X), n_words(n_bits)))
+  for idx1 in range(0, len(X), batchsize):
+    idx2 = min(idx1 + batchsize, len(X))
+    codes[idx1:idx2] = pack_bits(binarize(encode(X[idx1:idx2])))
+  codes.flush()
+  return codes
+
+# ----------------------------------------------------------------------------
+# hamming distance
+
+# bits set in every 16-bit value
+_POPCOUNT16 = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+def hamming(codes, query):
+  """Hamming distances between each row of codes and one query code"""
+  x = np.bitwise_xor(codes, query)
+  return _POPCOUNT16[x.view(np.uint16)].sum(axis=1, dtype=np.int32)
+
+def knn_linear(codes, query, k, chunk=1 << 16):
+  """Exact k nearest neighbors by a chunked scan (the baseline for the index)"""
+  best_idx = np.empty(0, dtype=np.int64)
+  best_dist = np.empty(0, dtype=np.int32)
+  for idx1 in range(0, len(codes), chunk):
+    dist = hamming(codes[idx1:idx1 + chunk], query)
+    idx = np.arange(idx1, idx1 + len(dist))
+    best_idx, best_dist = _top_k(np.concatenate([best_idx, idx]),
+                                 np.concatenate([best_dist, dist]), k)
+  return best_idx, best_dist
+
+def _top_k(idx, dist, k):
+  if len(dist) > k:
+    top = np.argpartition(dist, k - 1)[:k]
+    idx, dist = idx[top], dist[top]
+  order = np.argsort(dist, kind='mergesort')
+  return idx[order], dist[order]
+
+# ----------------------------------------------------------------------------
+# multi-index hashing
+
+_SUBSTRING_BITS = 16
+
+def _neighbors16(radius, _cache={}):
+  """XOR masks of all 16-bit values at exactly the given Hamming distance"""
+  if radius not in _cache:
+    masks = [sum(1 << b for b in bits)
+             for bits in itertools.combinations(range(_SUBSTRING_BITS), radius)]
+    _cache[radius] = np.array(masks, dtype=np.uint16)
+  return _cache[radius]
+
+def _ranges(begin, end):
+  """Concatenation of arange(b, e) for every pair"""
+  lengths = end - begin
+  offsets = np.cumsum(lengths) - lengths
+  return np.arange(lengths.sum()) - np.repeat(offsets - begin, lengths)
+
+class HammingIndex(object):
+  """k-NN search over packed binary codes by multi-index hashing
+
+  Codes are split into 16-bit substrings with one sorted table each. A code
+  within distance r of the query matches it within floor(r / m) bits on at
+  least one of its m substrings, so probing substring neighborhoods of
+  growing radius s finds every code within m * (s + 1) - 1 bits; the search
+  stops as soon as the k-th best distance is inside that guarantee.
+  (Norouzi et al., Fast Search in Hamming Space with Multi-Index Hashing)
+  """
+  def __init__(self, codes, n_bits, tables=None, max_radius=3):
+    self.codes = codes
+    self.n_bits = n_bits
+    self.max_radius = max_radius
+    self.tables = tables if tables is not None else self._build(codes, n_bits)
+
+  @staticmethod
+  def _build(codes, n_bits):
+    # substrings made only of padding would match every code
+    substrings = codes.view(np.uint16)
+    tables = []
+    for j in range((n_bits + _SUBSTRING_BITS - 1) // _SUBSTRING_BITS):
+      values = np.ascontiguousarray(substrings[:, j])
+      order = np.argsort(values, kind='mergesort').astype(np.int64)
+      starts = np.searchsorted(values[order], np.arange((1 << 16) + 1))
+      tables.append((order, starts.astype(np.int64)))
+    return tables
+
+  def save(self, fname):
+    arrays = OrderedDict()
+    for j, (order, starts) in enumerate(self.tables):
+      arrays['order%03d' % j] = order
+      arrays['starts%03d' % j] = starts
+    save_npz(fname, arrays)
+
+  @classmethod
+  def load(cls, codes, n_bits, fname, **kwargs):
+    arrays = load_npz(fname)
+    m = len([name for name in arrays if name.startswith('order')])
+    tables = [(arrays['order%03d' % j], arrays['starts%03d' % j]) for j in range(m)]
+    return cls(codes, n_bits, tables, **kwargs)
+
+  def query(self, query, k=10):
+    """Indices and distances of the k codes nearest to query, nearest first"""
+    query = np.asarray(query, dtype='<u8').reshape(1, -1)
+    query_sub = query.view(np.uint16)[0]
+    m = len(self.tables)
+    k = min(k, len(self.codes))
+
+    seen = np.zeros(0, dtype=np.int64)
+    best_idx = np.empty(0, dtype=np.int64)
+    best_dist = np.empty(0, dtype=np.int32)
+    for radius in range(self.max_radius + 1):
+      # gather the items in every bucket at this substring radius
+      candidates = []
+      for j, (order, starts) in enumerate(self.tables):
+        buckets = np.bitwise_xor(_neighbors16(radius), query_sub[j]).astype(np.int64)
+        candidates.append(order[_ranges(starts[buckets], starts[buckets + 1])])
+      candidates = np.setdiff1d(np.concatenate(candidates), seen)
+      if len(candidates):
+        seen = np.union1d(seen, candidates)
+        dist = hamming(self.codes[candidates], query)
+        best_idx, best_dist = _top_k(np.concatenate([best_idx, candidates]),
+                                     np.concatenate([best_dist, dist]), k)
+
+      # everything within this distance has been seen
+      if len(best_idx) == k and best_dist[-1] <= m * (radius + 1) - 1:
+        return best_idx, best_dist
+
+    # neighbors are too far for hashing to pay off; scan instead
+    return knn_linear(self.codes, query, k)
+
+  def search(self, queries, k=10):
+    """query() for each row of queries; returns (n, k) indices and distances"""
+    results = [self.query(q, k) for q in queries]
+    return (np.array([idx for idx, _ in results]),
+            np.array([dist for _, dist in results]))
@@ -0,0 +1,127 @@
+import sys
+import resource
+import threading
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# process memory
+
+def rss_mb():
+  """Current and peak resident set size of this process, in MB"""
+  try:
+    with open('/proc/self/status') as f:
+      fields = dict(line.split(':', 1) for line in f)
+    return (int(fields['VmRSS'].split()[0]) / 1024.,
+            int(fields['VmHWM'].split()[0]) / 1024.)
+  except (IOError, KeyError):
+    # no procfs; ru_maxrss is in kilobytes on Linux but bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    if sys.platform == 'darwin':
+      peak /= 1024.
+    return peak, peak
+
+class RSSSampler(object):
+  """Samples the process RSS every interval seconds on a background thread
+
+  peak is the largest sample since the last reset_peak(); unlike the
+  kernel's high-water mark it can be reset, e.g. at the start of each epoch.
+  """
+  def __init__(self, interval=0.5):
+    self.interval = interval
+    self.current = self.peak = rss_mb()[0]
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='rss-sampler')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def reset_peak(self):
+    self.peak = self.current
+
+  def close(self):
+    self._stop.set()
+    self._thread.join()
+
+  def _run(self):
+    while not self._stop.is_set():
+      self.current = rss_mb()[0]
+      self.peak = max(self.peak, self.current)
+      self._stop.wait(self.interval)
+
+# ----------------------------------------------------------------------------
+# model memory
+
+DATA_BUFFERS = ('train_set_x', 'train_set_y', 'val_set_x', 'val_set_y')
+
+def shared_variables(model):
+  """(name, kind, shape, dtype, bytes) of every shared variable a model uses
+
+  kind is 'data' for the superbatch buffers, 'param' for trainable
+  parameters and 'state' for the rest (optimizer moments, counters,
+  centering signals, random streams).
+  """
+  data = dict((id(getattr(model, name)), name) for name in DATA_BUFFERS
+              if hasattr(model, name))
+  params = set(id(p) for p in model.get_params())
+
+  seen, rows = set(), []
+  for f in model.compiled_functions().values():
+    for inp in f.maker.inputs:
+      var = inp.variable
+      if id(var) in seen or not hasattr(var, 'get_value'): continue
+      seen.add(id(var))
+
+      value = var.get_value(borrow=True)
+      if not isinstance(value, np.ndarray):
+        continue # random states and other non-array containers
+      if id(var) in data:
+        name, kind = data[id(var)], 'data'
+      else:
+        name, kind = var.name or type(var).__name__, 'param' if id(var) in params else 'state'
+      rows.append((name, kind, value.shape, str(value.dtype), value.nbytes))
+  return rows
+
+def activation_bytes(model, n_batch):
+  """Bytes of the Lasagne layer outputs for one minibatch: (forward, train)
+
+  forward is the sum of all layer outputs, which training keeps for the
+  backward pass; train adds the largest output again for its gradient. This
+  ignores Theano's temporaries, so treat it as a lower bound. Returns None
+  for models that are not built from Lasagne layers.
+  """
+  import theano
+  from models.helpers import network_layers
+  network = getattr(model, 'network', None)
+  if network is None:
+    return None
+
+  itemsize = np.dtype(theano.config.floatX).itemsize
+  sizes = []
+  for layer in network_layers(network):
+    shape = layer.output_shape[1:]
+    if any(dim is None for dim in shape): continue
+    sizes.append(n_batch * int(np.prod(shape)) * itemsize)
+  if not sizes:
+    return None
+  return sum(sizes), sum(sizes) + max(sizes)
+
+def report(model, n_batch):
+  """Printable summary of a model's shared-variable and activation memory"""
+  rows = shared_variables(model)
+  lines = ['Memory:']
+  for kind in ('data', 'param', 'state'):
+    kind_rows = [row for row in rows if row[1] == kind]
+    total = sum(row[4] for row in kind_rows)
+    lines.append('  {:<8}{:>6} variables {:>10.1f}MB'.format(kind, len(kind_rows), total / 2. ** 20))
+    # the big ones are what is worth knowing about
+    for name, _, shape, dtype, nbytes in sorted(kind_rows, key=lambda row: -row[4])[:5]:
+      lines.append('    {:<24}{:>20} {:<8}{:>10.1f}MB'.format(
+        name[:24], str(shape), dtype, nbytes / 2. ** 20))
+
+  activations = activation_bytes(model, n_batch)
+  if activations is not None:
+    lines.append('  activations per minibatch of {}: {:.1f}MB forward, ~{:.1f}MB training'.format(
+      n_batch, activations[0] / 2. ** 20, activations[1] / 2. ** 20))
+  current, peak = rss_mb()
+  lines.append('  process RSS {:.1f}MB (peak {:.1f}MB)'.format(current, peak))
+  return lines
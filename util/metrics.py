@@ -0,0 +1,128 @@
+import os
+import time
+import struct
+import threading
+import Queue
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# binary log format
+
+# header: magic, version, number of float64 fields per record
+MAGIC = 'NRFLOG'
+HEADER = struct.Struct('<6sHI')
+
+def is_binary_log(fname):
+  with open(fname, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def read_binary_log(fname):
+  """Memory-map a binary log as an (n_records, n_fields) float64 array"""
+  with open(fname, 'rb') as f:
+    magic, version, n_fields = HEADER.unpack(f.read(HEADER.size))
+  if magic != MAGIC or version != 1:
+    raise ValueError('%s is not a binary metrics log' % fname)
+
+  # ignore a partly written last record
+  n_records = (os.path.getsize(fname) - HEADER.size) // (8 * n_fields)
+  if n_records == 0:
+    return np.zeros((0, n_fields))
+  return np.memmap(fname, dtype='<f8', mode='r', offset=HEADER.size,
+                   shape=(n_records, n_fields))
+
+def _append_binary(fname, rows):
+  n_fields = len(rows[0])
+  if os.path.exists(fname) and os.path.getsize(fname) > 0:
+    with open(fname, 'rb') as f:
+      magic, version, n = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or n != n_fields:
+      raise ValueError('%s holds records of a different format' % fname)
+    header = ''
+  else:
+    header = HEADER.pack(MAGIC, 1, n_fields)
+
+  with open(fname, 'ab') as f:
+    f.write(header + np.asarray(rows, dtype='<f8').tostring())
+
+def _append_tsv(fname, rows):
+  with open(fname, 'a') as f:
+    f.write(''.join('\t'.join([str(m) for m in row]) + '\n' for row in rows))
+
+# ----------------------------------------------------------------------------
+# logger
+
+FORMATS = {
+  'tsv'    : ('%s.log', _append_tsv),
+  'binary' : ('%s.bin', _append_binary),
+}
+
+class MetricsLogger(object):
+  """Appends rows of metrics to log files on a background thread
+
+  log() only puts the row in a bounded buffer; the writer wakes up every
+  flush_every seconds and appends everything buffered, opening each file
+  once per flush. log() blocks if the writer falls max_rows behind.
+  """
+  def __init__(self, fmt='tsv', flush_every=5.0, max_rows=10000):
+    if fmt not in FORMATS:
+      raise ValueError('Invalid log format: %s' % fmt)
+    self.pattern, self._append = FORMATS[fmt]
+    self.flush_every = flush_every
+    self.error = None
+    self._queue = Queue.Queue(maxsize=max_rows)
+    self._thread = threading.Thread(target=self._run, name='metrics-logger')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def log(self, logname, metrics):
+    if self.error is not None:
+      raise self.error
+    self._queue.put((self.pattern % logname, list(metrics)))
+
+  def close(self):
+    """Write out everything logged so far and stop the writer"""
+    self._queue.put(None)
+    self._thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def _run(self):
+    running = True
+    while running:
+      # block for the first row, then collect until the next flush
+      rows = [self._queue.get()]
+      deadline = time.time() + self.flush_every
+      while rows[-1] is not None:
+        timeout = deadline - time.time()
+        if timeout <= 0: break
+        try:
+          rows.append(self._queue.get(timeout=timeout))
+        except Queue.Empty:
+          break
+      if rows[-1] is None:
+        running = False
+        rows.pop()
+
+      # drain whatever else is already waiting
+      while running:
+        try:
+          row = self._queue.get_nowait()
+        except Queue.Empty:
+          break
+        if row is None:
+          running = False
+        else:
+          rows.append(row)
+
+      self._write(rows)
+
+  def _write(self, rows):
+    by_file = {}
+    for fname, metrics in rows:
+      by_file.setdefault(fname, []).append(metrics)
+    for fname, metrics in by_file.items():
+      try:
+        self._append(fname, metrics)
+      except Exception as e:
+        self.error = e
@@ -0,0 +1,37 @@
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# per-channel weight quantization
+
+# axis of the output channels in dense (n_in, n_out) and conv (f, c, h, w) weights
+OUTPUT_AXIS = {'dense': 1, 'conv': 0}
+
+def quantize(W, mode, axis):
+  """Quantize W per channel along axis; returns (values, scale or None)
+
+  int8 uses a symmetric scale per channel (max |W| maps to 127); float16
+  is a plain cast and needs no scale.
+  """
+  if mode == 'float16':
+    return W.astype(np.float16), None
+  elif mode == 'int8':
+    reduce_axes = tuple(i for i in range(W.ndim) if i != axis)
+    scale = np.abs(W).max(axis=reduce_axes, keepdims=True) / 127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(W / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(W.dtype)
+  raise ValueError('Invalid quantization mode %s' % mode)
+
+def dequantize(q, scale=None, dtype=np.float32, out=None):
+  """Inverse of quantize, optionally into a preallocated array"""
+  if out is None:
+    out = np.empty(q.shape, dtype=dtype)
+  if scale is None:
+    out[...] = q
+  else:
+    np.multiply(q, scale, out=out)
+  return out
+
+def fallbacks(mode):
+  """Precisions to try for a layer, most compact first"""
+  return {'int8': ['int8', 'float16'], 'float16': ['float16']}[mode]
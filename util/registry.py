@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+import sqlite3
+
+import numpy as np
+
+from util.metrics import is_binary_log, read_binary_log
+
+# ----------------------------------------------------------------------------
+# schema
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  logname TEXT UNIQUE NOT NULL,
+  dataset TEXT, model TEXT, alg TEXT,
+  lr REAL, b1 REAL, b2 REAL, n_batch INTEGER,
+  config TEXT,
+  status TEXT,
+  started REAL, finished REAL,
+  n_epochs INTEGER,
+  best_val_err REAL, best_val_acc REAL,
+  final_val_err REAL, final_val_acc REAL
+);
+CREATE INDEX IF NOT EXISTS runs_dataset_model ON runs (dataset, model);
+CREATE INDEX IF NOT EXISTS runs_best_val_err ON runs (best_val_err);
+CREATE INDEX IF NOT EXISTS runs_best_val_acc ON runs (best_val_acc);
+
+CREATE TABLE IF NOT EXISTS epochs (
+  run_id INTEGER NOT NULL REFERENCES runs (id),
+  epoch INTEGER NOT NULL,
+  train_err REAL, train_acc REAL, val_err REAL, val_acc REAL,
+  seconds REAL,
+  PRIMARY KEY (run_id, epoch)
+);
+
+CREATE TABLE IF NOT EXISTS ingested (
+  path TEXT PRIMARY KEY,
+  mtime REAL, size INTEGER
+);
+"""
+
+# per-epoch logs that ingest reads, and their fields per record
+VAL_LOG = re.compile(r'\.val\.(log|bin)$')
+VAL_FIELDS = 5
+
+# hyperparameters that get their own (indexable) column
+COLUMNS = ['dataset', 'model', 'alg', 'lr', 'b1', 'b2', 'n_batch']
+
+# lognames built by launch.print_grid; floats are str()'d, e.g. 0.001 or 1e-05
+FLOAT = r'\d+(?:\.\d+)?(?:e[-+]?\d+)?'
+GRID_LOGNAME = re.compile(
+  r'^(?P<prefix>.+)\.(?P<dataset>[a-z]\w*)\.(?P<model>[a-z][\w-]*)\.(?P<alg>[a-z]\w*)'
+  r'\.(?P<lr>%s)\.(?P<b1>%s)\.(?P<b2>%s)'
+  r'\.(?P<n_batch>\d+)\.(?P<n_subbatch>\d+)$' % (FLOAT, FLOAT, FLOAT))
+
+def parse_logname(logname):
+  """Hyperparameters encoded in a launch.print_grid logname, or {}"""
+  match = GRID_LOGNAME.match(os.path.basename(logname))
+  if match is None:
+    return {}
+  config = match.groupdict()
+  for key in ['lr', 'b1', 'b2']:
+    config[key] = float(config[key])
+  for key in ['n_batch', 'n_subbatch']:
+    config[key] = int(config[key])
+  del config['prefix']
+  return config
+
+# ----------------------------------------------------------------------------
+# registry
+
+class Registry(object):
+  """SQLite index of training runs: config, timings and per-epoch metrics"""
+  def __init__(self, fname='runs.db'):
+    # runs started in parallel write to the same file
+    self.db = sqlite3.connect(fname, timeout=60)
+    self.db.row_factory = sqlite3.Row
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def start_run(self, logname, config):
+    """Register (or re-open, when resuming) a run; returns its id"""
+    with self.db:
+      return self._register(logname, config)
+
+  def log_epoch(self, run_id, epoch, metrics, seconds=None):
+    """Record [epoch, train_err, train_acc, val_err, val_acc] of a run"""
+    with self.db:
+      self._insert_epochs(run_id, [list(metrics) + [seconds]])
+      self._summarize(run_id)
+
+  def finish_run(self, run_id, status='done'):
+    with self.db:
+      self.db.execute('UPDATE runs SET status = ?, finished = ? WHERE id = ?',
+                      (status, time.time(), run_id))
+
+  def _register(self, logname, config, status='running'):
+    values = [config.get(key) for key in COLUMNS] + [json.dumps(config, sort_keys=True), status]
+    row = self.db.execute('SELECT id FROM runs WHERE logname = ?', (logname,)).fetchone()
+    if row is None:
+      cursor = self.db.execute(
+        'INSERT INTO runs (logname, %s, config, status, started) VALUES (?, %s, ?, ?, ?)'
+          % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+        [logname] + values + [time.time()])
+      return cursor.lastrowid
+    self.db.execute(
+      'UPDATE runs SET %s, config = ?, status = ? WHERE id = ?'
+        % ', '.join('%s = ?' % key for key in COLUMNS),
+      values + [row['id']])
+    return row['id']
+
+  def _insert_epochs(self, run_id, rows):
+    self.db.executemany(
+      'INSERT OR REPLACE INTO epochs VALUES (?, ?, ?, ?, ?, ?, ?)',
+      [[run_id, int(row[0])] + [float(m) if m is not None else None for m in row[1:6]]
+       for row in rows])
+
+  def _summarize(self, run_id):
+    self.db.execute("""
+      UPDATE runs SET
+        n_epochs = (SELECT COUNT(*) FROM epochs WHERE run_id = :id),
+        best_val_err = (SELECT MIN(val_err) FROM epochs WHERE run_id = :id),
+        best_val_acc = (SELECT MAX(val_acc) FROM epochs WHERE run_id = :id),
+        final_val_err = (SELECT val_err FROM epochs WHERE run_id = :id
+                         ORDER BY epoch DESC LIMIT 1),
+        final_val_acc = (SELECT val_acc FROM epochs WHERE run_id = :id
+                         ORDER BY epoch DESC LIMIT 1)
+      WHERE id = :id""", dict(id=run_id))
+
+  # --------------------------------------------------------------------------
+  # existing logs
+
+  def ingest(self, fnames):
+    """Register runs from <logname>.val.log (or .val.bin) files
+
+    Files already ingested with the same mtime and size are skipped, so
+    re-running this over a growing directory only reads new or changed logs.
+    Files that are not per-epoch .val logs (e.g. training or timing logs)
+    are left out. Returns the number of files read and a list of
+    (file, reason) for the files left out.
+    """
+    n_read, skipped = 0, []
+    for fname in fnames:
+      stat = os.stat(fname)
+      row = self.db.execute('SELECT mtime, size FROM ingested WHERE path = ?',
+                            (fname,)).fetchone()
+      if row is not None and (row['mtime'], row['size']) == (stat.st_mtime, stat.st_size):
+        continue
+
+      if not VAL_LOG.search(fname):
+        skipped.append((fname, 'not a .val.log or .val.bin file'))
+        continue
+      logname = VAL_LOG.sub('', fname)
+      log = _read_log(fname)
+      widths = set(len(row) for row in log)
+      if widths and widths != set([VAL_FIELDS]):
+        skipped.append((fname, 'records have %s fields, expected %d (epoch, training '
+                               'and validation loss and accuracy)'
+                               % ('/'.join(str(w) for w in sorted(widths)), VAL_FIELDS)))
+        continue
+      with self.db:
+        run_id = self._register(logname, parse_logname(logname), status='ingested')
+        self._insert_epochs(run_id, [list(row) + [None] for row in log])
+        self._summarize(run_id)
+        self.db.execute('INSERT OR REPLACE INTO ingested VALUES (?, ?, ?)',
+                        (fname, stat.st_mtime, stat.st_size))
+      n_read += 1
+    return n_read, skipped
+
+  # --------------------------------------------------------------------------
+  # queries
+
+  def query(self, filters={}, where=None, order_by='best_val_err', descending=False,
+            limit=20):
+    """Runs matching the column filters (and an optional SQL condition)"""
+    conditions, params = [], []
+    for key, value in sorted(filters.items()):
+      if key not in COLUMNS + ['status']:
+        raise ValueError('Cannot filter on %s' % key)
+      conditions.append('%s = ?' % key)
+      params.append(value)
+    if where:
+      conditions.append('(%s)' % where)
+    columns = self.run_columns()
+    if order_by not in columns:
+      raise ValueError('Cannot order by %s (columns: %s)' % (order_by, ', '.join(columns)))
+
+    sql = 'SELECT * FROM runs'
+    if conditions:
+      sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY %s IS NULL, %s %s LIMIT ?' % (
+      order_by, order_by, 'DESC' if descending else 'ASC')
+    try:
+      return self.db.execute(sql, params + [limit]).fetchall()
+    except sqlite3.OperationalError as e:
+      raise ValueError('Invalid condition %r: %s' % (where, e))
+
+  def run_columns(self):
+    return [row['name'] for row in self.db.execute('PRAGMA table_info(runs)')]
+
+  def epochs(self, run_id):
+    return self.db.execute('SELECT * FROM epochs WHERE run_id = ? ORDER BY epoch',
+                           (run_id,)).fetchall()
+
+def _read_log(fname):
+  if is_binary_log(fname):
+    return np.array(read_binary_log(fname))
+  with open(fname) as f:
+    lines = [line.split() for line in f if line.endswith('\n')]
+  return [[float(field) for field in line] for line in lines if line]
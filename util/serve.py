@@ -0,0 +1,217 @@
+import time
+import urllib2
+import threading
+import Queue
+import BaseHTTPServer
+from cStringIO import StringIO
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# request coalescing
+
+class _Pending(object):
+  """A request waiting in a MicroBatcher queue"""
+  def __init__(self, X):
+    self.X = X
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+class MicroBatcher(object):
+  """Coalesces concurrent calls to f into batched calls
+
+  A worker thread takes the oldest waiting request and keeps collecting more
+  until max_batch rows are gathered or max_latency seconds have passed since
+  it started; f then runs once on all of them and every caller receives its
+  own rows of the result. f must map (n, ...) inputs to (n, ...) outputs.
+  """
+  def __init__(self, f, max_batch=256, max_latency=0.005):
+    self.f = f
+    self.max_batch = max_batch
+    self.max_latency = max_latency
+    self._queue = Queue.Queue()
+    self._thread = threading.Thread(target=self._run, name='micro-batcher')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def __call__(self, X):
+    pending = _Pending(X)
+    self._queue.put(pending)
+    pending.done.wait()
+    if pending.error is not None:
+      raise pending.error
+    return pending.result
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+
+  def _run(self):
+    running = True
+    while running:
+      first = self._queue.get()
+      if first is None:
+        return
+
+      # collect requests until the batch is full or the deadline passes
+      batch, n_rows = [first], len(first.X)
+      deadline = time.time() + self.max_latency
+      while n_rows < self.max_batch:
+        timeout = deadline - time.time()
+        if timeout <= 0: break
+        try:
+          pending = self._queue.get(timeout=timeout)
+        except Queue.Empty:
+          break
+        if pending is None:
+          running = False
+          break
+        batch.append(pending)
+        n_rows += len(pending.X)
+
+      self._process(batch)
+
+  def _process(self, batch):
+    try:
+      Y = self.f(np.concatenate([pending.X for pending in batch]))
+    except Exception as e:
+      # don't let one malformed request fail the others
+      if len(batch) > 1:
+        for pending in batch:
+          self._process([pending])
+        return
+      batch[0].error = e
+      batch[0].done.set()
+      return
+
+    idx = 0
+    for pending in batch:
+      pending.result = Y[idx:idx + len(pending.X)]
+      idx += len(pending.X)
+      pending.done.set()
+
+# ----------------------------------------------------------------------------
+# http server
+
+def dumps_array(X):
+  buf = StringIO()
+  np.save(buf, X, allow_pickle=False)
+  return buf.getvalue()
+
+def loads_array(s):
+  return np.load(StringIO(s), allow_pickle=False)
+
+class InferenceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """POST /<method> with an .npy body; replies with the .npy result"""
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    if self.path == '/health':
+      self._reply(200, 'ok\n', 'text/plain')
+    else:
+      self._reply(404, 'unknown path %s\n' % self.path, 'text/plain')
+
+  def do_POST(self):
+    method = self.path.strip('/')
+    if method not in self.server.methods:
+      self._reply(404, 'unknown method %s\n' % method, 'text/plain')
+      return
+
+    # parse on this (pool) thread, outside the batcher
+    try:
+      body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+      X = loads_array(body)
+      X = X.reshape(len(X), -1)
+    except Exception as e:
+      self._reply(400, 'bad request: %s\n' % e, 'text/plain')
+      return
+
+    try:
+      Y = self.server.methods[method](X)
+    except Exception as e:
+      self._reply(500, 'error: %s\n' % e, 'text/plain')
+      return
+    self._reply(200, dumps_array(Y), 'application/octet-stream')
+
+  def _reply(self, code, body, content_type):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+  """HTTP server that handles connections on a fixed pool of threads"""
+  def __init__(self, address, handler, methods, n_threads=8):
+    BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+    self.methods = methods
+    self._connections = Queue.Queue(maxsize=4 * n_threads)
+    self._workers = [threading.Thread(target=self._work, name='http-worker-%d' % i)
+                     for i in range(n_threads)]
+    for worker in self._workers:
+      worker.daemon = True
+      worker.start()
+
+  def process_request(self, request, client_address):
+    self._connections.put((request, client_address))
+
+  def server_close(self):
+    for worker in self._workers:
+      self._connections.put(None)
+    for worker in self._workers:
+      worker.join()
+    BaseHTTPServer.HTTPServer.server_close(self)
+
+  def _work(self):
+    while True:
+      item = self._connections.get()
+      if item is None:
+        return
+      request, client_address = item
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+
+def model_methods(model, max_batch=256):
+  """Inference functions of a model, compiled and ready to serve"""
+  methods = {}
+  for name, spec in model.get_inference_layers().items():
+    if isinstance(spec['output'], list):
+      continue # one array per request and reply
+    # compile up front: compile_inference is not thread-safe
+    model.compile_inference(name)
+    methods[name] = lambda X, name=name: model.apply_inference(name, X, batchsize=max_batch)
+  return methods
+
+def serve(methods, host='127.0.0.1', port=8000, max_batch=256, max_latency=0.005,
+          n_threads=8):
+  """Serve a dict of inference functions (name -> f(X)) until interrupted"""
+  batchers = dict((name, MicroBatcher(f, max_batch, max_latency))
+                  for name, f in methods.items())
+
+  server = PooledHTTPServer((host, port), InferenceHandler, batchers, n_threads)
+  print 'Serving {} on http://{}:{}/'.format(', '.join(sorted(batchers)), host, port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    for batcher in batchers.values():
+      batcher.close()
+
+# ----------------------------------------------------------------------------
+# client
+
+def post_array(url, X, timeout=60):
+  """Send X to an inference server endpoint and return the result"""
+  request = urllib2.Request(url, dumps_array(np.asarray(X)),
+                            {'Content-Type': 'application/octet-stream'})
+  return loads_array(urllib2.urlopen(request, timeout=timeout).read())
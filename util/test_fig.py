@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from util import fig
+from util.fig import downsample
+
+# ----------------------------------------------------------------------------
+
+def test_downsample_keeps_endpoints_and_extrema():
+  rng = np.random.RandomState(0)
+  x = np.arange(10000, dtype=np.float64)
+  y = np.sin(x / 500.) + 0.01 * rng.randn(len(x))
+  y[3333], y[6666] = 10., -10.
+
+  xs, ys = downsample(x, y, 100)
+  assert len(xs) == 100
+  assert xs[0] == x[0] and xs[-1] == x[-1]
+  assert np.all(np.diff(xs) > 0)
+  assert ys.max() == 10. and ys.min() == -10.
+
+def test_downsample_short_curves_unchanged():
+  x, y = np.arange(50.), np.arange(50.)
+  xs, ys = downsample(x, y, 100)
+  assert np.array_equal(xs, x) and np.array_equal(ys, y)
+
+# ----------------------------------------------------------------------------
+# log cache
+
+def test_corrupt_cache_is_a_miss():
+  d = tempfile.mkdtemp()
+  try:
+    fname = os.path.join(d, 'run.val.log')
+    with open(fname, 'w') as f:
+      f.write('0\t1.5\t0.5\n1\t1.25\t0.75\n')
+    with open(fname + '.cache.npz', 'wb') as f:
+      f.write(b'PK\x03\x04 half-written')
+    fig._log_cache.clear()
+    x, y = fig.parselog(fname)
+    assert np.array_equal(x, [0, 1]) and np.array_equal(y, [0.5, 0.75])
+
+    # the rewritten cache is used once the in-memory copy is gone
+    fig._log_cache.clear()
+    assert np.array_equal(fig.readlog(fname), [[0, 1.5, 0.5], [1, 1.25, 0.75]])
+    assert sorted(os.listdir(d)) == ['run.val.log', 'run.val.log.cache.npz']
+  finally:
+    shutil.rmtree(d)
+
+def test_empty_log():
+  fd, fname = tempfile.mkstemp(suffix='.log')
+  os.close(fd)
+  try:
+    x, y = fig.parselog(fname, yi=4)
+    assert len(x) == 0 and len(y) == 0
+  finally:
+    os.remove(fname)
+    if os.path.exists(fname + '.cache.npz'):
+      os.remove(fname + '.cache.npz')
@@ -0,0 +1,32 @@
+import numpy as np
+
+from util.hamming import pack_bits, unpack_bits, hamming, knn_linear, HammingIndex
+
+# ----------------------------------------------------------------------------
+
+def clustered_codes(n, n_bits, n_clusters=20, flip=0.05, seed=0):
+  rng = np.random.RandomState(seed)
+  centers = rng.rand(n_clusters, n_bits) < 0.5
+  B = centers[rng.randint(n_clusters, size=n)]
+  return B ^ (rng.rand(n, n_bits) < flip)
+
+def test_pack_round_trip():
+  B = clustered_codes(100, 70)
+  codes = pack_bits(B)
+  assert codes.shape == (100, 2)
+  assert np.array_equal(unpack_bits(codes, 70), B)
+  assert np.array_equal(hamming(codes, codes[0]), (B != B[0]).sum(axis=1))
+
+def test_index_matches_linear_scan():
+  n_bits = 64
+  codes = pack_bits(clustered_codes(5000, n_bits))
+  index = HammingIndex(codes, n_bits)
+  queries = pack_bits(clustered_codes(30, n_bits, seed=1))
+  idx, dist = index.search(queries, k=10)
+
+  for q, i, d in zip(queries, idx, dist):
+    _, expected = knn_linear(codes, q, 10)
+    # neighbors may differ on ties, their distances may not
+    assert np.array_equal(d, expected)
+    assert np.array_equal(hamming(codes[i], q), d)
+    assert len(set(i)) == len(i)
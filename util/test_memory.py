@@ -0,0 +1,11 @@
+from models.sbn import SBN
+from util.memory import activation_bytes, report
+
+# ----------------------------------------------------------------------------
+
+def test_activations_of_a_network_with_shared_variables():
+  # SBN's network tuple ends with the centering signals c and v
+  model = SBN(n_dim=28, n_out=10, n_chan=1, n_superbatch=100)
+  forward, train = activation_bytes(model, 100)
+  assert 0 < forward < train
+  assert any('activations' in line for line in report(model, 100))
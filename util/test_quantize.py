@@ -0,0 +1,20 @@
+import numpy as np
+
+from util.quantize import quantize, dequantize
+
+# ----------------------------------------------------------------------------
+
+def test_int8_round_trip():
+  W = np.random.RandomState(0).randn(50, 20).astype(np.float32)
+  W[:, 3] = 0 # an all-zero channel must not divide by zero
+  q, scale = quantize(W, 'int8', axis=1)
+  assert q.dtype == np.int8 and scale.shape == (1, 20)
+  # rounding moves every weight by at most half a step of its channel
+  assert np.all(np.abs(dequantize(q, scale) - W) <= scale / 2 + 1e-7)
+  assert np.all(dequantize(q, scale)[:, 3] == 0)
+
+def test_float16_round_trip():
+  W = np.random.RandomState(0).randn(8, 4, 3, 3).astype(np.float32)
+  q, scale = quantize(W, 'float16', axis=0)
+  assert scale is None and q.dtype == np.float16
+  assert np.allclose(dequantize(q), W, rtol=1e-3, atol=1e-4)
@@ -0,0 +1,19 @@
+import numpy as np
+
+from util.timing import PhaseTimer
+
+# ----------------------------------------------------------------------------
+
+def test_epoch_without_batches():
+  # e.g. a dataset smaller than one minibatch
+  timer = PhaseTimer()
+  with timer.phase('evaluate'):
+    pass
+  assert np.isnan(timer.row(0, 0)[1])
+  assert timer.report(0)[-1].strip() == 'nan training examples/s'
+
+def test_throughput_counts_the_training_loop():
+  timer = PhaseTimer()
+  timer.phases['train'].durations.extend([0.5, 0.5])
+  timer.phases['evaluate'].durations.append(10.)
+  assert timer.row(3, 100)[:2] == [3, 100.]
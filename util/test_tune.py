@@ -0,0 +1,23 @@
+import os
+
+from util import tune
+
+RUN_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run.py')
+
+# ----------------------------------------------------------------------------
+
+def test_settings_env():
+  env = {'THEANO_FLAGS': 'floatX=float32,openmp=True,' + tune.CONV_FLAG}
+  legacy = tune.settings_env(dict(threads=2, openmp=False, conv='legacy'), env)
+  assert legacy['OMP_NUM_THREADS'] == '2'
+  assert legacy['THEANO_FLAGS'].split(',') == ['floatX=float32', 'openmp=False', tune.CONV_FLAG]
+
+  # profiles from before the conv setting use CorrMM
+  corrmm = tune.settings_env(dict(threads=1, openmp=True), legacy)
+  assert corrmm['THEANO_FLAGS'].split(',') == ['floatX=float32', 'openmp=True']
+
+def test_one_trial():
+  # runs `run.py bench` in a subprocess, as `run.py tune` does
+  settings = dict(threads=1, openmp=False, conv='corrmm')
+  result = tune.run_trial('softmax', 'mnist', settings, [32], 2, run_py=RUN_PY)
+  assert result is not None and result.keys() == [32] and result[32] > 0
@@ -0,0 +1,73 @@
+import json
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------
+# aggregation
+
+def _node(key):
+  # newer Theano keys apply_time by (fgraph, node) instead of node
+  return key[1] if isinstance(key, tuple) else key
+
+def collect(functions):
+  """Per-function, per-Op and per-Apply times of profiled Theano functions
+
+  functions maps names to functions compiled with profiling enabled
+  (theano.config.profile = True); functions without a profile are skipped.
+  Ops are grouped by their string form (e.g. Elemwise{add}, CorrMM), Applies
+  by function and node, and both are sorted by total time.
+  """
+  fns, ops, applies = OrderedDict(), {}, []
+  for name, f in functions.items():
+    stats = getattr(f, 'profile', None)
+    if not stats or not stats.fct_callcount:
+      continue
+    fns[name] = dict(calls=stats.fct_callcount, time=stats.fct_call_time,
+                     vm_time=stats.vm_call_time)
+
+    for key, t in stats.apply_time.items():
+      node = _node(key)
+      calls = stats.apply_callcount.get(key, 0)
+      op = str(node.op)
+      entry = ops.setdefault(op, dict(op=op, type=type(node.op).__name__,
+                                      time=0., calls=0, applies=0))
+      entry['time'] += t
+      entry['calls'] += calls
+      entry['applies'] += 1
+      applies.append(dict(function=name, apply=str(node), op=op, time=t, calls=calls))
+
+  total = sum(entry['time'] for entry in ops.values()) or 1.
+  ops = sorted(ops.values(), key=lambda entry: -entry['time'])
+  applies = sorted(applies, key=lambda entry: -entry['time'])
+  for entry in ops + applies:
+    entry['fraction'] = entry['time'] / total
+  return dict(functions=fns, ops=ops, applies=applies, apply_time=total)
+
+# ----------------------------------------------------------------------------
+# reports
+
+def format_report(report, top=20):
+  lines = ['Functions:']
+  for name, stats in report['functions'].items():
+    lines.append('  {:<24}{:>8} calls{:>12.3f}s'.format(name, stats['calls'], stats['time']))
+
+  lines += ['', 'Top {} ops ({:.3f}s in applies):'.format(top, report['apply_time']),
+            '  {:>7}{:>10}{:>9}{:>8}  {}'.format('%', 'time (s)', 'calls', 'applies', 'op')]
+  for entry in report['ops'][:top]:
+    lines.append('  {:>6.1f}%{:>10.3f}{:>9}{:>8}  {}'.format(
+      100 * entry['fraction'], entry['time'], entry['calls'], entry['applies'], entry['op']))
+
+  lines += ['', 'Top {} applies:'.format(top),
+            '  {:>7}{:>10}{:>9}  {}'.format('%', 'time (s)', 'calls', 'function: apply')]
+  for entry in report['applies'][:top]:
+    lines.append('  {:>6.1f}%{:>10.3f}{:>9}  {}: {}'.format(
+      100 * entry['fraction'], entry['time'], entry['calls'], entry['function'],
+      entry['apply'][:120]))
+  return '\n'.join(lines) + '\n'
+
+def write_report(report, prefix, top=20):
+  """Write <prefix>.profile.json and the top-N text summary <prefix>.profile.txt"""
+  with open(prefix + '.profile.json', 'w') as f:
+    json.dump(report, f, indent=1)
+  with open(prefix + '.profile.txt', 'w') as f:
+    f.write(format_report(report, top))
+  return prefix + '.profile.json', prefix + '.profile.txt'
@@ -0,0 +1,105 @@
+from timeit import default_timer as clock
+from collections import OrderedDict
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# phase timers
+
+# phases of a training epoch, in the order they are reported and logged
+PHASES = ['shuffle', 'load_data', 'train', 'metrics', 'log', 'evaluate', 'checkpoint']
+
+# the phases of the training loop, which training throughput is measured over
+LOOP_PHASES = ['shuffle', 'load_data', 'train', 'metrics', 'log']
+
+class _Phase(object):
+  __slots__ = ('durations', 'start')
+
+  def __init__(self):
+    self.durations = []
+
+  def __enter__(self):
+    self.start = clock()
+
+  def __exit__(self, *exc_info):
+    self.durations.append(clock() - self.start)
+
+class PhaseTimer(object):
+  """Collects the duration of every occurrence of each training phase
+
+  Use as `with timer.phase('train'): ...`; phases must not nest under
+  the same name.
+  """
+  def __init__(self):
+    self.phases = OrderedDict((name, _Phase()) for name in PHASES)
+    self.start = clock()
+
+  def phase(self, name):
+    if name not in self.phases:
+      self.phases[name] = _Phase()
+    return self.phases[name]
+
+  def reset(self):
+    for phase in self.phases.values():
+      del phase.durations[:]
+    self.start = clock()
+
+  def summary(self):
+    """name -> (count, total, p50, p95, max) of the durations, in seconds"""
+    stats = OrderedDict()
+    for name, phase in self.phases.items():
+      if not phase.durations:
+        stats[name] = (0, 0., 0., 0., 0.)
+        continue
+      d = np.array(phase.durations)
+      p50, p95 = np.percentile(d, [50, 95])
+      stats[name] = (len(d), d.sum(), p50, p95, d.max())
+    return stats
+
+  def loop_seconds(self):
+    """Time spent in the training loop since the last reset"""
+    summary = self.summary()
+    return sum(summary[name][1] for name in LOOP_PHASES)
+
+  def throughput(self, n_examples):
+    """Training examples/s over the training loop, or nan if it did not run
+    (e.g. an epoch with no full minibatch)"""
+    seconds = self.loop_seconds()
+    if not n_examples or seconds <= 0:
+      return float('nan')
+    return n_examples / seconds
+
+  def report(self, n_examples):
+    """Per-phase breakdown since the last reset, as printable lines"""
+    elapsed = max(clock() - self.start, 1e-12)
+    lines = ['  {:<12}{:>8}{:>10}{:>8}{:>12}{:>12}{:>12}'.format(
+      'phase', 'count', 'total (s)', '%', 'p50 (ms)', 'p95 (ms)', 'max (ms)')]
+    for name, (count, total, p50, p95, max_) in self.summary().items():
+      if not count: continue
+      lines.append('  {:<12}{:>8}{:>10.3f}{:>8.1f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+        name, count, total, 100 * total / elapsed, 1000 * p50, 1000 * p95, 1000 * max_))
+    lines.append('  {:.1f} training examples/s'.format(self.throughput(n_examples)))
+    return lines
+
+  def row(self, epoch, n_examples):
+    """[epoch, training examples/s, total seconds of each phase] for the metrics log"""
+    summary = self.summary()
+    return [epoch, self.throughput(n_examples)] + [float(summary[name][1]) for name in PHASES]
+
+class _NullPhase(object):
+  __slots__ = ()
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc_info):
+    pass
+
+class NullTimer(object):
+  """Stands in for a PhaseTimer when timing is off; phases cost one call"""
+  _phase = _NullPhase()
+
+  def phase(self, name):
+    return self._phase
+
+NULL_TIMER = NullTimer()
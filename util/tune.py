@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+
+# per-host results of `run.py tune`, read by `run.py train`
+PROFILE = os.path.expanduser('~/.nrfl-tune.json')
+
+# BLAS and OpenMP read these when they are loaded, so they only take effect
+# in a fresh process
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+# set in processes started with tuned settings, so they don't restart again
+TUNED_VAR = 'NRFL_TUNED'
+
+# CPU convolution implementations: Theano's default CorrMM (im2col + gemm),
+# or the legacy ConvOp it falls back to when the conv_gemm rewrite is off
+CONV_IMPLS = ['corrmm', 'legacy']
+CONV_FLAG = 'optimizer_excluding=conv_gemm'
+
+# ----------------------------------------------------------------------------
+# trials
+
+def thread_counts(n_cpus=None):
+  """1, 2, 4, ... up to and including the number of cores"""
+  n_cpus = n_cpus or multiprocessing.cpu_count()
+  counts = [1]
+  while counts[-1] * 2 < n_cpus:
+    counts.append(counts[-1] * 2)
+  if counts[-1] != n_cpus:
+    counts.append(n_cpus)
+  return counts
+
+def settings_env(settings, env=None):
+  """A copy of env with the thread count, Theano OpenMP flag and conv
+  implementation of settings (profiles without a conv setting use CorrMM)"""
+  env = dict(os.environ if env is None else env)
+  for var in THREAD_VARS:
+    env[var] = str(settings['threads'])
+  flags = [flag for flag in env.get('THEANO_FLAGS', '').split(',')
+           if flag and not flag.startswith('openmp=') and flag != CONV_FLAG]
+  flags.append('openmp=%s' % bool(settings['openmp']))
+  if settings.get('conv', 'corrmm') == 'legacy':
+    flags.append(CONV_FLAG)
+  env['THEANO_FLAGS'] = ','.join(flags)
+  return env
+
+def run_trial(model, dataset, settings, batch_sizes, n_steps, run_py='run.py'):
+  """Train-step examples/s per batch size under settings, or None on failure"""
+  fd, out = tempfile.mkstemp(suffix='.json')
+  os.close(fd)
+  try:
+    cmd = [sys.executable, run_py, 'bench', '--models', model, '--dataset', dataset,
+           '--steps', str(n_steps), '--out', out, '--batch-sizes'] + map(str, batch_sizes)
+    with open(os.devnull, 'w') as devnull:
+      status = subprocess.call(cmd, env=settings_env(settings), stdout=devnull)
+    with open(out) as f:
+      result = json.load(f)[model]
+  except (IOError, ValueError, KeyError):
+    return None
+  finally:
+    os.remove(out)
+  if status != 0 or 'error' in result:
+    return None
+  return dict((int(b), v) for b, v in result['train'].items())
+
+def tune(model, dataset, batch_sizes, n_steps=20, threads=None, convs=CONV_IMPLS,
+         run_py='run.py'):
+  """Time every thread count, OpenMP setting and conv implementation;
+  returns the best per batch size
+
+  The result maps each batch size to a dict with threads, openmp, conv and
+  the examples_per_sec it reached.
+  """
+  best = {}
+  for n_threads in threads or thread_counts():
+    for openmp in (False, True):
+      for conv in convs:
+        settings = dict(threads=n_threads, openmp=openmp, conv=conv)
+        label = '{:>3} threads, openmp={:<5}, conv={:<6}'.format(n_threads, openmp, conv)
+        result = run_trial(model, dataset, settings, batch_sizes, n_steps, run_py)
+        if result is None:
+          print '{}: failed'.format(label)
+          continue
+        print '{}: {}'.format(label, '  '.join(
+          'b{}={:.0f}/s'.format(b, result[b]) for b in sorted(result)))
+
+        for b, examples_per_sec in result.items():
+          if b not in best or examples_per_sec > best[b]['examples_per_sec']:
+            best[b] = dict(settings, examples_per_sec=examples_per_sec)
+  return best
+
+# ----------------------------------------------------------------------------
+# profiles
+
+def load_profile(fname=PROFILE):
+  if not os.path.exists(fname):
+    return {}
+  with open(fname) as f:
+    return json.load(f)
+
+def save_profile(model, dataset, best, fname=PROFILE):
+  """Record the best settings for model on dataset on this host"""
+  # several hosts may share a home directory: hold a lock from reading the
+  # profile to replacing it, and write through a temp file of our own
+  with open(fname + '.lock', 'a') as lock:
+    fcntl.lockf(lock, fcntl.LOCK_EX)
+    profile = load_profile(fname)
+    host = profile.setdefault(socket.gethostname(), {})
+    host['%s.%s' % (model, dataset)] = dict(
+      tuned=time.time(), batches=dict((str(b), s) for b, s in best.items()))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                               prefix=os.path.basename(fname) + '.')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(profile, f, indent=1, sort_keys=True)
+      os.rename(tmp, fname)
+    except Exception:
+      os.remove(tmp)
+      raise
+
+def lookup(model, dataset, n_batch, fname=PROFILE):
+  """Tuned settings for this host, model and dataset, or None
+
+  Settings come from the tuned batch size closest to n_batch (by ratio).
+  """
+  entry = load_profile(fname).get(socket.gethostname(), {}).get('%s.%s' % (model, dataset))
+  if not entry or not entry['batches']:
+    return None
+  b = min(entry['batches'], key=lambda b: abs(float(b) / n_batch - 1) + abs(n_batch / float(b) - 1))
+  return entry['batches'][b]
+
+def restart_with(settings):
+  """Re-run this command in a fresh process under settings; does not return"""
+  env = settings_env(settings)
+  env[TUNED_VAR] = '1'
+  sys.stdout.flush()
+  os.execve(sys.executable, [sys.executable] + sys.argv, env)